@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+"""Benchmarks for the render pipeline and the http front end.
+
+Everything runs offline: the templates are generated into a temporary
+folder and redis is replaced by fakeredis. The results are written as json,
+pass a previous result with --compare to see the changes.
+
+    python benchmarks/run.py --output bench.json --compare old.json
+"""
+import argparse
+import contextlib
+import http.server
+import json
+import logging
+import os
+import pathlib
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import fakeredis
+from redis import Redis
+from rq import Queue, SimpleWorker, Worker
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from httypist import processor  # noqa: E402
+from httypist import registry  # noqa: E402
+from httypist import routing  # noqa: E402
+from httypist import storage  # noqa: E402
+
+STAGES = [
+    "prepare_files",
+    "process_template_files",
+    "post_processing",
+    "pack_result",
+    "upload_results",
+    "do_callbacks",
+]
+
+
+def measure(function, repeat):
+    """Run function repeat times and return statistics in seconds"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return summarize(timings)
+
+
+def summarize(timings):
+    timings = sorted(timings)
+    return dict(
+        count=len(timings),
+        mean=statistics.mean(timings),
+        median=statistics.median(timings),
+        p95=timings[int(0.95 * (len(timings) - 1))],
+        min=timings[0],
+        max=timings[-1],
+    )
+
+
+def build_template(base, name="bench", callback_url=None, assets=20):
+    """Create a template folder like the ones in test/testrepo"""
+    path = pathlib.Path(base) / name
+    (path / "assets").mkdir(parents=True)
+    for i in range(assets):
+        (path / "assets" / f"logo{i}.png").write_bytes(os.urandom(64 * 1024))
+    (path / "letter.txt.jinja").write_text(
+        "Dear {{ json.name }},\n"
+        "{% for item in json['items'] %}{{ loop.index }}: {{ item }}\n{% endfor %}"
+    )
+    config = dict(
+        output=dict(files=["letter.txt", "copy.txt"]),
+        post=dict(txt=dict(commands=dict(copy="cp letter.txt copy.txt"))),
+    )
+    if callback_url:
+        config["callbacks"] = dict(
+            bench=dict(
+                method="post",
+                template=callback_url,
+                data=[dict(name="letter", file="letter.txt")],
+            )
+        )
+    return dict(name=name, path=str(path), commit=None, config=config)
+
+
+def request_data(i=0):
+    return dict(
+        body=b"",
+        json=dict(type=f"type{i}", name="Bench", items=list(range(100))),
+        headers={},
+        query={},
+        client="127.0.0.1",
+    )
+
+
+@contextlib.contextmanager
+def callback_endpoint():
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}/callback"
+    finally:
+        server.shutdown()
+
+
+def bench_stages(base, repeat):
+    with callback_endpoint() as url:
+        template = build_template(base, callback_url=url)
+        timings = {stage: [] for stage in STAGES}
+        for _ in range(repeat):
+            t = processor.Template(template, request_data())
+            for stage in STAGES:
+                start = time.perf_counter()
+                getattr(t, stage)()
+                timings[stage].append(time.perf_counter() - start)
+    return {stage: summarize(values) for stage, values in timings.items()}
+
+
+def bench_routing(repeat):
+    results = {}
+    for count in (10, 100, 1000):
+        index = routing.SelectorIndex()
+        for i in range(count):
+            if i % 2:
+                index.add(f"t{i}", f'json.type == "type{i}"')
+            else:
+                index.add(f"t{i}", f'json.type == "type{i}" and json.name')
+        data = request_data(count - 1)
+        results[str(count)] = measure(lambda: index.match(data), repeat)
+    return results
+
+
+def bench_queue(base, connection, repeat):
+    template = build_template(base, name="queued")
+    q = Queue("process", connection=connection)
+    worker = SimpleWorker([q], connection=connection)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        job = q.enqueue(processor.process_template, template=template, data=request_data())
+        worker.work(burst=True)
+        job.refresh()
+        assert job.get_status() == "finished", job.exc_info
+        timings.append(time.perf_counter() - start)
+    return summarize(timings)
+
+
+@contextlib.contextmanager
+def redis_server():
+    """A fakeredis server on a socket, the forked work horses reach it too"""
+    server = fakeredis.TcpFakeServer(("127.0.0.1", 0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield Redis(*server.server_address)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def bench_workers(base, repeat):
+    """Jobs per second of a pool process (jobs run in the long lived process,
+    see worker.pool) and of the rq worker forking a work horse per job"""
+    template = build_template(base, name="pooled")
+    results = {}
+    with redis_server() as connection:
+        q = Queue("process", connection=connection)
+        for name, worker_class in (("pool", SimpleWorker), ("fork", Worker)):
+            worker = worker_class([q], connection=connection)
+            jobs = [
+                q.enqueue(processor.process_template, template=template, data=request_data())
+                for _ in range(repeat)
+            ]
+            start = time.perf_counter()
+            worker.work(burst=True)
+            elapsed = time.perf_counter() - start
+            for job in jobs:
+                job.refresh()
+                assert job.get_status() == "finished", job.exc_info
+            results[name] = dict(
+                count=repeat, mean=elapsed / repeat, jobs_per_second=repeat / elapsed
+            )
+    return results
+
+
+def bench_http(base, connection, repeat):
+    from fastapi.testclient import TestClient
+    from httypist import server
+
+    template = build_template(base, name="http")
+    server.q = Queue("process", connection=connection)
+    server.current_registry = registry.Registry(templates={"http": template})
+    client = TestClient(server.app)
+    done = server.q.enqueue(processor.process_template, template=template, data=request_data())
+    SimpleWorker([server.q], connection=connection).work(burst=True)
+
+    def process():
+        assert client.post("/process/http", json=request_data()["json"]).status_code == 200
+
+    def status():
+        assert client.get(f"/status/{done.id}").status_code == 200
+
+    def result():
+        assert client.get(f"/result/{done.id}").status_code == 200
+
+    results = {}
+    for name, function in (("process", process), ("status", status), ("result", result)):
+        stats = measure(function, repeat)
+        stats["requests_per_second"] = 1 / stats["mean"]
+        results[name] = stats
+    return results
+
+
+def git_commit():
+    result = subprocess.run(
+        ["git", "rev-parse", "HEAD"], capture_output=True, text=True
+    )
+    return result.stdout.strip() or None
+
+
+def compare(old, new, prefix=""):
+    """Print the change of the mean values between two results"""
+    for key, value in new.items():
+        if not isinstance(value, dict) or key not in old:
+            continue
+        if "mean" in value and "mean" in old[key]:
+            change = value["mean"] / old[key]["mean"] - 1 if old[key]["mean"] else 0
+            print(f"{prefix}{key}: {old[key]['mean'] * 1000:.3f}ms -> {value['mean'] * 1000:.3f}ms ({change:+.1%})")
+        else:
+            compare(old[key], value, f"{prefix}{key}.")
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output", default="bench.json", help="write the results to this file")
+    parser.add_argument("--compare", help="compare with a previous result file")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args(args)
+
+    logging.disable(logging.WARNING)
+    output = os.path.abspath(args.output)
+    commit = git_commit()
+    connection = fakeredis.FakeRedis()
+    with tempfile.TemporaryDirectory() as base:
+        os.chdir(base)
+        storage._store = storage.LocalStore(os.path.join(base, "store"))
+        benchmarks = dict(
+            stages=bench_stages(base, args.repeat),
+            routing=bench_routing(args.repeat * 50),
+            queue=bench_queue(base, connection, args.repeat),
+            workers=bench_workers(base, args.repeat),
+            http=bench_http(base, connection, args.repeat),
+        )
+    result = dict(
+        commit=commit,
+        timestamp=time.time(),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        benchmarks=benchmarks,
+    )
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f)["benchmarks"], benchmarks)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,12 +9,15 @@ def parse_args(args=None):
     #parser.add_argument("square", type=int, help="display a square of a given number")
     #parser.add_argument("-v", "--verbosity", type=int, help="increase output verbosity")
     parser.add_argument("-w", "--worker", action='store_true', help="start worker")
+    parser.add_argument("--pool", type=int, help="number of long lived worker processes")
+    parser.add_argument("--max-jobs", type=int, help="restart a worker process after this many jobs")
+    parser.add_argument("--max-workers", help="scale the pool up to this many processes with the load, auto is the number of cpus")
     return parser.parse_known_args(args)
 
 if __name__ == "__main__":
     args, unknown = parse_args()
     sys.argv = sys.argv[0:1] + unknown
     if args.worker:
-        worker.main()
+        worker.main(pool_size=args.pool, max_jobs=args.max_jobs, max_workers=args.max_workers)
     else:
         server.main()
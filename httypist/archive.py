@@ -0,0 +1,103 @@
+import contextlib
+import glob
+import io
+import os
+import pathlib
+import time
+import zipfile
+
+COMPRESSION = {
+    "store": zipfile.ZIP_STORED,
+    "deflate": zipfile.ZIP_DEFLATED,
+    "bzip2": zipfile.ZIP_BZIP2,
+    "lzma": zipfile.ZIP_LZMA,
+}
+DEFAULT_COMPRESSION = "deflate"
+CHUNK_SIZE = 64 * 1024
+
+
+def get_compression(config):
+    """Return the zip compression configured for the template output"""
+    name = config.get("output", {}).get("compression", DEFAULT_COMPRESSION)
+    try:
+        return COMPRESSION[str(name).lower()]
+    except KeyError:
+        raise ValueError(f"unknown compression {name}")
+
+
+def iter_folder(folder):
+    """Yield (path, name in archive) for everything below folder"""
+    folder = pathlib.Path(folder)
+    for i in sorted(glob.iglob(str(folder / "**/*"), recursive=True)):
+        path = pathlib.Path(i)
+        yield path, str(path.relative_to(folder))
+
+
+def write_zip(target, files, compression=zipfile.ZIP_DEFLATED):
+    with zipfile.ZipFile(target, "w", compression=compression) as zf:
+        for path, arcname in files:
+            zf.write(path, arcname=arcname)
+
+
+class _StreamBuffer(object):
+    """Write only file object collecting the data written by ZipFile"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def zip_bytes(files, compression=zipfile.ZIP_DEFLATED):
+    """An archive of {name: bytes} built in memory"""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=compression) as zf:
+        for name, content in files.items():
+            zf.writestr(name, content)
+    return buffer.getvalue()
+
+
+def stream_zip(files, compression=zipfile.ZIP_DEFLATED, chunk_size=CHUNK_SIZE):
+    """Build a zip archive on the fly and yield it in chunks.
+
+    The archive is never written to disk, the files (paths or artifacts of
+    the store) are read and compressed while the previous chunks are
+    already sent.
+    """
+    buffer = _StreamBuffer()
+    with zipfile.ZipFile(buffer, "w", compression=compression) as zf:
+        for source, arcname in files:
+            if isinstance(source, (str, os.PathLike)):
+                path = pathlib.Path(source)
+                if path.is_dir():
+                    zf.write(path, arcname=arcname)
+                    continue
+                info = zipfile.ZipInfo.from_file(path, arcname=arcname)
+                fileobj = open(path, "rb")
+            else:
+                info = zipfile.ZipInfo(
+                    arcname, time.localtime(source.mtime)[:6]
+                )
+                info.file_size = source.size
+                fileobj = source.open()
+            info.compress_type = compression
+            with contextlib.closing(fileobj) as src, zf.open(info, "w") as dst:
+                while True:
+                    data = src.read(chunk_size)
+                    if not data:
+                        break
+                    dst.write(data)
+                    if sum(len(c) for c in buffer.chunks) >= chunk_size:
+                        yield buffer.pop()
+            yield buffer.pop()
+    yield buffer.pop()
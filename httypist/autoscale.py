@@ -0,0 +1,148 @@
+import datetime
+import json
+import logging
+import math
+import os
+import socket
+import time
+
+import rq
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+INTERVAL = float(os.getenv("HTTYPIST_SCALE_INTERVAL", 5))
+# the backlog should be done within this time
+TARGET_SECONDS = float(os.getenv("HTTYPIST_SCALE_TARGET_SECONDS", 30))
+# the demand has to stay lower this long before workers are stopped
+DOWN_DELAY = float(os.getenv("HTTYPIST_SCALE_DOWN_DELAY", 60))
+REDIS_KEY = "httypist:autoscale"
+
+
+def get_maximum(value):
+    """The `--max-workers` argument, `auto` is the number of cpus"""
+    if value in (None, "auto"):
+        return os.cpu_count() or 1
+    return int(value)
+
+
+def _timestamp(moment):
+    if moment.tzinfo is None:
+        # rq stores naive utc times
+        moment = moment.replace(tzinfo=datetime.timezone.utc)
+    return moment.timestamp()
+
+
+def job_seconds(connection):
+    """The average duration of the jobs of all workers from the metrics"""
+    _, histograms = metrics.load(connection)
+    count = total = 0
+    for (name, _), histogram in histograms.items():
+        if name in ("job_seconds", "batch_seconds"):
+            count += histogram.count
+            total += histogram.sum
+    return total / count if count else 1.0
+
+
+class Autoscaler(object):
+    """Decide how many worker processes a pool should run.
+
+    The number follows the work waiting in the queues: the jobs in the queues
+    times the average job duration should be done within TARGET_SECONDS by
+    the idle workers, a job waiting longer than that adds a worker in any
+    case. Workers are only stopped after the demand has been lower for
+    DOWN_DELAY seconds.
+    """
+
+    def __init__(self, connection, queue_names, minimum, maximum):
+        self.connection = connection
+        self.queue_names = queue_names
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self.low_since = None
+
+    def observe(self, pids=()):
+        depth = 0
+        oldest = 0.0
+        now = time.time()
+        for name in self.queue_names:
+            queue = rq.Queue(name, connection=self.connection)
+            depth += queue.count
+            jobids = queue.get_job_ids(0, 1)
+            job = queue.fetch_job(jobids[0]) if jobids else None
+            if job is not None and job.enqueued_at is not None:
+                oldest = max(oldest, now - _timestamp(job.enqueued_at))
+        hostname = socket.gethostname()
+        busy = sum(
+            1
+            for w in rq.Worker.all(connection=self.connection)
+            if w.hostname == hostname and w.pid in pids and w.get_state() == "busy"
+        )
+        return dict(
+            depth=depth,
+            oldest=oldest,
+            busy=busy,
+            job_seconds=job_seconds(self.connection),
+        )
+
+    def wanted(self, running, observation):
+        backlog = observation["depth"] * observation["job_seconds"]
+        wanted = observation["busy"] + math.ceil(backlog / TARGET_SECONDS)
+        if observation["oldest"] > TARGET_SECONDS:
+            wanted = max(wanted, running + 1)
+        return max(self.minimum, min(self.maximum, wanted))
+
+    def decide(self, running, pids=(), now=None):
+        """The number of workers to run now"""
+        now = time.monotonic() if now is None else now
+        observation = self.observe(pids)
+        wanted = self.wanted(running, observation)
+        target = running
+        if wanted > running:
+            target = wanted
+            self.low_since = None
+        elif wanted < running:
+            if self.low_since is None:
+                self.low_since = now
+            if now - self.low_since >= DOWN_DELAY:
+                target = wanted
+                self.low_since = None
+        else:
+            self.low_since = None
+        if target != running:
+            direction = "up" if target > running else "down"
+            logger.info(
+                f"scaling {direction} from {running} to {target} workers: "
+                f"{observation['depth']} jobs queued, oldest {observation['oldest']:.0f}s, "
+                f"{observation['busy']} busy, {observation['job_seconds']:.1f}s per job"
+            )
+            metrics.inc("autoscale_events", direction=direction)
+        self.report(running, target)
+        return target
+
+    def report(self, running, target):
+        """Share the state of this pool with the servers"""
+        try:
+            state = dict(running=running, target=target, time=time.time())
+            self.connection.hset(REDIS_KEY, self.name, json.dumps(state))
+            metrics.flush(self.connection)
+        except Exception:
+            logger.exception("could not report the autoscaler state")
+
+    def remove(self):
+        self.connection.hdel(REDIS_KEY, self.name)
+
+
+def load(connection, max_age=None):
+    """The state of all running pools, as {supervisor: state}"""
+    max_age = max_age or 5 * INTERVAL
+    states = {}
+    for name, value in connection.hgetall(REDIS_KEY).items():
+        state = json.loads(value)
+        if time.time() - state["time"] > max_age:
+            connection.hdel(REDIS_KEY, name)
+            continue
+        states[name.decode()] = state
+    return states
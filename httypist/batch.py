@@ -0,0 +1,147 @@
+import io
+import json
+import os
+from rq.job import Job
+
+from . import processor
+from . import storage
+
+BATCH_CHUNK_SIZE = int(os.getenv("HTTYPIST_BATCH_CHUNK_SIZE", 100))
+BATCH_TTL = int(os.getenv("HTTYPIST_BATCH_TTL", 24 * 60 * 60))
+KEY = "httypist:batch:{}"
+
+
+class BatchError(ValueError):
+    pass
+
+
+def parse_records(fileobj):
+    """Yield the records of a json array or of newline delimited json.
+
+    Newline delimited json is read line by line, an array (or a single
+    record spanning several lines) has to be parsed as a whole.
+    """
+    fileobj.seek(0)
+    start = fileobj.read(1024).lstrip()
+    fileobj.seek(0)
+    try:
+        if start.startswith(b"["):
+            records = json.load(fileobj)
+            if not isinstance(records, list):
+                raise BatchError("invalid records: not an array")
+            yield from records
+            return
+        for number, line in enumerate(fileobj):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                if number > 0:
+                    raise
+                # a single record, pretty printed
+                fileobj.seek(0)
+                yield json.load(fileobj)
+                return
+    except ValueError as e:
+        raise BatchError(f"invalid records: {e}")
+
+
+def store_records(fileobj, template, batchid):
+    """Parse the records and store them in chunks of `batch_chunk_size` as
+    newline delimited json, returns [(offset, count, key)]"""
+    size = template["config"].get("batch_chunk_size", BATCH_CHUNK_SIZE)
+    store = storage.get_store()
+    chunks = []
+    lines = []
+
+    def flush():
+        key = f"uploads/{batchid}/chunks/{len(chunks)}"
+        store.put(key, io.BytesIO(b"".join(lines)))
+        chunks.append((sum(c[1] for c in chunks), len(lines), key))
+        lines.clear()
+
+    for record in parse_records(fileobj):
+        lines.append(json.dumps(record).encode() + b"\n")
+        if len(lines) == size:
+            flush()
+    if lines:
+        flush()
+    if not chunks:
+        raise BatchError("no records")
+    return chunks
+
+
+def enqueue(queue, template, batchid, chunks, data, jobids=None, quota=None):
+    """Enqueue the stored chunks, all with one round trip to redis.
+
+    `jobids` and `quota` are the in-flight slots of the client reserved for
+    the jobs (see ratelimit.reserve).
+    """
+    jobids = jobids or [None] * len(chunks)
+    job_datas = [
+        queue.prepare_data(
+            processor.process_batch,
+            kwargs=dict(template=template, records=key, data=data, offset=offset),
+            result_ttl=BATCH_TTL,
+            job_id=jobid,
+            meta=dict(batch=batchid, done=0, failed=0, quota=quota),
+        )
+        for (offset, _, key), jobid in zip(chunks, jobids)
+    ]
+    with queue.connection.pipeline() as pipe:
+        jobs = queue.enqueue_many(job_datas, pipeline=pipe)
+        info = dict(
+            template=template["name"],
+            records=sum(count for _, count, _ in chunks),
+            jobs=[[job.id, count] for job, (_, count, _) in zip(jobs, chunks)],
+        )
+        pipe.set(KEY.format(batchid), json.dumps(info), ex=BATCH_TTL)
+        pipe.execute()
+    return jobs
+
+
+def load(connection, batchid):
+    info = connection.get(KEY.format(batchid))
+    if info is None:
+        return None
+    info = json.loads(info)
+    info["batch_id"] = batchid
+    return info
+
+
+def fetch_jobs(connection, info):
+    ids = [jobid for jobid, _ in info["jobs"]]
+    return zip(Job.fetch_many(ids, connection=connection), info["jobs"])
+
+
+def status(connection, info):
+    done = failed = 0
+    finished = True
+    for job, (_, count) in fetch_jobs(connection, info):
+        state = job.get_status() if job is not None else "failed"
+        if state == "failed" or job is None:
+            failed += count
+            continue
+        done += job.meta.get("done", 0)
+        failed += job.meta.get("failed", 0)
+        finished = finished and state == "finished"
+    return dict(
+        template=info["template"],
+        batch_id=info["batch_id"],
+        records=info["records"],
+        done=done,
+        failed=failed,
+        finished=finished,
+    )
+
+
+def result_files(connection, info):
+    """(artifact, name in archive) of all finished records of the batch"""
+    store = storage.get_store()
+    for job, _ in fetch_jobs(connection, info):
+        if job is None or job.get_status() != "finished":
+            continue
+        prefix = f"{job.result['artifacts']}/records/"
+        for artifact in store.list(prefix):
+            yield artifact, artifact.key[len(prefix) :]
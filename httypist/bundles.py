@@ -0,0 +1,156 @@
+import contextlib
+import hashlib
+import logging
+import os
+import pathlib
+import shutil
+import tarfile
+import tempfile
+import time
+
+from . import storage
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.getenv(
+    "HTTYPIST_BUNDLE_CACHE", os.path.join(tempfile.gettempdir(), "httypist-bundles")
+)
+CACHE_SIZE = int(os.getenv("HTTYPIST_BUNDLE_CACHE_SIZE", 1024 * 1024 * 1024))
+# bundles used within this time are not evicted, a job may still read them
+MIN_AGE = 10 * 60
+SPOOL_SIZE = 1024 * 1024
+
+
+class BundleError(Exception):
+    pass
+
+
+def bundle_key(digest):
+    return f"bundles/{digest}.tar"
+
+
+def _reset(info):
+    # the same files always give the same archive
+    info.mtime = 0
+    info.uid = info.gid = 0
+    info.uname = info.gname = ""
+    return info
+
+
+def pack(path):
+    """The template folder as tar in a temporary file and its sha256"""
+    path = pathlib.Path(path)
+    fileobj = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+    with tarfile.open(fileobj=fileobj, mode="w", format=tarfile.PAX_FORMAT) as tar:
+        for root, dirs, files in os.walk(path, followlinks=True):
+            dirs[:] = sorted(d for d in dirs if d != ".git")
+            for name in dirs:
+                source = pathlib.Path(root) / name
+                name = str(source.relative_to(path))
+                tar.addfile(_reset(tar.gettarinfo(source.resolve(), name)))
+            for name in sorted(files):
+                source = pathlib.Path(root) / name
+                # the workers get the content of linked files
+                name = str(source.relative_to(path))
+                info = _reset(tar.gettarinfo(source.resolve(), name))
+                with open(source, "rb") as f:
+                    tar.addfile(info, f)
+    digest = hashlib.sha256()
+    fileobj.seek(0)
+    for chunk in iter(lambda: fileobj.read(storage.CHUNK_SIZE), b""):
+        digest.update(chunk)
+    fileobj.seek(0)
+    return fileobj, digest.hexdigest()
+
+
+def publish(templates, store=None):
+    """Upload a bundle of every template which has none yet.
+
+    The hash of the bundle is stored as `bundle` in the template, templates
+    unchanged since the last update keep theirs. A bundle which is in the
+    store already is not uploaded again.
+    """
+    store = store or storage.get_store()
+    for template in templates:
+        if template.get("bundle"):
+            continue
+        fileobj, digest = pack(template["path"])
+        with fileobj:
+            if store.stat(bundle_key(digest)) is None:
+                logger.info(f"publish bundle {digest} of {template['name']}")
+                store.put(bundle_key(digest), fileobj)
+        template["bundle"] = digest
+
+
+def fetch(digest, store=None):
+    """The local folder of a bundle, downloaded and unpacked if needed"""
+    base = pathlib.Path(CACHE_DIR)
+    target = base / digest
+    if target.is_dir():
+        # the mtime of the folder is the last use
+        os.utime(target)
+        return target
+    store = store or storage.get_store()
+    base.mkdir(parents=True, exist_ok=True)
+    temp = pathlib.Path(tempfile.mkdtemp(prefix=f".{digest}.", dir=base))
+    try:
+        with tempfile.TemporaryFile(dir=base) as archive:
+            hashed = hashlib.sha256()
+            with contextlib.closing(store.open(bundle_key(digest))) as src:
+                for chunk in iter(lambda: src.read(storage.CHUNK_SIZE), b""):
+                    hashed.update(chunk)
+                    archive.write(chunk)
+            if hashed.hexdigest() != digest:
+                raise BundleError(f"bundle {digest} is corrupt")
+            archive.seek(0)
+            with tarfile.open(fileobj=archive) as tar:
+                if hasattr(tarfile, "data_filter"):
+                    tar.extractall(temp, filter="data")
+                else:
+                    tar.extractall(temp)
+        try:
+            os.rename(temp, target)
+        except OSError:
+            # unpacked by another worker in the meantime
+            shutil.rmtree(temp, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(temp, ignore_errors=True)
+        raise
+    logger.info(f"fetched bundle {digest}")
+    evict(keep=digest)
+    return target
+
+
+def _size(path):
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+def evict(keep=None, size=None):
+    """Remove the least recently used bundles above the size of the cache"""
+    size = CACHE_SIZE if size is None else size
+    base = pathlib.Path(CACHE_DIR)
+    bundles = sorted(
+        (p for p in base.iterdir() if p.is_dir() and not p.name.startswith(".")),
+        key=lambda p: p.stat().st_mtime,
+        reverse=True,
+    )
+    total = 0
+    for path in bundles:
+        used = _size(path)
+        recent = time.time() - path.stat().st_mtime < MIN_AGE
+        if total + used <= size or path.name == keep or recent:
+            total += used
+            continue
+        logger.info(f"remove bundle {path.name}")
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def localize(template):
+    """The template with a `path` on this machine.
+
+    The snapshot is used if it is there (the server and workers sharing the
+    disk), otherwise the bundle of the template is fetched.
+    """
+    if os.path.isdir(template["path"]) or not template.get("bundle"):
+        return template
+    return dict(template, path=str(fetch(template["bundle"])))
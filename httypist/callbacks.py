@@ -0,0 +1,118 @@
+import logging
+import os
+import threading
+import uuid
+import requests
+import requests.adapters
+from rq import Queue, Retry
+
+from . import storage
+
+logger = logging.getLogger(__name__)
+
+CALLBACK_QUEUE = os.getenv("HTTYPIST_CALLBACK_QUEUE", "callbacks")
+CALLBACK_RETRIES = int(os.getenv("HTTYPIST_CALLBACK_RETRIES", 5))
+CALLBACK_BACKOFF = float(os.getenv("HTTYPIST_CALLBACK_BACKOFF", 10))
+CALLBACK_TIMEOUT = float(os.getenv("HTTYPIST_CALLBACK_TIMEOUT", 60))
+POOL_SIZE = int(os.getenv("HTTYPIST_CALLBACK_POOL_SIZE", 10))
+CHUNK_SIZE = 64 * 1024
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class CallbackError(Exception):
+    pass
+
+
+def get_session():
+    """One session per process, so connections to a host are reused"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE
+            )
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+
+class MultipartStream(object):
+    """multipart/form-data body read from the artifact store while it is sent.
+
+    The length is known upfront, so requests sends a Content-Length instead
+    of a chunked body.
+    """
+
+    def __init__(self, files, store=None):
+        self.store = store or storage.get_store()
+        self.files = [(name, self._stat(key)) for name, key in files]
+        self.boundary = uuid.uuid4().hex
+
+    def _stat(self, key):
+        artifact = self.store.stat(key)
+        if artifact is None:
+            raise CallbackError(f"artifact {key} not found")
+        return artifact
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def _header(self, name, artifact):
+        filename = artifact.name.replace('"', "%22")
+        return (
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            "\r\n"
+        ).encode()
+
+    @property
+    def _footer(self):
+        return f"--{self.boundary}--\r\n".encode()
+
+    def __len__(self):
+        length = len(self._footer)
+        for name, artifact in self.files:
+            length += len(self._header(name, artifact)) + artifact.size + 2
+        return length
+
+    def __iter__(self):
+        for name, artifact in self.files:
+            yield self._header(name, artifact)
+            yield from storage.iter_chunks(artifact.open(), CHUNK_SIZE)
+            yield b"\r\n"
+        yield self._footer
+
+
+def deliver(callback):
+    """Send a prepared callback, failures raise so rq retries the job"""
+    logger.info(f"processing callback {callback['name']} {callback['url']}")
+    headers = dict(callback["headers"])
+    body = None
+    if callback["files"]:
+        body = MultipartStream(callback["files"])
+        headers["Content-Type"] = body.content_type
+    result = get_session().request(
+        callback["method"],
+        callback["url"],
+        data=body,
+        headers=headers,
+        timeout=CALLBACK_TIMEOUT,
+    )
+    logger.info(f"callback result {result.status_code}")
+    logger.info(f"result callback {result.content}")
+    if result.status_code >= 500:
+        raise CallbackError(f"callback {callback['name']} failed: {result.status_code}")
+    return result.status_code
+
+
+def enqueue(callback, connection):
+    retry = Retry(
+        max=CALLBACK_RETRIES,
+        interval=[CALLBACK_BACKOFF * 2 ** i for i in range(CALLBACK_RETRIES)],
+    )
+    queue = Queue(CALLBACK_QUEUE, connection=connection)
+    return queue.enqueue(deliver, callback, retry=retry)
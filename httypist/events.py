@@ -0,0 +1,117 @@
+import asyncio
+import collections
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "httypist:events"
+FINAL_STATES = ("finished", "failed", "stopped", "canceled")
+MAX_WAIT = float(os.getenv("HTTYPIST_MAX_WAIT", 60))
+KEEPALIVE = float(os.getenv("HTTYPIST_EVENT_KEEPALIVE", 15))
+
+
+def publish(connection, jobid, state, **info):
+    """Tell all servers about a change of a job"""
+    event = dict(job=jobid, state=state, time=time.time(), **info)
+    connection.publish(CHANNEL, json.dumps(event))
+    return event
+
+
+def progress(job, **info):
+    """Store the progress of a running job in its meta and publish it"""
+    job.meta["progress"] = info
+    job.save_meta()
+    publish(job.connection, job.id, "progress", progress=info)
+
+
+class NotifyingMixin(object):
+    """Worker publishing the start and the end of every job.
+
+    The events are sent after rq has stored the new state of the job, so a
+    client reacting to them finds the result.
+    """
+
+    def prepare_job_execution(self, job, *args, **kwargs):
+        result = super().prepare_job_execution(job, *args, **kwargs)
+        publish(self.connection, job.id, "started")
+        return result
+
+    def handle_job_success(self, job, *args, **kwargs):
+        result = super().handle_job_success(job, *args, **kwargs)
+        publish(self.connection, job.id, "finished")
+        return result
+
+    def handle_job_failure(self, job, *args, **kwargs):
+        result = super().handle_job_failure(job, *args, **kwargs)
+        publish(self.connection, job.id, "failed")
+        return result
+
+
+class Hub(object):
+    """Fan out the published events to the waiting requests of this process.
+
+    A single thread subscribes to the channel, the requests waiting for a job
+    get the events of that job through an asyncio queue.
+    """
+
+    def __init__(self):
+        self.waiters = collections.defaultdict(set)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.ready = threading.Event()
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive() and self.ready.is_set()
+
+    def start(self, connection, timeout=1):
+        """Start the subscription thread and wait until it has subscribed"""
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.ready.clear()
+                self.thread = threading.Thread(
+                    target=self.run, args=(connection,), daemon=True, name="event-hub"
+                )
+                self.thread.start()
+        self.ready.wait(timeout)
+
+    def run(self, connection):
+        while True:
+            try:
+                pubsub = connection.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CHANNEL)
+                self.ready.set()
+                for message in pubsub.listen():
+                    self.dispatch(json.loads(message["data"]))
+            except Exception:
+                self.ready.clear()
+                logger.exception("event subscription failed")
+                time.sleep(1)
+
+    def dispatch(self, event):
+        with self.lock:
+            waiters = list(self.waiters.get(event["job"], ()))
+        for loop, queue in waiters:
+            loop.call_soon_threadsafe(queue.put_nowait, event)
+
+    @contextlib.asynccontextmanager
+    async def subscribe(self, connection, jobid):
+        """An asyncio queue receiving the events of a job"""
+        loop = asyncio.get_running_loop()
+        if not self.running():
+            # usually started with the server, never wait on the event loop
+            await loop.run_in_executor(None, self.start, connection)
+        waiter = (loop, asyncio.Queue())
+        with self.lock:
+            self.waiters[jobid].add(waiter)
+        try:
+            yield waiter[1]
+        finally:
+            with self.lock:
+                self.waiters[jobid].discard(waiter)
+                if not self.waiters[jobid]:
+                    del self.waiters[jobid]
@@ -0,0 +1,191 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import tempfile
+import uuid
+
+from starlette.formparsers import MultiPartParser
+
+from . import storage
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_SIZE = int(os.getenv("HTTYPIST_MAX_BODY_SIZE", 100 * 1024 * 1024))
+INLINE_SIZE = int(os.getenv("HTTYPIST_INLINE_BODY_SIZE", 64 * 1024))
+SPOOL_SIZE = 1024 * 1024
+
+_UNSET = object()
+
+
+class PayloadTooLarge(Exception):
+    pass
+
+
+def safe_filename(filename, default):
+    """The name of an uploaded file without any directories"""
+    name = pathlib.PurePosixPath((filename or "").replace("\\", "/")).name
+    return name if name not in ("", ".", "..") else default
+
+
+def parse_json(body):
+    try:
+        return json.loads(body)
+    except ValueError:
+        return None
+
+
+class Payload(object):
+    """The data of a request, read without keeping the body in memory.
+
+    The body is spooled to a temporary file, uploaded files of a multipart
+    request are kept as files and the json is only parsed when it is used.
+    """
+
+    def __init__(self, headers, query, client):
+        self.headers = headers
+        self.query = query
+        self.client = client
+        self.body = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+        self.size = 0
+        self.length = 0
+        self.digest = hashlib.sha256()
+        self.form = {}
+        self.uploads = []
+        self._json = _UNSET
+
+    def _count(self, size):
+        # size counts everything received, length only the spooled body
+        self.size += size
+        if self.size > MAX_BODY_SIZE:
+            raise PayloadTooLarge(f"request body exceeds {MAX_BODY_SIZE} bytes")
+
+    def write(self, chunk):
+        self._count(len(chunk))
+        self.length += len(chunk)
+        self.digest.update(chunk)
+        self.body.write(chunk)
+
+    async def _limited(self, stream):
+        async for chunk in stream:
+            self._count(len(chunk))
+            yield chunk
+
+    async def read(self, request):
+        """Consume the body of a starlette request"""
+        length = request.headers.get("content-length")
+        if length is not None and length.isdigit():
+            self._count(int(length))
+            self.size = 0
+        content_type = request.headers.get("content-type", "")
+        if content_type.startswith("multipart/form-data"):
+            parser = MultiPartParser(request.headers, self._limited(request.stream()))
+            form = await parser.parse()
+            for name, value in form.multi_items():
+                if isinstance(value, str):
+                    self.form[name] = value
+                else:
+                    self.uploads.append((name, value))
+            return
+        async for chunk in request.stream():
+            self.write(chunk)
+
+    def read_body(self):
+        self.body.seek(0)
+        return self.body.read()
+
+    @property
+    def json(self):
+        if self._json is _UNSET:
+            self._json = parse_json(self.read_body()) if self.length else None
+        return self._json
+
+    def data(self):
+        """The request data for the selectors and the result cache.
+
+        Large bodies are only available as json, `body` is empty for them.
+        """
+        return dict(
+            body=self.read_body() if self.length <= INLINE_SIZE else b"",
+            digest=self.digest.hexdigest(),
+            json=self.json,
+            headers=self.headers,
+            query=self.query,
+            client=self.client,
+            form=self.form,
+            files=self.describe_uploads(),
+        )
+
+    def describe_uploads(self):
+        files = []
+        for i, (name, upload) in enumerate(self.uploads):
+            upload.file.seek(0)
+            digest = hashlib.sha256()
+            size = 0
+            for chunk in iter(lambda: upload.file.read(storage.CHUNK_SIZE), b""):
+                digest.update(chunk)
+                size += len(chunk)
+            files.append(
+                dict(
+                    name=name,
+                    filename=safe_filename(upload.filename, f"upload{i}"),
+                    content_type=upload.content_type,
+                    size=size,
+                    digest=digest.hexdigest(),
+                )
+            )
+        return files
+
+    def job_data(self):
+        """The data passed to the jobs.
+
+        The body is inlined if it is small, otherwise it is uploaded to the
+        store like the files of a multipart request and only the key is
+        passed. The json is parsed by the worker.
+        """
+        store = storage.get_store()
+        prefix = f"uploads/{uuid.uuid4().hex}"
+        data = dict(
+            body=b"",
+            digest=self.digest.hexdigest(),
+            headers=self.headers,
+            query=self.query,
+            client=self.client,
+            form=self.form,
+            files=[],
+        )
+        if self.length <= INLINE_SIZE:
+            data["body"] = self.read_body()
+        else:
+            self.body.seek(0)
+            store.put(f"{prefix}/body", self.body)
+            data["body_ref"] = f"{prefix}/body"
+            logger.info(f"stored body of {self.length} bytes as {prefix}/body")
+        for i, (description, (_, upload)) in enumerate(
+            zip(self.describe_uploads(), self.uploads)
+        ):
+            upload.file.seek(0)
+            description["key"] = f"{prefix}/files/{i}"
+            store.put(description["key"], upload.file)
+            data["files"].append(description)
+        return data
+
+    def close(self):
+        self.body.close()
+        for _, upload in self.uploads:
+            upload.file.close()
+
+
+def resolve(data):
+    """Load a body stored by the server and parse the json, done once per job"""
+    if "json" in data:
+        return data
+    data = dict(data)
+    key = data.pop("body_ref", None)
+    if key is not None:
+        with contextlib.closing(storage.get_store().open(key)) as f:
+            data["body"] = f.read()
+    data["json"] = parse_json(data["body"]) if data["body"] else None
+    return data
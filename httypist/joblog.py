@@ -0,0 +1,128 @@
+import collections
+import logging
+import os
+import tempfile
+import threading
+
+from . import events
+
+MEMORY_SIZE = int(os.getenv("HTTYPIST_LOG_MEMORY", 256 * 1024))
+MAX_SIZE = int(os.getenv("HTTYPIST_LOG_MAX_SIZE", 10 * 1024 * 1024))
+TAIL_LINES = int(os.getenv("HTTYPIST_LOG_TAIL_LINES", 1000))
+TAIL_TTL = 24 * 60 * 60
+FLUSH_LINES = 100
+FLUSH_SECONDS = 1.0
+FORMAT = "%(asctime)s %(levelname)s %(message)s"
+
+
+def tail_key(jobid):
+    return f"httypist:log:{jobid}"
+
+
+class JobLog(logging.Handler):
+    """The log of one job.
+
+    The job gets its own logger (a child of `parent`, not registered with
+    logging, so it is freed with the job) with this handler as the only one.
+    The lines are kept in memory up to MEMORY_SIZE bytes, then spilled to a
+    temporary file, at most MAX_SIZE bytes are kept, after that only the
+    last TAIL_LINES lines. With a job the lines are also pushed to redis in
+    batches, at the latest FLUSH_SECONDS after they were logged, and a `log`
+    event is published, so the log of a running job can be followed.
+    """
+
+    def __init__(self, parent, job=None):
+        super().__init__()
+        self.setFormatter(logging.Formatter(FORMAT))
+        self.logger = logging.Logger(parent.name + ".job")
+        self.logger.parent = parent
+        # captured whatever the level of the worker output is
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(self)
+        self.job = job
+        self.file = tempfile.SpooledTemporaryFile(MEMORY_SIZE)
+        self.size = 0
+        self.dropped = 0
+        self.tail = collections.deque(maxlen=TAIL_LINES)
+        self.pending = []
+        self.timer = None
+        self.lines_lock = threading.Lock()
+
+    def emit(self, record):
+        try:
+            line = (self.format(record) + "\n").encode("utf-8", "replace")
+        except Exception:
+            self.handleError(record)
+            return
+        with self.lines_lock:
+            self.tail.append(line)
+            if self.size + len(line) <= MAX_SIZE:
+                self.file.write(line)
+                self.size += len(line)
+            else:
+                self.dropped += 1
+            if self.job is None:
+                return
+            self.pending.append(line)
+            if len(self.pending) >= FLUSH_LINES:
+                self.push()
+            elif self.timer is None:
+                # the next lines may come much later, e.g. after a latex run
+                self.timer = threading.Timer(FLUSH_SECONDS, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def push(self):
+        """Send the pending lines to redis"""
+        pending, self.pending = self.pending, []
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not pending:
+            return
+        key = tail_key(self.job.id)
+        try:
+            pipe = self.job.connection.pipeline(transaction=False)
+            pipe.rpush(key, *pending)
+            pipe.ltrim(key, -TAIL_LINES, -1)
+            pipe.incrby(f"{key}:count", len(pending))
+            pipe.expire(key, TAIL_TTL)
+            pipe.expire(f"{key}:count", TAIL_TTL)
+            pipe.execute()
+            events.publish(self.job.connection, self.job.id, "log", lines=len(pending))
+        except Exception:
+            # following the log is a convenience, the job goes on without it
+            pass
+
+    def flush(self):
+        with self.lines_lock:
+            self.push()
+
+    def getvalue(self):
+        """The complete log, the last lines only if it was too large"""
+        with self.lines_lock:
+            self.file.seek(0)
+            value = self.file.read()
+            self.file.seek(0, os.SEEK_END)
+            if self.dropped:
+                value += f"... {self.dropped} lines dropped, the last lines:\n".encode()
+                value += b"".join(self.tail)
+        return value
+
+    def close(self):
+        self.flush()
+        self.logger.removeHandler(self)
+        self.file.close()
+        super().close()
+
+
+def read_tail(connection, jobid, seen=0):
+    """The lines of a running job after the first `seen` ones and the new
+    number of lines seen. Lines dropped from the tail in redis are skipped."""
+    key = tail_key(jobid)
+    count = int(connection.get(f"{key}:count") or 0)
+    new = count - seen
+    if new <= 0:
+        return [], seen
+    lines = connection.lrange(key, -min(new, TAIL_LINES), -1)
+    return lines, count
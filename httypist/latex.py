@@ -0,0 +1,199 @@
+import contextlib
+import logging
+import os
+import pathlib
+import shutil
+import subprocess
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from . import bundles
+from . import metrics
+from . import repo
+from . import workspace
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.getenv(
+    "HTTYPIST_LATEX_CACHE", os.path.join(tempfile.gettempdir(), "httypist-latex")
+)
+FORMAT_TIMEOUT = int(os.getenv("HTTYPIST_LATEX_FORMAT_TIMEOUT", 600))
+# files written by latex and read again by the next run
+AUX_SUFFIXES = (
+    ".aux", ".toc", ".lof", ".lot", ".out", ".bbl", ".bcf", ".nav", ".snm", ".run.xml"
+)
+
+
+def get_options(config):
+    """The `latex` options of a template or None.
+
+    `engine` (default pdflatex) builds the precompiled `format` (a file of
+    the template, its preamble is dumped with mylatexformat), `cache` (default
+    true) keeps the aux files of the last job for the next one.
+    """
+    options = config.get("latex")
+    if not options:
+        return None
+    if not isinstance(options, dict):
+        options = {}
+    return dict(
+        engine=options.get("engine", "pdflatex"),
+        format=options.get("format"),
+        cache=options.get("cache", True),
+    )
+
+
+def cache_dir(template):
+    """The build cache of a template version, None if there is no commit"""
+    if not template.get("commit"):
+        return None
+    return pathlib.Path(CACHE_DIR) / template["name"] / template["commit"]
+
+
+def environment():
+    """Environment of the post processing, generated fonts and font name
+    databases are kept between the jobs"""
+    return dict(os.environ, TEXMFVAR=os.path.join(CACHE_DIR, "texmf-var"))
+
+
+@contextlib.contextmanager
+def _locked(path):
+    """Serialize the builds of all worker processes of this machine"""
+    with open(path.with_suffix(".lock"), "w") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def ensure_format(template, options=None):
+    """The path of the precompiled preamble of a template, built if needed.
+
+    Returns None if the template has no format or it can not be built, the
+    documents are compiled without it then.
+    """
+    options = options or get_options(template["config"])
+    if not options or not options["format"]:
+        return None
+    directory = cache_dir(template)
+    if directory is None:
+        return None
+    name = pathlib.PurePath(options["format"]).stem
+    target = directory / f"{name}.fmt"
+    failed = directory / f"{name}.failed"
+    if target.exists():
+        return target
+    directory.mkdir(parents=True, exist_ok=True)
+    with _locked(target):
+        if target.exists() or failed.exists():
+            return target if target.exists() else None
+        engine = options["engine"]
+        with tempfile.TemporaryDirectory(dir=directory) as build:
+            arguments = [
+                engine,
+                "-ini",
+                f"-jobname={name}",
+                f"-output-directory={build}",
+                "-interaction=batchmode",
+                "-halt-on-error",
+                f"&{engine}",
+                "mylatexformat.ltx",
+                options["format"],
+            ]
+            logger.info(f"building format {name} of {template['name']}")
+            with metrics.timer("latex_format_seconds", template=template["name"]):
+                try:
+                    result = subprocess.run(
+                        arguments,
+                        cwd=template["path"],
+                        capture_output=True,
+                        timeout=FORMAT_TIMEOUT,
+                    )
+                except (OSError, subprocess.TimeoutExpired):
+                    # not the fault of the template, tried again by the next job
+                    logger.exception(f"building format {name} failed")
+                    return None
+            built = pathlib.Path(build) / f"{name}.fmt"
+            if result.returncode != 0 or not built.exists():
+                logger.error(f"building format {name} failed: {result.stdout[-2000:]}")
+                failed.touch()
+                return None
+            os.replace(built, target)
+    return target
+
+
+def build_formats(templates):
+    """Build the formats of new template versions, enqueued after an update.
+
+    The build caches of older versions are removed like the snapshots of the
+    repository, queued jobs of a version still having a snapshot use them.
+    """
+    for template in templates:
+        template = bundles.localize(template)
+        current = cache_dir(template)
+        if current is None:
+            continue
+        cleanup(current)
+        ensure_format(template)
+
+
+def cleanup(current):
+    """Remove the caches of the versions without snapshot beyond the newest
+    HTTYPIST_SNAPSHOT_KEEP"""
+    versions = sorted(
+        (p for p in current.parent.iterdir() if p.is_dir() and p != current),
+        key=lambda p: p.stat().st_mtime,
+        reverse=True,
+    )
+    snapshots = pathlib.Path(repo.SNAPSHOT_DIR)
+    for directory in versions[repo.SNAPSHOT_KEEP - 1:]:
+        if not (snapshots / directory.name).is_dir():
+            logger.info(f"remove build cache {directory}")
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def enqueue_formats(queue, templates):
+    templates = [
+        t for t in templates if (get_options(t["config"]) or {}).get("format")
+    ]
+    if templates:
+        return queue.enqueue(build_formats, templates)
+
+
+def restore(template, tempdir, options):
+    """Put the format and the aux files of the last job into the workspace.
+
+    Returns the restored aux files, they hold data of another request and
+    are removed again unless the job rewrote them.
+    """
+    fmt = ensure_format(template, options)
+    if fmt is not None:
+        workspace.link_or_copy(fmt, tempdir / fmt.name)
+    directory = cache_dir(template)
+    if not options["cache"] or directory is None or not (directory / "aux").is_dir():
+        return []
+    restored = []
+    for path in (directory / "aux").iterdir():
+        if path.name.startswith("."):
+            continue
+        # copied, latex writes these files in place
+        shutil.copyfile(path, tempdir / path.name)
+        restored.append(tempdir / path.name)
+    return restored
+
+
+def save(template, tempdir, options):
+    """Keep the aux files of a successful job for the next one"""
+    directory = cache_dir(template)
+    if not options["cache"] or directory is None:
+        return
+    target = directory / "aux"
+    target.mkdir(parents=True, exist_ok=True)
+    for path in tempdir.iterdir():
+        if path.is_file() and path.name.endswith(AUX_SUFFIXES):
+            temp = target / f".{path.name}.{os.getpid()}"
+            shutil.copyfile(path, temp)
+            os.replace(temp, target / path.name)
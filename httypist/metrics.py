@@ -0,0 +1,174 @@
+import collections
+import contextlib
+import json
+import threading
+import time
+
+PREFIX = "httypist_"
+REDIS_KEY = "httypist:metrics"
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+_lock = threading.Lock()
+
+
+class Histogram(object):
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+
+    def add(self, other):
+        self.count += other.count
+        self.sum += other.sum
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+
+counters = collections.defaultdict(float)
+histograms = collections.defaultdict(Histogram)
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    with _lock:
+        counters[_key(name, labels)] += value
+
+
+def observe(name, seconds, **labels):
+    with _lock:
+        histograms[_key(name, labels)].observe(seconds)
+
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def reset():
+    with _lock:
+        counters.clear()
+        histograms.clear()
+
+
+def flush(connection):
+    """Add the metrics of this process to the ones in redis and reset them.
+
+    Used by the workers, so the server can export the metrics of all of them.
+    """
+    with _lock:
+        pending_counters = dict(counters)
+        pending_histograms = dict(histograms)
+        counters.clear()
+        histograms.clear()
+    pipe = connection.pipeline(transaction=False)
+    for (name, labels), value in pending_counters.items():
+        pipe.hincrbyfloat(REDIS_KEY, json.dumps(["c", name, labels]), value)
+    for (name, labels), histogram in pending_histograms.items():
+        field = json.dumps(["h", name, labels])
+        pipe.hincrbyfloat(REDIS_KEY, field + "sum", histogram.sum)
+        pipe.hincrbyfloat(REDIS_KEY, field + "count", histogram.count)
+        for bound, count in zip(BUCKETS, histogram.buckets):
+            pipe.hincrbyfloat(REDIS_KEY, field + str(bound), count)
+    pipe.execute()
+
+
+def load(connection):
+    """Read the metrics flushed to redis as (counters, histograms)"""
+    shared_counters = {}
+    shared_histograms = collections.defaultdict(Histogram)
+    for field, value in connection.hgetall(REDIS_KEY).items():
+        field = field.decode()
+        end = field.rindex("]") + 1
+        kind, name, labels = json.loads(field[:end])
+        key = (name, tuple(tuple(label) for label in labels))
+        value = float(value)
+        if kind == "c":
+            shared_counters[key] = value
+            continue
+        histogram = shared_histograms[key]
+        suffix = field[end:]
+        if suffix == "sum":
+            histogram.sum = value
+        elif suffix == "count":
+            histogram.count = int(value)
+        else:
+            histogram.buckets[BUCKETS.index(float(suffix))] = int(value)
+    return shared_counters, dict(shared_histograms)
+
+
+def merge(*sources):
+    """Combine several (counters, histograms) into one"""
+    merged_counters = collections.defaultdict(float)
+    merged_histograms = collections.defaultdict(Histogram)
+    for source_counters, source_histograms in sources:
+        for key, value in source_counters.items():
+            merged_counters[key] += value
+        for key, histogram in source_histograms.items():
+            merged_histograms[key].add(histogram)
+    return dict(merged_counters), dict(merged_histograms)
+
+
+def hit_ratios(counters):
+    """Gauges with the hit ratio of counters with result="hit"/"miss" labels"""
+    totals = collections.defaultdict(lambda: [0.0, 0.0])
+    for (name, labels), value in counters.items():
+        labels = dict(labels)
+        result = labels.pop("result", None)
+        if result not in ("hit", "miss"):
+            continue
+        total = totals[_key(f"{name}_hit_ratio", labels)]
+        total[0] += value if result == "hit" else 0
+        total[1] += value
+    return {key: hits / count for key, (hits, count) in totals.items() if count}
+
+
+def _labels(labels, **extra):
+    labels = list(labels) + list(extra.items())
+    if not labels:
+        return ""
+    values = ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in labels
+    )
+    return "{" + values + "}"
+
+
+def render(counters, histograms, gauges=None):
+    """Format the metrics in the prometheus text format"""
+    lines = []
+    seen = set()
+
+    def describe(name, kind):
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# TYPE {PREFIX}{name} {kind}")
+
+    for (name, labels), value in sorted(counters.items()):
+        describe(f"{name}_total", "counter")
+        lines.append(f"{PREFIX}{name}_total{_labels(labels)} {value}")
+    for (name, labels), value in sorted((gauges or {}).items()):
+        describe(name, "gauge")
+        lines.append(f"{PREFIX}{name}{_labels(labels)} {value}")
+    for (name, labels), histogram in sorted(histograms.items()):
+        describe(name, "histogram")
+        for bound, count in zip(BUCKETS, histogram.buckets):
+            lines.append(f"{PREFIX}{name}_bucket{_labels(labels, le=bound)} {count}")
+        lines.append(
+            f"{PREFIX}{name}_bucket{_labels(labels, le='+Inf')} {histogram.count}"
+        )
+        lines.append(f"{PREFIX}{name}_sum{_labels(labels)} {histogram.sum}")
+        lines.append(f"{PREFIX}{name}_count{_labels(labels)} {histogram.count}")
+    return "\n".join(lines) + "\n"
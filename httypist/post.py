@@ -0,0 +1,154 @@
+import concurrent.futures
+import hashlib
+import os
+import pathlib
+import shlex
+import subprocess
+import time
+
+# the commands of all worker processes of a machine share its cpus
+MAX_PARALLELISM = int(os.getenv("HTTYPIST_MAX_POST_PARALLELISM", os.cpu_count() or 1))
+
+
+class Command(object):
+    """A post processing command for one rendered file.
+
+    Commands of a file run in the configured order unless `after` lists the
+    commands they depend on explicitly, either by name for commands of the
+    same file or as `file:name` for commands of another file.
+
+    With `passes` a command is run again (at most `passes` times) as long as
+    one of the files matching the `stable` patterns changes, e.g. the aux
+    files of latex.
+    """
+
+    def __init__(self, filename, name, spec, previous=None, timeout=None):
+        if isinstance(spec, str):
+            spec = dict(command=spec)
+        self.filename = filename
+        self.name = name
+        self.command = spec["command"]
+        self.timeout = spec.get("timeout", timeout)
+        if "after" in spec:
+            after = spec["after"]
+            if isinstance(after, str):
+                after = [after]
+            self.after = [a if ":" in a else f"{filename}:{a}" for a in after]
+        else:
+            self.after = [previous] if previous else []
+        self.passes = int(spec.get("passes", 1))
+        if self.passes < 1:
+            raise ValueError(f"{self.id}: passes has to be at least 1")
+        self.stable = spec.get("stable", [])
+        if isinstance(self.stable, str):
+            self.stable = [self.stable]
+        self.runs = 0
+        self.duration = None
+
+    @property
+    def id(self):
+        return f"{self.filename}:{self.name}"
+
+    @property
+    def arguments(self):
+        return list(shlex.shlex(self.command, punctuation_chars=True))
+
+    def digests(self, cwd):
+        return {
+            path.name: hashlib.sha256(path.read_bytes()).hexdigest()
+            for pattern in self.stable
+            for path in sorted(pathlib.Path(cwd).glob(pattern))
+        }
+
+    def run(self, cwd, env=None):
+        start = time.perf_counter()
+        try:
+            for _ in range(self.passes):
+                before = self.digests(cwd)
+                result = subprocess.run(
+                    self.arguments,
+                    cwd=cwd,
+                    check=True,
+                    capture_output=True,
+                    timeout=self.timeout,
+                    env=env,
+                )
+                self.runs += 1
+                if not self.stable or self.digests(cwd) == before:
+                    break
+            return result
+        finally:
+            self.duration = time.perf_counter() - start
+
+
+def get_parallelism(config):
+    """The commands of a job running at the same time, `post_parallelism`
+    (default 1) bounded by HTTYPIST_MAX_POST_PARALLELISM"""
+    return max(1, min(int(config.get("post_parallelism", 1)), MAX_PARALLELISM))
+
+
+def build_commands(files, config):
+    """Build the commands for the rendered files [(filename, ending)]"""
+    commands = []
+    for filename, ending in files:
+        try:
+            configured = config["post"][ending]["commands"]
+        except KeyError:
+            continue
+        previous = None
+        for name, spec in configured.items():
+            command = Command(
+                filename, name, spec, previous, config.get("post_timeout")
+            )
+            commands.append(command)
+            previous = command.id
+    return commands
+
+
+def run(commands, cwd, parallelism, logger, env=None):
+    """Run the commands respecting their dependencies.
+
+    Up to `parallelism` commands run at the same time. If a command fails,
+    the commands depending on it are skipped. Returns the failed and the
+    skipped commands.
+    """
+    pending = {c.id: c for c in commands}
+    for command in commands:
+        unknown = [a for a in command.after if a not in pending]
+        if unknown:
+            logger.warning(f"{command.id} depends on unknown commands {unknown}")
+            command.after = [a for a in command.after if a in pending]
+    done, failed, skipped = set(), [], []
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallelism) as executor:
+        while pending or running:
+            for command in list(pending.values()):
+                if any(a in failed or a in skipped for a in command.after):
+                    logger.warning(f"skipping {command.id}, a dependency failed")
+                    skipped.append(command.id)
+                    del pending[command.id]
+                elif all(a in done for a in command.after):
+                    logger.info(f"running {command.id}: {command.command}")
+                    running[executor.submit(command.run, cwd, env)] = command
+                    del pending[command.id]
+            if not running:
+                for command in pending.values():
+                    logger.error(f"skipping {command.id}, circular dependency")
+                    skipped.append(command.id)
+                break
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in finished:
+                command = running.pop(future)
+                try:
+                    output = future.result()
+                    logger.info(output)
+                    done.add(command.id)
+                except Exception:
+                    logger.exception(f"{command.id} failed")
+                    failed.append(command.id)
+                logger.info(
+                    f"{command.id} took {command.duration:.3f}s ({command.runs} passes)"
+                )
+    return failed, skipped
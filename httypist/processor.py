@@ -1,27 +1,58 @@
 import jinja2
-import shlex
 import tempfile
-import glob
 import zipfile
 import pathlib
-import requests
 import sys
 import os
 import tempfile
-import subprocess
 import importlib
 import shutil
 import pathlib
 import logging
 import io
+import collections
+import threading
+import uuid
+import time
+import contextlib
+import json
 from rq import get_current_job
 
+from . import archive
+from . import resultcache
+from . import post
+from . import callbacks
+from . import metrics
+from . import workspace
+from . import storage
+from . import ingest
+from . import events
+from . import latex
+from . import joblog
+from . import bundles
+
 
 import http.client as http_client
 http_client.HTTPConnection.debuglevel = 1
 
 logger = logging.getLogger(__name__)
 
+ENVIRONMENT_CACHE_SIZE = int(os.getenv("HTTYPIST_ENVIRONMENT_CACHE_SIZE", 64))
+WORK_DIR = os.getenv("HTTYPIST_WORK_DIR") or None
+BYTECODE_CACHE_DIR = os.getenv(
+    "HTTYPIST_BYTECODE_CACHE",
+    os.path.join(tempfile.gettempdir(), "httypist-bytecode"),
+)
+
+# limits of a single rendered file, 0 is unlimited, see `render` in config.yml
+RENDER_TIMEOUT = float(os.getenv("HTTYPIST_RENDER_TIMEOUT", 0))
+MAX_OUTPUT_SIZE = int(os.getenv("HTTYPIST_MAX_OUTPUT_SIZE", 0))
+WRITE_BUFFER = 256 * 1024
+
+_environments = collections.OrderedDict()
+_environments_lock = threading.Lock()
+_bytecode_cache = None
+
 
 def get_filename_infos(filename: pathlib.Path):
     return filename.stem, filename.suffixes[-2][1:]
@@ -31,6 +62,90 @@ def get_filetype_template_options(filetype, config):
     return config.get("filetypes", {}).get(filetype, {}).get("jinja", {})
 
 
+def get_bytecode_cache():
+    """The bytecode cache is shared by all environments of this process and
+    persisted on disk, so a fresh worker can skip the compilation as well."""
+    global _bytecode_cache
+    if _bytecode_cache is None and BYTECODE_CACHE_DIR:
+        os.makedirs(BYTECODE_CACHE_DIR, exist_ok=True)
+        _bytecode_cache = jinja2.FileSystemBytecodeCache(BYTECODE_CACHE_DIR)
+    return _bytecode_cache
+
+
+def get_environment(template, options=None):
+    """Return a cached jinja environment for the template and options.
+
+    Environments are kept in a bounded LRU keyed by the template, its commit
+    and the filetype options. The compiled templates inside an environment are
+    checked against the file mtime by jinja itself (auto_reload).
+    """
+    options = options or {}
+    key = (
+        template["name"],
+        str(template["path"]),
+        template.get("commit"),
+        repr(sorted(options.items())),
+    )
+    with _environments_lock:
+        env = _environments.get(key)
+        if env is not None:
+            _environments.move_to_end(key)
+            metrics.inc("environment_cache", result="hit")
+            return env
+        metrics.inc("environment_cache", result="miss")
+        loader = jinja2.FileSystemLoader(str(template["path"]), followlinks=True)
+        env = jinja2.Environment(
+            loader=loader,
+            bytecode_cache=get_bytecode_cache(),
+            auto_reload=True,
+            **options,
+        )
+        _environments[key] = env
+        while len(_environments) > ENVIRONMENT_CACHE_SIZE:
+            _environments.popitem(last=False)
+        return env
+
+
+def clear_environments():
+    with _environments_lock:
+        _environments.clear()
+
+
+class RenderLimitExceeded(Exception):
+    pass
+
+
+def get_render_limits(config):
+    """`timeout` in seconds and `max_size` in bytes of the `render` block"""
+    options = config.get("render") or {}
+    return (
+        float(options.get("timeout", RENDER_TIMEOUT)),
+        int(options.get("max_size", MAX_OUTPUT_SIZE)),
+    )
+
+
+def render_to(jinja_template, data, fileobj, limits=(0, 0), name=None):
+    """Render a template piece by piece into a binary file.
+
+    The limits are checked after every piece the template yields, so a loop
+    producing huge or endless output is stopped, a single slow expression is
+    only stopped by the job timeout.
+    """
+    timeout, max_size = limits
+    name = name or jinja_template.name
+    deadline = time.monotonic() + timeout if timeout else None
+    size = 0
+    for chunk in jinja_template.generate(**data):
+        chunk = chunk.encode()
+        size += len(chunk)
+        if max_size and size > max_size:
+            raise RenderLimitExceeded(f"{name} is larger than {max_size} bytes")
+        if deadline is not None and time.monotonic() > deadline:
+            raise RenderLimitExceeded(f"rendering {name} took longer than {timeout}s")
+        fileobj.write(chunk)
+    return size
+
+
 def process_string(string, data):
     try:
         env = jinja2.Environment()
@@ -39,31 +154,117 @@ def process_string(string, data):
         return "False"
 
 
+def can_render_sync(template):
+    """`sync: true` renders in the server, only without post processing and
+    callbacks"""
+    config = template["config"]
+    return bool(config.get("sync")) and "post" not in config and "callbacks" not in config
+
+
+def render_sync(template, data):
+    """Render the template files in memory and return the output files.
+
+    No workspace is created, the output files are returned as
+    {filename: bytes}, rendered files or static files of the template.
+    """
+    path = pathlib.Path(template["path"])
+    config = template["config"]
+    with metrics.timer("sync_render_seconds", template=template["name"]):
+        rendered = {}
+        limits = get_render_limits(config)
+        for f in sorted(path.glob("*.jinja")):
+            fname, ending = get_filename_infos(f)
+            env = get_environment(template, get_filetype_template_options(ending, config))
+            buffer = io.BytesIO()
+            render_to(env.get_template(f.name), data, buffer, limits)
+            rendered[fname] = buffer.getvalue()
+        files = {}
+        for name in config.get("output", {}).get("files") or sorted(rendered):
+            if name in rendered:
+                files[name] = rendered[name]
+            else:
+                files[name] = (path / name).read_bytes()
+    return files
+
+
 class Template(object):
-    def __init__(self, template, data):
-        self.template = template
-        self.data = data
-        self.logger = logging.getLogger(__name__)
-        self.logstream = io.StringIO()
-        self.logger.addHandler(logging.StreamHandler(self.logstream))
+    def __init__(self, template, data, job=None):
+        self.template = bundles.localize(template)
+        self.data = ingest.resolve(data)
+        self.job = job
+        self.timings = []
+        self.result_files = []
+        self.post_failed = []
+        self.store = storage.get_store()
+        self._id = str(uuid.uuid4())
+        self.joblog = joblog.JobLog(logger, job)
+        self.logger = self.joblog.logger
         self.logger.info("Template created")
 
     @property
     def name(self):
         return self.template["name"]
 
+    @property
+    def artifacts(self):
+        """Prefix of the artifacts of this job in the store"""
+        jobid = self.job.id if self.job is not None else self._id
+        return f"jobs/{jobid}"
+
+    def progress(self, **info):
+        """Tell the clients waiting for the job how far it got"""
+        if self.job is not None:
+            events.progress(self.job, **info)
+
+    @contextlib.contextmanager
+    def span(self, stage, report=True):
+        """Record the time spent in a stage of the job"""
+        if report:
+            self.progress(stage=stage)
+        start = time.time()
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - begin
+            self.timings.append(dict(stage=stage, start=start, duration=duration))
+            metrics.observe(
+                "job_stage_seconds", duration, template=self.name, stage=stage
+            )
+            self.logger.info(f"{stage} took {duration:.3f}s")
+
     def process(self):
-        self.prepare_files()
-        self.process_template_files()
-        self.post_processing()
-        self.pack_result()
-        self.do_callbacks()
+        with self.span("prepare_files"):
+            self.prepare_files()
+        with self.span("render"):
+            self.process_template_files()
+        with self.span("post"):
+            self.post_processing()
+            self.discard_restored()
+        with self.span("pack"):
+            self.pack_result()
+        with self.span("upload"):
+            self.upload_results()
+            if self.complete():
+                self.cache_result()
+        with self.span("callbacks"):
+            self.do_callbacks()
 
     def prepare_files(self):
         self.template_path = pathlib.Path(self.template["path"])
         self.separate_file_types()
         self.create_temp_folder()
         self.prepare_auxilary_files()
+        self.prepare_uploads()
+        self.latex = latex.get_options(self.template["config"])
+        self.restored = []
+        if self.latex is not None:
+            self.restored = latex.restore(self.template, self.tempdir, self.latex)
+        self.prepared = {
+            path: (path.stat().st_ino, path.stat().st_mtime_ns)
+            for path, _ in archive.iter_folder(self.tempdir)
+            if path.is_file()
+        }
 
     def separate_file_types(self):
         self.template_files = []
@@ -80,62 +281,96 @@ class Template(object):
                 self.auxilary_files.append(filepath)
 
     def create_temp_folder(self):
-        self._tempdir = tempfile.TemporaryDirectory(prefix=self.name)
-        self.tempdir = pathlib.Path(self._tempdir.name)
+        # the workspace is kept with the result, so temp.zip can be built
+        # later, when somebody actually asks for it
+        self.resultdir = pathlib.Path(
+            tempfile.mkdtemp(prefix=f"result_{self.name}_", dir=WORK_DIR)
+        )
+        self.tempdir = self.resultdir / "workspace"
+        self.tempdir.mkdir()
         self.logger.info(
             f"Created Temporary Directory {self.tempdir} {self.tempdir.is_dir()}"
         )
 
     def prepare_auxilary_files(self):
+        copy_function = workspace.get_copy_function(self.template["config"])
         for folder in self.folders:
             self.logger.info(f"copy {folder} to {self.tempdir}")
-            shutil.copytree(self.template_path / folder, self.tempdir / folder)
+            shutil.copytree(
+                self.template_path / folder,
+                self.tempdir / folder,
+                copy_function=copy_function,
+            )
         for file in self.auxilary_files:
             self.logger.info(f"copy {file} to {self.tempdir}")
-            shutil.copy(file, self.tempdir / file.relative_to(self.template_path))
+            copy_function(file, self.tempdir / file.relative_to(self.template_path))
+
+    def prepare_uploads(self):
+        """Put the files uploaded with a multipart request into the workspace"""
+        for upload in self.data.get("files", ()):
+            self.logger.info(f"download {upload['key']} to {upload['filename']}")
+            target = self.tempdir / upload["filename"]
+            # never write through a link into the snapshot
+            target.unlink(missing_ok=True)
+            with contextlib.closing(self.store.open(upload["key"])) as src:
+                with open(target, "wb") as dst:
+                    shutil.copyfileobj(src, dst, storage.CHUNK_SIZE)
 
     def process_template_files(self):
-        loader = jinja2.FileSystemLoader(str(self.template_path), followlinks=True)
         for f in self.template_files:
             self.logger.info(f"process {f}")
             fname, ending = get_filename_infos(f)
             options = get_filetype_template_options(ending, self.template["config"])
 
             # we might have a separate environment config per filetype
-            env = jinja2.Environment(loader=loader, **options)
+            env = get_environment(self.template, options)
             jinja_template = env.get_template(str(f.relative_to(self.template_path)))
-            with open(self.tempdir / fname, "w") as fout:
-                fout.write(jinja_template.render(**self.data))
+            # never write into a file shared with the repository snapshot
+            (self.tempdir / fname).unlink(missing_ok=True)
+            try:
+                with open(self.tempdir / fname, "wb", buffering=WRITE_BUFFER) as fout:
+                    size = render_to(
+                        jinja_template,
+                        self.data,
+                        fout,
+                        get_render_limits(self.template["config"]),
+                    )
+            except RenderLimitExceeded as e:
+                # fail the job with a clear message, the partial file is useless
+                (self.tempdir / fname).unlink(missing_ok=True)
+                self.logger.error(str(e))
+                metrics.inc("render_limit_exceeded", template=self.name)
+                raise
+            self.logger.info(f"rendered {fname} ({size} bytes)")
 
     def post_processing(self):
+        self.post_failed = []
         if not "post" in self.template["config"]:
             return
         self.logger.info(f"process post step")
-        output = "failed before calling process"
-        try:
-            for f in self.template_files:
-                self.logger.info(f"post_processing for {f}")
-                _, ending = get_filename_infos(f)
-                try:
-                    commands = self.template["config"]["post"][ending]["commands"]
-                    for name, command in commands.items():
-                        self.logger.info("running %s on %s: %s", name, f, command)
-                        command_list = list(
-                            shlex.shlex(command, punctuation_chars=True)
-                        )
-                        output = subprocess.run(
-                            command_list,
-                            cwd=self.tempdir,
-                            check=True,
-                            capture_output=True,
-                        )
-
-                except KeyError:
-                    continue
-        except:
-            logger.exception(output)
-        finally:
-            logger.info(output)
+        files = [get_filename_infos(f) for f in self.template_files]
+        commands = post.build_commands(files, self.template["config"])
+        failed, skipped = post.run(
+            commands,
+            self.tempdir,
+            post.get_parallelism(self.template["config"]),
+            self.logger,
+            latex.environment() if self.latex is not None else None,
+        )
+        self.post_failed = failed + skipped
+        if failed or skipped:
+            self.logger.error(f"post processing failed: {failed}, skipped: {skipped}")
+        elif self.latex is not None:
+            latex.save(self.template, self.tempdir, self.latex)
+
+    def discard_restored(self):
+        """Remove the aux files of the last job the post commands did not
+        rewrite, they must not be delivered with this job"""
+        for path in self.restored:
+            with contextlib.suppress(FileNotFoundError):
+                stat = path.stat()
+                if self.prepared.get(path) == (stat.st_ino, stat.st_mtime_ns):
+                    path.unlink()
 
     # This has been thought to offer the possiblity to run python transformations but I do not think this is a good idea
     # def execute_processing(self):
@@ -157,25 +392,78 @@ class Template(object):
 
     #     sys.path = original_pythonpath
 
+    @property
+    def output_files(self):
+        return self.template["config"].get("output", {}).get("files", [])
+
+    def process_records(self, records, offset=0):
+        """Render many records in one workspace.
+
+        The auxiliary files are prepared once, then every record is rendered
+        and post processed. The output files of a record are stored as
+        `records/<index>/` artifacts. A failing record does not stop the
+        others, a record whose post commands failed or which is missing an
+        output file counts as failed.
+        """
+        with self.span("prepare_files"):
+            self.prepare_files()
+        base = self.data
+        self.finished_records = []
+        self.failed_records = []
+        for index, record in enumerate(records, offset):
+            self.data = dict(base, json=record)
+            for f in self.output_files:
+                (self.tempdir / f).unlink(missing_ok=True)
+            try:
+                with self.span("render", report=False):
+                    self.process_template_files()
+                with self.span("post", report=False):
+                    self.post_processing()
+                with self.span("pack", report=False):
+                    collected = self.collect_record(index)
+                if self.post_failed or len(collected) < len(self.output_files):
+                    self.logger.error(f"record {index} is incomplete")
+                    self.failed_records.append(index)
+                else:
+                    self.finished_records.append(index)
+            except Exception:
+                self.logger.exception(f"record {index} failed")
+                self.failed_records.append(index)
+            if self.job is not None:
+                self.job.meta["done"] = len(self.finished_records)
+                self.job.meta["failed"] = len(self.failed_records)
+            self.progress(
+                records=len(records),
+                done=len(self.finished_records),
+                failed=len(self.failed_records),
+            )
+        self.data = base
+
+    def collect_record(self, index):
+        """Store the output files of a record, returns the stored ones"""
+        collected = []
+        for f in self.output_files:
+            file = self.tempdir / f
+            if not file.exists():
+                self.logger.warning(f"Expected output File {f}({file}) not found")
+                continue
+            self.store.put(f"{self.artifacts}/records/{index}/{f}", file)
+            file.unlink()
+            collected.append(f)
+        return collected
+
     def pack_result(self):
-        self.logger.info("Creating result dir")
-        self.resultdir = pathlib.Path(tempfile.mkdtemp(prefix="result_"))
-        self.logger.warning("Packing all files")
-        with zipfile.ZipFile(
-            self.resultdir / "temp.zip", "w", compression=zipfile.ZIP_LZMA
-        ) as zf:
-            for i in glob.iglob(str(self.tempdir / "**/*"), recursive=True):
-                path_in_zip = str(pathlib.Path(i).relative_to(self.tempdir))
-                zf.write(i, arcname=path_in_zip)
+        compression = archive.get_compression(self.template["config"])
         self.logger.warning("Packing defined result files")
         with zipfile.ZipFile(
-            self.resultdir / "result.zip", "w", compression=zipfile.ZIP_LZMA
+            self.resultdir / "result.zip", "w", compression=compression
         ) as zf:
             try:
                 for f in self.template["config"]["output"]["files"]:
                     try:
                         file = self.tempdir / f
                         zf.write(file, arcname=f)
+                        self.result_files.append(f)
                     except FileNotFoundError as e:
                         self.logger.warning(
                             f"Expected output File {f}({file}) not found (%s)", e
@@ -183,19 +471,92 @@ class Template(object):
             except KeyError:
                 self.logger.warning("not output files specified")
 
+    def generated_files(self):
+        """The files of the workspace created or changed by the job"""
+        for path, arcname in archive.iter_folder(self.tempdir):
+            if not path.is_file():
+                continue
+            stat = path.stat()
+            if self.prepared.get(path) != (stat.st_ino, stat.st_mtime_ns):
+                yield path, arcname
+
+    def workspace_files(self):
+        """The files of the workspace kept for temp.zip.
+
+        `output: workspace:` selects them: `all` (default) the complete
+        workspace, `generated` only the files created by the job or `none`.
+        """
+        keep = self.template["config"].get("output", {}).get("workspace", "all")
+        if keep == "all":
+            files = archive.iter_folder(self.tempdir)
+        elif keep == "generated":
+            files = self.generated_files()
+        else:
+            files = []
+        return [(path, arcname) for path, arcname in files if path.is_file()]
+
+    def upload_results(self):
+        """Move the results to the artifact store"""
+        self.store.put(f"{self.artifacts}/result.zip", self.resultdir / "result.zip")
+        for path, arcname in self.workspace_files():
+            self.store.put(f"{self.artifacts}/workspace/{arcname}", path)
+
+    def complete(self):
+        """All post commands ran and every output file is in result.zip"""
+        return not self.post_failed and all(
+            f in self.result_files for f in self.output_files
+        )
+
+    def cache_result(self):
+        options = resultcache.get_options(self.template)
+        if options is None:
+            return
+        cachekey = resultcache.key(self.template, self.data, options)
+        resultcache.store(self.template, cachekey, self.resultdir / "result.zip")
+
+    def pack_temp(self):
+        """Pack the kept workspace files (the same as the temp.zip route
+        streams), only done on demand"""
+        key = f"{self.artifacts}/temp.zip"
+        target = self.resultdir / "temp.zip"
+        if not target.exists():
+            self.logger.warning("Packing workspace files")
+            archive.write_zip(
+                target,
+                self.workspace_files(),
+                archive.get_compression(self.template["config"]),
+            )
+            self.store.put(key, target)
+        return key
+
+    def cleanup(self):
+        """Remove the local files, everything needed is in the store"""
+        if getattr(self, "resultdir", None) is not None:
+            shutil.rmtree(self.resultdir, ignore_errors=True)
+
+    def save_log(self):
+        """Upload the log and detach it from the logging"""
+        try:
+            self.store.put(f"{self.artifacts}/log.txt", io.BytesIO(self.joblog.getvalue()))
+        finally:
+            self.joblog.close()
+
     def do_callbacks(self):
+        """Prepare the callbacks and hand them to the callback queue.
+
+        Outside of a job (e.g. in tests) the callbacks are delivered directly.
+        """
         if "callbacks" not in self.template["config"]:
             return
         self.logger.error("preparing callback")
         try:
             for cbname, cb in self.template["config"]["callbacks"].items():
                 self.logger.info(f"processing callback {cbname}")
-                loader = jinja2.FileSystemLoader(self.template_path, followlinks=True)
-                env = jinja2.Environment(loader=loader)
+                env = get_environment(self.template)
                 self.logger.info(f'template url for callback {cb["template"]}')
                 url = env.from_string(cb["template"]).render(**self.data)
                 self.logger.info(f"url for callback {url}")
-                postfiles = {}
+                postfiles = []
                 headers = {"x-httypist-processed": "1"}
                 # todo jobid, ect.
                 if "headers" in cb:
@@ -205,47 +566,93 @@ class Template(object):
                 try:
                     self.logger.info(cb["data"])
                     for sendfile in cb["data"]:
-                        if "binary" not in sendfile or sendfile["binary"]:
-                            openbinary = "rb"
-                        else:
-                            openbinary = "r"
-
-                        postfiles[sendfile["name"]] = open(
-                            self.tempdir / sendfile["file"], openbinary
-                        )
+                        key = f"{self.artifacts}/callbacks/{sendfile['file']}"
+                        self.store.put(key, self.tempdir / sendfile["file"])
+                        postfiles.append((sendfile["name"], key))
                 except:
                     self.logger.exception("configuration error for callback files")
                 if "send_result" in cb and cb["send_result"]:
-                    postfiles['result'] = open(
-                        self.resultdir / "result.zip", "rb"
-                    )
+                    postfiles.append(("result", f"{self.artifacts}/result.zip"))
                 if "send_temp" in cb and cb["send_temp"]:
-                    postfiles['complete'] = open(
-                        self.resultdir / "temp.zip", "rb"
-                    )
-                if len(postfiles) == 0:
-                    postfiles = None
+                    postfiles.append(("complete", self.pack_temp()))
                 self.logger.info(f"sending files {postfiles}")
                 self.logger.info(f"method: {cb['method']}")
-                result = requests.request(
-                    cb["method"], url, files=postfiles, headers=headers
+                callback = dict(
+                    name=cbname,
+                    method=cb["method"],
+                    url=url,
+                    headers=headers,
+                    files=postfiles,
                 )
-                self.logger.info(f"callback result {result.status_code}")
-                self.logger.info(f"result callback {result.content}")
+                if self.job is None:
+                    callbacks.deliver(callback)
+                else:
+                    job = callbacks.enqueue(callback, self.job.connection)
+                    self.logger.info(f"callback queued as {job.id}")
         except KeyError:
             self.logger.warn("Insufficent Configuration for callback")
 
     @property
     def log(self):
-        return self.logstream.getvalue()
+        return self.joblog.getvalue().decode("utf-8", "replace")
 
 
 def process_template(template, data):
-    """ This function processes a template, using the data provided. """
-    t = Template(template, data)
-    t.job = get_current_job()
-    t.process()
-
-    result = dict(template=template, data=data, result_folder=t.resultdir, log=t.log)
-
-    return result
+    """ This function processes a template, using the data provided.
+
+    The files are moved to the artifact store, the result only holds the
+    information needed to find them.
+    """
+    t = Template(template, data, get_current_job())
+    start = time.perf_counter()
+    state = "failed"
+    try:
+        t.process()
+        state = "finished"
+    finally:
+        t.cleanup()
+        t.save_log()
+        metrics.observe("job_seconds", time.perf_counter() - start, template=t.name)
+        metrics.inc("jobs", template=t.name, state=state)
+        if t.job is not None:
+            metrics.flush(t.job.connection)
+
+    return dict(
+        template=t.name,
+        artifacts=t.artifacts,
+        files=t.result_files,
+        timings=t.timings,
+    )
+
+
+def process_batch(template, records, data, offset=0):
+    """Process a chunk of the records of a batch request.
+
+    `records` is the key of the chunk in the store (newline delimited json)
+    or a list. `data` holds the request information shared by all records,
+    the record itself is available as `json` in the templates.
+    """
+    if isinstance(records, str):
+        with contextlib.closing(storage.get_store().open(records)) as f:
+            records = [json.loads(line) for line in f]
+    t = Template(template, data, get_current_job())
+    start = time.perf_counter()
+    try:
+        t.process_records(records, offset)
+    finally:
+        t.cleanup()
+        t.save_log()
+        metrics.observe(
+            "batch_seconds", time.perf_counter() - start, template=t.name
+        )
+        metrics.inc("batch_records", len(records), template=t.name)
+        if t.job is not None:
+            metrics.flush(t.job.connection)
+
+    return dict(
+        template=t.name,
+        artifacts=t.artifacts,
+        records=t.finished_records,
+        failed=t.failed_records,
+        timings=t.timings,
+    )
@@ -0,0 +1,140 @@
+import datetime
+import logging
+import os
+import random
+import time
+
+from rq import Queue
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUEUE = "process"
+PRIORITIES = ("high", "normal", "low")
+CONCURRENCY_RETRY = float(os.getenv("HTTYPIST_CONCURRENCY_RETRY", 1))
+DEFAULT_LEASE = 24 * 60 * 60
+
+# drop expired leases, then take a slot if one is free (or already held)
+ACQUIRE = """
+redis.call('zremrangebyscore', KEYS[1], '-inf', ARGV[1])
+if redis.call('zscore', KEYS[1], ARGV[3]) or
+   redis.call('zcard', KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call('zadd', KEYS[1], ARGV[4], ARGV[3])
+    redis.call('expireat', KEYS[1], math.ceil(tonumber(ARGV[4])))
+    return 1
+end
+return 0
+"""
+
+
+def queue_name(name, priority="normal"):
+    """The redis queue of a priority, `fast`, `fast.high` or `fast.low`"""
+    if priority not in PRIORITIES:
+        raise ValueError(f"unknown priority {priority}")
+    return name if priority == "normal" else f"{name}.{priority}"
+
+
+def get_queue_name(template, priority=None):
+    """The queue for jobs of a template, from `queue` and `priority` in config.yml"""
+    config = template["config"]
+    return queue_name(
+        config.get("queue", DEFAULT_QUEUE), priority or config.get("priority", "normal")
+    )
+
+
+def get_queue(template, connection, priority=None):
+    return Queue(get_queue_name(template, priority), connection=connection)
+
+
+def parse_weights(args):
+    """Read worker arguments like `fast:3 process` as {name: weight}"""
+    weights = {}
+    for arg in args:
+        name, _, weight = arg.partition(":")
+        weights[name] = float(weight) if weight else 1.0
+        if weights[name] <= 0:
+            raise ValueError(f"the weight of {name} has to be positive")
+    return weights
+
+
+def expand(weights):
+    """All queue names a worker listens to, every priority of every queue"""
+    return [queue_name(name, p) for p in PRIORITIES for name in weights]
+
+
+def weighted_order(weights):
+    """The order in which a worker checks its queues for the next job.
+
+    All high priority queues come first, then the normal and the low ones.
+    Within a priority the queues are ordered randomly, a queue with a higher
+    weight is more likely to be checked first.
+    """
+    remaining = list(weights)
+    names = []
+    while remaining:
+        name = random.choices(remaining, [weights[n] for n in remaining])[0]
+        remaining.remove(name)
+        names.append(name)
+    return [queue_name(name, p) for p in PRIORITIES for name in names]
+
+
+def get_concurrency(template):
+    limit = template.get("config", {}).get("concurrency")
+    return int(limit) if limit else None
+
+
+def _key(template):
+    return f"httypist:running:{template['name']}"
+
+
+def acquire(connection, template, jobid, lease=DEFAULT_LEASE):
+    """Take one of the `concurrency` slots of a template for a job.
+
+    The slots are shared by all workers. A slot is held at most `lease`
+    seconds, so slots of crashed workers are freed eventually.
+    """
+    limit = get_concurrency(template)
+    if limit is None:
+        return True
+    now = time.time()
+    script = connection.register_script(ACQUIRE)
+    return bool(script(keys=[_key(template)], args=[now, limit, jobid, now + lease]))
+
+
+def release(connection, template, jobid):
+    if get_concurrency(template) is not None:
+        connection.zrem(_key(template), jobid)
+
+
+class WeightedMixin(object):
+    """Worker listening to weighted queues, honoring the concurrency limits"""
+
+    weights = None
+
+    def reorder_queues(self, reference_queue=None):
+        if not self.weights:
+            return
+        queues = {q.name: q for q in self.queues}
+        self._ordered_queues = [queues[n] for n in weighted_order(self.weights)]
+
+    def execute_job(self, job, queue):
+        template = (job.kwargs or {}).get("template")
+        if template is None:
+            return super().execute_job(job, queue)
+        lease = job.timeout if job.timeout and job.timeout > 0 else DEFAULT_LEASE
+        if not acquire(self.connection, template, job.id, lease + 60):
+            # all slots are taken, the scheduler puts the job back later
+            metrics.inc("jobs_deferred", template=template["name"])
+            metrics.flush(self.connection)
+            logger.info(f"concurrency limit of {template['name']} reached, deferring {job.id}")
+            queue.schedule_job(
+                job,
+                datetime.datetime.now(datetime.timezone.utc)
+                + datetime.timedelta(seconds=CONCURRENCY_RETRY),
+            )
+            return
+        try:
+            return super().execute_job(job, queue)
+        finally:
+            release(self.connection, template, job.id)
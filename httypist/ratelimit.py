@@ -0,0 +1,139 @@
+import hashlib
+import logging
+import math
+import os
+import time
+
+from . import metrics
+from . import queues
+
+logger = logging.getLogger(__name__)
+
+MAX_QUEUE_DEPTH = int(os.getenv("HTTYPIST_MAX_QUEUE_DEPTH", 0))
+QUEUE_RETRY_AFTER = int(os.getenv("HTTYPIST_QUEUE_RETRY_AFTER", 10))
+IN_FLIGHT_RETRY_AFTER = int(os.getenv("HTTYPIST_IN_FLIGHT_RETRY_AFTER", 5))
+# a job holds its slot at most this long, so slots of lost jobs are freed
+IN_FLIGHT_LEASE = int(os.getenv("HTTYPIST_IN_FLIGHT_LEASE", 60 * 60))
+
+# refill the bucket, take a token if there is one, otherwise return the
+# seconds until there is one (as string, lua numbers are truncated to int)
+TAKE = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('hmget', KEYS[1], 'tokens', 'time')
+local tokens = tonumber(state[1]) or burst
+local last = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - last) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('hset', KEYS[1], 'tokens', tokens, 'time', now)
+redis.call('expire', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RateLimited(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(f"too many requests ({reason}), retry after {retry_after}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def parse_limits(entry):
+    """The limits of an `access` entry: `rate` requests per second with a
+    `burst` (default max(rate, 1)) and at most `max_in_flight` unfinished jobs.
+    `name` is used in the metrics instead of the token."""
+    rate = entry.get("rate")
+    max_in_flight = entry.get("max_in_flight")
+    if not rate and not max_in_flight:
+        return None
+    token = entry["token"]
+    return dict(
+        name=entry.get("name") or hashlib.sha256(token.encode()).hexdigest()[:8],
+        rate=float(rate) if rate else None,
+        burst=float(entry.get("burst") or max(float(rate or 0), 1)),
+        max_in_flight=int(max_in_flight) if max_in_flight else None,
+    )
+
+
+def _key(kind, token):
+    # the tokens are secrets, they are not written to redis
+    return f"httypist:{kind}:{hashlib.sha256(token.encode()).hexdigest()}"
+
+
+def take(connection, token, limits):
+    """Take a token from the bucket of a client or raise RateLimited"""
+    if not limits["rate"]:
+        return
+    script = connection.register_script(TAKE)
+    wait = float(
+        script(
+            keys=[_key("ratelimit", token)],
+            args=[limits["rate"], limits["burst"], time.time()],
+        )
+    )
+    if wait > 0:
+        metrics.inc("requests_limited", client=limits["name"], reason="rate")
+        raise RateLimited("rate", math.ceil(wait))
+
+
+def reserve(connection, token, limits, jobids):
+    """Take an in-flight slot of a client for every job id or raise RateLimited.
+
+    Returns the key of the slots, it is stored with the jobs and the worker
+    releases the slot when the job has ended.
+    """
+    if not limits["max_in_flight"]:
+        return None
+    key = _key("inflight", token)
+    script = connection.register_script(queues.ACQUIRE)
+    taken = []
+    for jobid in jobids:
+        now = time.time()
+        if not script(
+            keys=[key], args=[now, limits["max_in_flight"], jobid, now + IN_FLIGHT_LEASE]
+        ):
+            if taken:
+                connection.zrem(key, *taken)
+            metrics.inc("requests_limited", client=limits["name"], reason="in_flight")
+            raise RateLimited("in_flight", IN_FLIGHT_RETRY_AFTER)
+        taken.append(jobid)
+    return key
+
+
+def release(connection, key, jobid):
+    if key is not None:
+        connection.zrem(key, jobid)
+
+
+def in_flight(connection, token):
+    connection.zremrangebyscore(_key("inflight", token), "-inf", time.time())
+    return connection.zcard(_key("inflight", token))
+
+
+def check_queue(queue, template):
+    """Refuse new jobs while the queue of a template is longer than
+    `max_queue_depth` (config) or HTTYPIST_MAX_QUEUE_DEPTH"""
+    depth = template["config"].get("max_queue_depth", MAX_QUEUE_DEPTH)
+    if not depth or queue.count < depth:
+        return
+    metrics.inc("requests_limited", template=template["name"], reason="queue")
+    logger.warning(f"queue {queue.name} is full, refusing jobs of {template['name']}")
+    raise RateLimited("queue", QUEUE_RETRY_AFTER)
+
+
+class QuotaMixin(object):
+    """Worker releasing the in-flight slot of a job when it has ended"""
+
+    def handle_job_success(self, job, *args, **kwargs):
+        release(self.connection, job.meta.get("quota"), job.id)
+        return super().handle_job_success(job, *args, **kwargs)
+
+    def handle_job_failure(self, job, *args, **kwargs):
+        release(self.connection, job.meta.get("quota"), job.id)
+        return super().handle_job_failure(job, *args, **kwargs)
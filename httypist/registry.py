@@ -0,0 +1,163 @@
+import collections
+import contextlib
+import copy
+import json
+import logging
+import os
+import pathlib
+import yaml
+
+from . import repo
+from . import routing
+from . import ratelimit
+from . import resultcache
+
+try:
+    from yaml import CLoader as Loader
+except ImportError:
+    from yaml import Loader
+
+logger = logging.getLogger(__name__)
+
+# default is registry.json in the snapshot folder
+REGISTRY_FILE = os.getenv("HTTYPIST_REGISTRY_FILE")
+FORMAT_VERSION = 1
+
+
+class Registry(object):
+    """The templates of one commit of the repository.
+
+    A registry is never changed after it has been built. An update builds a
+    new one, which replaces the old one as a whole.
+    """
+
+    def __init__(self, commit=None, templates=None, authentication=None, limits=None):
+        self.commit = commit
+        self.templates = templates or {}
+        self.authentication = authentication or collections.defaultdict(list)
+        # token: rate limits, see ratelimit.parse_limits
+        self.limits = limits or {}
+        self.selector_index = routing.SelectorIndex()
+        for name, template in self.templates.items():
+            for selector in template["config"].get("selector", []):
+                self.selector_index.add(name, selector)
+
+
+def read_config(path):
+    with contextlib.suppress(FileNotFoundError):
+        return yaml.load(open(path), Loader=Loader) or {}
+    return {}
+
+
+def add_access(authentication, access, limits=None):
+    for e in access:
+        if isinstance(e, str):
+            authentication[e] = ["*"]
+        elif isinstance(e, dict):
+            if limits is not None and ratelimit.parse_limits(e):
+                limits[e["token"]] = ratelimit.parse_limits(e)
+            if isinstance(e["templates"], str):
+                authentication[e["token"]] = [e["templates"]]
+            else:
+                authentication[e["token"]] = list(e["templates"])
+
+
+def load(base="repo", previous=None):
+    """Read the templates below base.
+
+    If the previous registry is given, only the template folders changed
+    between its commit and the current one are read again.
+    """
+    base = pathlib.PosixPath(base)
+    commit = repo.get_commit(base)
+
+    changed = None
+    if previous is not None and previous.commit and commit:
+        changed = repo.changed_folders(base, previous.commit, commit)
+        if changed is not None and "config.yml" in changed:
+            # the base config is part of every template
+            changed = None
+
+    try:
+        dirs = [x for x in next(os.walk(base))[1] if not x.startswith(".")]
+    except (FileNotFoundError, StopIteration):
+        dirs = []
+
+    source = base
+    if commit is not None and dirs:
+        source = repo.snapshot(
+            base, commit, previous.commit if previous else None, changed
+        )
+
+    baseconfig = read_config(source / "config.yml")
+    authentication = collections.defaultdict(list)
+    limits = {}
+    add_access(authentication, baseconfig.pop("access", []), limits)
+
+    templates = {}
+    for dirname in dirs:
+        path = source / dirname
+        old = previous.templates.get(dirname) if changed is not None else None
+        if old is not None and dirname not in changed:
+            template = dict(old, path=str(path), commit=commit)
+        else:
+            logger.info(f"read template {dirname}")
+            template = dict(path=str(path), name=dirname, commit=commit)
+            template["config"] = copy.deepcopy(baseconfig)
+            template["config"].update(read_config(path / "config.yml"))
+            if commit is None:
+                # the version of the template for the result cache
+                template["digest"] = resultcache.content_digest(path)
+        templates[dirname] = template
+        for e in template["config"].get("access", []):
+            if isinstance(e, str):
+                authentication[e].append(dirname)
+
+    return Registry(commit, templates, authentication, limits)
+
+
+def _registry_file(path):
+    return pathlib.Path(
+        path or REGISTRY_FILE or os.path.join(repo.SNAPSHOT_DIR, "registry.json")
+    )
+
+
+def save(registry, path=None):
+    """Write the registry to disk, so the next start can use it right away"""
+    if registry.commit is None:
+        return
+    path = _registry_file(path)
+    data = dict(
+        version=FORMAT_VERSION,
+        commit=registry.commit,
+        templates=registry.templates,
+        authentication=registry.authentication,
+        limits=registry.limits,
+    )
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp = path.with_name(f".{path.name}.{os.getpid()}")
+    try:
+        temp.write_text(json.dumps(data))
+    except (TypeError, ValueError):
+        logger.exception("the registry can not be saved")
+        temp.unlink(missing_ok=True)
+        return
+    os.replace(temp, path)
+
+
+def load_snapshot(path=None):
+    """The registry written by `save` or None if there is no usable one"""
+    try:
+        data = json.loads(_registry_file(path).read_text())
+    except (FileNotFoundError, ValueError):
+        return None
+    if data.get("version") != FORMAT_VERSION:
+        logger.info("ignoring registry snapshot of another version")
+        return None
+    if not all(os.path.isdir(t["path"]) for t in data["templates"].values()):
+        logger.info(f"the snapshot of {data['commit']} is gone")
+        return None
+    authentication = collections.defaultdict(list, data["authentication"])
+    return Registry(
+        data["commit"], data["templates"], authentication, data.get("limits")
+    )
@@ -2,10 +2,15 @@ import subprocess
 import os
 import os.path
 import stat
+import shutil
+import pathlib
 import logging
 
 _logger = logging.getLogger(__name__)
 
+SNAPSHOT_DIR = os.getenv("HTTYPIST_SNAPSHOT_DIR", "snapshots")
+SNAPSHOT_KEEP = int(os.getenv("HTTYPIST_SNAPSHOT_KEEP", 10))
+
 
 def update(url=None, directory=None, token=None):
     if url is None:
@@ -47,3 +52,107 @@ def update(url=None, directory=None, token=None):
         subprocess.run(
             ["git", "submodule", "update", "--init", "--force"], cwd=directory, env=env
         )
+
+
+def get_commit(directory="repo"):
+    """Return the commit hash checked out in directory or None if unknown"""
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "--show-toplevel", "HEAD"],
+            cwd=directory,
+            capture_output=True,
+            text=True,
+        )
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    if result.returncode != 0:
+        return None
+    toplevel, commit = result.stdout.splitlines()
+    if os.path.realpath(toplevel) != os.path.realpath(directory):
+        # directory is not a checkout itself, but inside of another one
+        return None
+    return commit
+
+
+def changed_folders(directory, old, new):
+    """Return the top level entries changed between two commits or None if
+    the difference can not be determined"""
+    if old == new:
+        return set()
+    result = subprocess.run(
+        ["git", "diff", "--name-only", old, new],
+        cwd=directory,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        _logger.warning(f"Can not diff {old}..{new}: {result.stderr}")
+        return None
+    return {line.split("/")[0] for line in result.stdout.splitlines() if line}
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def snapshot(directory, commit, previous=None, changed=None):
+    """Create an immutable copy of the checkout for the commit.
+
+    Jobs use the snapshot of the commit they were enqueued with, so an update
+    of the checkout does not change the files below a running job. Folders
+    which did not change since the previous commit are hardlinked from its
+    snapshot instead of being copied again.
+    """
+    base = pathlib.Path(SNAPSHOT_DIR)
+    target = base / commit
+    if target.is_dir():
+        return target
+    previous_snapshot = base / previous if previous else None
+    if previous_snapshot is None or not previous_snapshot.is_dir():
+        changed = None
+    temp = base / f".{commit}.{os.getpid()}"
+    shutil.rmtree(temp, ignore_errors=True)
+    temp.mkdir(parents=True)
+    for entry in os.scandir(directory):
+        if entry.name == ".git":
+            continue
+        source = pathlib.Path(entry.path)
+        if changed is not None and entry.name not in changed:
+            source = previous_snapshot / entry.name
+            if not source.exists():
+                source = pathlib.Path(entry.path)
+            copy_function = _link_or_copy
+        else:
+            copy_function = shutil.copy2
+        if source.is_dir():
+            shutil.copytree(
+                source,
+                temp / entry.name,
+                copy_function=copy_function,
+                ignore=shutil.ignore_patterns(".git"),
+            )
+        elif source.exists():
+            copy_function(source, temp / entry.name)
+    try:
+        os.rename(temp, target)
+    except OSError:
+        # created by someone else in the meantime
+        shutil.rmtree(temp, ignore_errors=True)
+    cleanup_snapshots(keep=[commit, previous])
+    return target
+
+
+def cleanup_snapshots(keep=()):
+    base = pathlib.Path(SNAPSHOT_DIR)
+    snapshots = sorted(
+        (p for p in base.iterdir() if p.is_dir() and not p.name.startswith(".")),
+        key=lambda p: p.stat().st_mtime,
+        reverse=True,
+    )
+    for path in snapshots[SNAPSHOT_KEEP:]:
+        if path.name not in keep:
+            _logger.info(f"Remove snapshot {path}")
+            shutil.rmtree(path, ignore_errors=True)
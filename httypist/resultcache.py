@@ -0,0 +1,146 @@
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import time
+import threading
+
+from . import metrics
+from . import storage
+
+logger = logging.getLogger(__name__)
+
+CACHE_SIZE = int(os.getenv("HTTYPIST_RESULT_CACHE_SIZE", 1024 * 1024 * 1024))
+DEFAULT_TTL = 3600
+CACHE_MAX_AGE = int(os.getenv("HTTYPIST_RESULT_CACHE_MAX_AGE", 24 * 60 * 60))
+
+_lock = threading.Lock()
+
+
+def get_options(template):
+    """Return the cache options of the template or None if it is not cached.
+
+    `cache: true` enables caching with the defaults, a dict can set `ttl` in
+    seconds and a list of `ignore`d fields, e.g. `headers` or `json.timestamp`.
+    """
+    options = template["config"].get("cache")
+    if not options:
+        return None
+    if not isinstance(options, dict):
+        options = {}
+    return dict(
+        ttl=options.get("ttl", DEFAULT_TTL),
+        ignore=options.get("ignore", ["headers", "client"]),
+    )
+
+
+def content_digest(path):
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            filepath = pathlib.Path(root) / name
+            digest.update(str(filepath.relative_to(path)).encode())
+            digest.update(filepath.read_bytes())
+    return digest.hexdigest()
+
+
+def _drop(data, field):
+    *parents, last = field.split(".")
+    for parent in parents:
+        data = data.get(parent) if isinstance(data, dict) else None
+    if isinstance(data, dict):
+        data.pop(last, None)
+
+
+def normalize(data, ignore=()):
+    data = dict(data)
+    # the body is represented by its digest, it can be inlined or stored
+    digest = data.pop("digest", None)
+    data.pop("body_ref", None)
+    if data.get("json") is not None:
+        # the body is only the unparsed version of the json
+        data.pop("body", None)
+    elif digest is not None:
+        data["body"] = digest
+    if data.get("files"):
+        data["files"] = [
+            {k: v for k, v in f.items() if k != "key"} for f in data["files"]
+        ]
+    data = json.loads(json.dumps(data, default=_encode))
+    for field in ignore:
+        _drop(data, field)
+    return data
+
+
+def _encode(value):
+    if isinstance(value, bytes):
+        return hashlib.sha256(value).hexdigest()
+    return str(value)
+
+
+def key(template, data, options=None):
+    """Build the cache key from the template version and the request data"""
+    options = options or get_options(template) or {}
+    # the digest is computed when the registry is loaded, see registry.load
+    version = (
+        template.get("commit")
+        or template.get("digest")
+        or content_digest(template["path"])
+    )
+    payload = dict(
+        template=template["name"],
+        version=version,
+        data=normalize(data, options.get("ignore", ())),
+    )
+    return hashlib.sha256(
+        json.dumps(payload, sort_keys=True).encode()
+    ).hexdigest()
+
+
+def _key(cachekey):
+    return f"cache/{cachekey}.zip"
+
+
+def lookup(template, cachekey, ttl=DEFAULT_TTL):
+    """Return the artifact of a cached result.zip or None"""
+    store = storage.get_store()
+    artifact = store.stat(_key(cachekey))
+    if artifact is None or artifact.mtime + ttl < time.time():
+        metrics.inc("result_cache", result="miss", template=template["name"])
+        return None
+    metrics.inc("result_cache", result="hit", template=template["name"])
+    return artifact
+
+
+def store(template, cachekey, result_zip):
+    """Store a result.zip, the size of the cache is limited by `evict`, which
+    is run by the sweeper of the server"""
+    storage.get_store().put(_key(cachekey), result_zip)
+    logger.info(f"cached result of {template['name']} as {cachekey}")
+
+
+def evict(max_size=None, max_age=None):
+    """Remove entries older than max_age and the oldest ones above max_size.
+
+    The store does not know when an entry was used, so the entries are
+    evicted in the order they were created.
+    """
+    max_size = CACHE_SIZE if max_size is None else max_size
+    max_age = CACHE_MAX_AGE if max_age is None else max_age
+    store = storage.get_store()
+    limit = time.time() - max_age
+    with _lock:
+        entries = []
+        for artifact in store.list("cache/"):
+            if artifact.mtime < limit:
+                store.delete(artifact.key)
+                continue
+            entries.append((artifact.mtime, artifact.size, artifact.key))
+        size = sum(e[1] for e in entries)
+        for _, entrysize, key in sorted(entries):
+            if size <= max_size:
+                break
+            store.delete(key)
+            size -= entrysize
@@ -0,0 +1,86 @@
+import ast
+import collections
+import logging
+import re
+import jinja2
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# matches selectors like `json.type == "invoice"` which can be answered with a
+# dictionary lookup instead of evaluating every selector expression
+EQUALITY_SELECTOR = re.compile(
+    r"""^\s*(?P<path>[A-Za-z_]\w*(?:\.[A-Za-z_]\w*)*)\s*==\s*"""
+    r"""(?P<value>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|-?\d+(?:\.\d+)?)\s*$"""
+)
+
+_missing = object()
+
+
+class SelectorIndex(object):
+    """Routing index of all template selectors.
+
+    Selectors are compiled once into jinja expressions. Simple equality
+    selectors are grouped by the data path they compare, so for every request
+    each path is resolved only once and all templates expecting another value
+    are skipped without evaluating anything.
+    """
+
+    def __init__(self):
+        self.env = jinja2.Environment()
+        self.order = {}
+        self.equality = collections.defaultdict(dict)
+        self.expressions = []
+
+    def add(self, name, selector):
+        self.order.setdefault(name, len(self.order))
+        match = EQUALITY_SELECTOR.match(selector)
+        if match:
+            path = tuple(match.group("path").split("."))
+            value = ast.literal_eval(match.group("value"))
+            if not any(hasattr(dict, p) for p in path[1:]):
+                self.equality[path].setdefault(value, []).append(name)
+                return
+        try:
+            expression = self.env.compile_expression(selector)
+        except jinja2.TemplateSyntaxError:
+            logger.exception(f"invalid selector for {name}: {selector}")
+            return
+        self.expressions.append((name, selector, expression))
+
+    def resolve(self, path, data):
+        value = data.get(path[0], _missing)
+        if value is _missing:
+            return _missing
+        for attribute in path[1:]:
+            value = self.env.getattr(value, attribute)
+            if isinstance(value, jinja2.Undefined):
+                # an attribute of it would raise an UndefinedError
+                return _missing
+        return value
+
+    def match(self, data):
+        """Return the names of all templates with a matching selector"""
+        with metrics.timer("selector_seconds"):
+            matched = set()
+            for path, values in self.equality.items():
+                value = self.resolve(path, data)
+                try:
+                    matched.update(values.get(value, ()))
+                except TypeError:
+                    # unhashable values can not equal a literal
+                    continue
+            for name, selector, expression in self.expressions:
+                if name in matched:
+                    continue
+                metrics.inc("selector_evaluations")
+                try:
+                    # same semantics as rendering `{{ selector }}` to "True"
+                    use = str(expression(**data)) == "True"
+                except Exception:
+                    use = False
+                logger.debug(f"check: {{{{ {selector} }}}} => {use}")
+                if use:
+                    matched.add(name)
+        return sorted(matched, key=self.order.get)
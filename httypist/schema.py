@@ -9,7 +9,7 @@ from enum import Enum
 class Response(BaseModel):
     status: str
     success: bool
-    result: t.Union["ErrorResult", "RequestResult", "StatusResult", "RespsoneResult", "MultipleRequestsResult", str]
+    result: t.Union["ErrorResult", "RequestResult", "StatusResult", "RespsoneResult", "MultipleRequestsResult", "BatchRequestResult", "BatchStatusResult", str]
 
     class Config:
         schema_extra = {
@@ -33,6 +33,25 @@ class MultipleRequestsResult(BaseModel):
 
 class StatusResult(BaseModel):
     finished: bool
+    state: str = "unknown"
+    progress: t.Optional[dict] = None
+
+
+class BatchRequestResult(BaseModel):
+    template: str
+    batch_id: str
+    records: int
+    jobs: int
+    request_timestamp: int
+
+
+class BatchStatusResult(BaseModel):
+    template: str
+    batch_id: str
+    records: int
+    done: int
+    failed: int
+    finished: bool
 
 
 class RespsoneResult(BaseModel):
@@ -1,37 +1,66 @@
+import asyncio
+import concurrent.futures
 import fastapi
-from fastapi.responses import FileResponse, PlainTextResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 import datetime
-import copy
-import contextlib
 import functools
+import inspect
+import json
+import mimetypes
 import os
-import yaml
-import pathlib
-import collections
-from rq import Queue
-from redis import Redis
+import threading
+import time
+import uuid
+from rq import Queue, Worker
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
+from rq.registry import StartedJobRegistry, FailedJobRegistry
+from redis import Redis, BlockingConnectionPool
 from httypist import schema
 from . import repo
 from . import processor
+from . import registry
+from . import archive
+from . import resultcache
+from . import metrics
+from . import batch
+from . import storage
+from . import ingest
+from . import queues
+from . import events
+from . import latex
+from . import joblog
+from . import ratelimit
+from . import bundles
+from . import autoscale
 import logging
 import pydantic
 import pydantic.generics
 
-try:
-    from yaml import CLoader as Loader
-except ImportError:
-    from yaml import Loader
-
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = fastapi.FastAPI()
-available_templates = {}
-authentication = collections.defaultdict(list)
-
-# Tell RQ what Redis connection to use
-redis_conn = Redis(host="localhost")
+current_registry = registry.Registry()
+
+# Tell RQ what Redis connection to use, the blocking calls are run in a thread
+# pool, the connection pool is shared between those threads
+redis_pool = BlockingConnectionPool.from_url(
+    os.getenv("REDIS_URL", "redis://localhost"),
+    max_connections=int(os.getenv("HTTYPIST_REDIS_CONNECTIONS", 50)),
+)
+redis_conn = Redis(connection_pool=redis_pool)
 q = Queue("process", connection=redis_conn)  # no args implies the default queue
+hub = events.Hub()
+
+# `sync` templates are rendered by the server in a bounded thread pool
+SYNC_THREADS = int(os.getenv("HTTYPIST_SYNC_THREADS", 4))
+SYNC_TIMEOUT = float(os.getenv("HTTYPIST_SYNC_TIMEOUT", 2))
+sync_pool = concurrent.futures.ThreadPoolExecutor(
+    SYNC_THREADS, thread_name_prefix="sync-render"
+)
+sync_slots = threading.BoundedSemaphore(SYNC_THREADS)
 
 
 def build_error_response(msg, code=-1, status="error"):
@@ -44,29 +73,35 @@ def build_success_response(result, status="success"):
     return dict(status=status, success=True, result=result)
 
 
+def get_allowed(headers):
+    """The templates the `Authorization` header gives access to, None without it"""
+    authentication = current_registry.authentication
+    if len(authentication) == 0:
+        return ["*"]
+    if not "Authorization" in headers:
+        return None
+    return authentication.get(headers["Authorization"], [])
+
+
 def check_auth(func):
     """Decorate the routes to get a basic protection information. The allowed templates are stored in the request.state as allowed.
     N.B.:
         - The real check if the template is allowed with the provided `Authorization` header is not done here as we may not know, what template to use.
         - It is required that the decorated function includes a request:fastapi.Request parameter.
+        - Synchronous routes are run in the thread pool, so blocking calls (e.g. to redis) do not block the event loop.
     """
 
     @functools.wraps(func)
     async def login_required(*args, **kwargs):
         if "request" in kwargs:
             request = kwargs["request"]
-            if len(authentication) == 0:
-                request.state.allowed = ["*"]
-            else:
-                request.state.allowed = []
-                if not "Authorization" in request.headers:
-                    raise fastapi.HTTPException(status_code=401)
-                data = request.headers["Authorization"]
-                token = data
-                if token in authentication:
-                    request.state.allowed = authentication[token]
+            request.state.allowed = get_allowed(request.headers)
+            if request.state.allowed is None:
+                raise fastapi.HTTPException(status_code=401)
 
-        return await func(*args, **kwargs)
+        if inspect.iscoroutinefunction(func):
+            return await func(*args, **kwargs)
+        return await run_in_threadpool(func, *args, **kwargs)
 
     return login_required
 
@@ -82,92 +117,463 @@ def access_root():
 async def info(request: fastapi.Request):
     '''Return the available templates (respecting the given authentication)'''
     know_keys = []
-    for key in available_templates:
+    for key in current_registry.templates:
         if "*" in request.state.allowed or key in request.state.allowed:
             know_keys.append(key)
     return build_success_response(know_keys)
 
 
+REFRESH_INTERVAL = int(os.getenv("HTTYPIST_REFRESH_INTERVAL", 0))
+update_state = dict(state="idle", started=None, finished=None, error=None)
+update_lock = threading.Lock()
+
+
+def refresh():
+    """Update the repository and read the templates again"""
+    update_state.update(state="running", started=time.time(), error=None)
+    try:
+        repo.update()
+        read_templates()
+        update_state.update(state="finished")
+    except Exception as e:
+        logger.exception("update failed")
+        update_state.update(state="failed", error=str(e))
+    finally:
+        update_state.update(finished=time.time())
+
+
+def refresh_in_background():
+    def run():
+        try:
+            refresh()
+        finally:
+            update_lock.release()
+
+    if not update_lock.acquire(blocking=False):
+        return False
+    threading.Thread(target=run, daemon=True).start()
+    return True
+
+
 @app.get("/update")
 def update_repo():
-    '''Refresh the repository'''
-    repo.update()
-    read_templates()
+    '''Refresh the repository in the background'''
+    if not refresh_in_background():
+        return build_success_response("update already running")
     return build_success_response("update triggered")
 
 
+@app.get("/update/status")
+def update_status():
+    '''State of the last repository update'''
+    return build_success_response(update_state)
+
+
+@app.get("/metrics")
+def prometheus_metrics():
+    '''Metrics of the server and the workers in the prometheus format'''
+    local = (dict(metrics.counters), dict(metrics.histograms))
+    counters, histograms = metrics.merge(local, metrics.load(redis_conn))
+    gauges = metrics.hit_ratios(counters)
+    for queue in Queue.all(connection=redis_conn):
+        labels = (("queue", queue.name),)
+        gauges[("queue_depth", labels)] = len(queue)
+        gauges[("queue_started", labels)] = StartedJobRegistry(queue=queue).count
+        gauges[("queue_failed", labels)] = FailedJobRegistry(queue=queue).count
+    workers = Worker.all(connection=redis_conn)
+    busy = sum(1 for w in workers if w.get_state() == "busy")
+    gauges[("workers", (("state", "busy"),))] = busy
+    gauges[("workers", (("state", "idle"),))] = len(workers) - busy
+    gauges[("worker_utilization", ())] = busy / len(workers) if workers else 0
+    for supervisor, state in autoscale.load(redis_conn).items():
+        for kind in ("running", "target"):
+            labels = (("kind", kind), ("supervisor", supervisor))
+            gauges[("autoscale_workers", labels)] = state[kind]
+    for token, limits in current_registry.limits.items():
+        if limits["max_in_flight"]:
+            labels = (("client", limits["name"]),)
+            gauges[("client_in_flight", labels)] = ratelimit.in_flight(redis_conn, token)
+    return PlainTextResponse(
+        metrics.render(counters, histograms, gauges),
+        media_type="text/plain; version=0.0.4",
+    )
+
+
 def get_job(jobid, request):
-    job = q.fetch_job(jobid)
-    if job is None:
+    # not q.fetch_job, the job may be in any queue (see queues.queue_name)
+    try:
+        job = Job.fetch(jobid, connection=redis_conn)
+    except NoSuchJobError:
         raise fastapi.HTTPException(status_code=404)
     templatename = job.kwargs["template"]["name"]
     if not ("*" in request.state.allowed or templatename in request.state.allowed):
         raise fastapi.HTTPException(status_code=403)
     return job
 
+def job_status(job):
+    state = job.get_status(refresh=False)
+    state = getattr(state, "value", state)
+    return schema.StatusResult(
+        finished=state in events.FINAL_STATES,
+        state=state,
+        progress=job.meta.get("progress"),
+    )
+
+
+async def wait_for_status(jobid, request, wait):
+    """The status of a job, waiting up to `wait` seconds for it to end"""
+    job = await run_in_threadpool(get_job, jobid, request)
+    resp = job_status(job)
+    if resp.finished or wait <= 0:
+        return resp
+    async with hub.subscribe(redis_conn, jobid) as queue:
+        # the job could have ended before the subscription
+        job = await run_in_threadpool(get_job, jobid, request)
+        resp = job_status(job)
+        deadline = time.monotonic() + min(wait, events.MAX_WAIT)
+        while not resp.finished:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if event["state"] in events.FINAL_STATES:
+                job = await run_in_threadpool(get_job, jobid, request)
+                resp = job_status(job)
+    return resp
+
+
 @app.get("/status/{jobid}")
 @check_auth
-async def status(request: fastapi.Request, jobid: str = fastapi.Path(...)):
-    '''Check the state of a triggered httypist job.'''
-    job = get_job(jobid, request)
-    resp = schema.StatusResult(finished=job.result is not None)
-    return build_success_response(resp)
-
+async def status(
+    request: fastapi.Request,
+    jobid: str = fastapi.Path(...),
+    wait: float = fastapi.Query(0, ge=0),
+):
+    '''Check the state of a triggered httypist job, with `wait` seconds it returns as soon as the job has ended.'''
+    return build_success_response(await wait_for_status(jobid, request, wait))
 
 
 @app.get("/result/{jobid}")
 @check_auth
-async def result(request: fastapi.Request, jobid: str = fastapi.Path(...)):
+async def result(
+    request: fastapi.Request,
+    jobid: str = fastapi.Path(...),
+    wait: float = fastapi.Query(0, ge=0),
+):
     '''Get the result information for a specific job.'''
-    job = get_job(jobid, request)
-    resp = schema.StatusResult(finished=job.result is not None)
-    return build_success_response(resp)
+    return build_success_response(await wait_for_status(jobid, request, wait))
+
+
+async def job_events(jobid, request):
+    """The status of a job and then its events until it has ended.
+
+    Without events the status is read again every KEEPALIVE seconds, an
+    unchanged status is reported as None.
+    """
+    async with hub.subscribe(redis_conn, jobid) as queue:
+        job = await run_in_threadpool(get_job, jobid, request)
+        last = job_status(job)
+        yield last.dict()
+        while not last.finished:
+            try:
+                event = await asyncio.wait_for(queue.get(), events.KEEPALIVE)
+            except asyncio.TimeoutError:
+                job = await run_in_threadpool(get_job, jobid, request)
+                if job_status(job) == last:
+                    yield None
+                    continue
+                last = job_status(job)
+                yield last.dict()
+                continue
+            if event["state"] == "log":
+                continue
+            if event["state"] == "progress":
+                last = schema.StatusResult(
+                    finished=False, state="started", progress=event["progress"]
+                )
+            else:
+                job = await run_in_threadpool(get_job, jobid, request)
+                last = job_status(job)
+            yield last.dict()
+
+
+@app.get("/events/{jobid}")
+@check_auth
+async def server_sent_events(request: fastapi.Request, jobid: str = fastapi.Path(...)):
+    '''Server-Sent Events with the status of a job, the stream ends with the job.'''
+    # fail with 404/403 before the stream starts
+    await run_in_threadpool(get_job, jobid, request)
+
+    async def stream():
+        async for status in job_events(jobid, request):
+            if status is None:
+                yield ": keepalive\n\n"
+            else:
+                yield f"event: status\ndata: {json.dumps(status)}\n\n"
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.websocket("/ws/{jobid}")
+async def websocket_events(websocket: fastapi.WebSocket, jobid: str):
+    '''The status of a job as json messages, the socket is closed when the job has ended.'''
+    websocket.state.allowed = get_allowed(websocket.headers)
+    if websocket.state.allowed is None:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    try:
+        async for status in job_events(jobid, websocket):
+            if status is not None:
+                await websocket.send_json(status)
+    except fastapi.HTTPException as e:
+        await websocket.send_json(build_error_response(e.detail, e.status_code))
+    except fastapi.WebSocketDisconnect:
+        return
+    await websocket.close()
+
+
+def get_artifacts(job):
+    """The artifact prefix of a finished job"""
+    if job.result is None:
+        raise fastapi.HTTPException(status_code=404)
+    return job.result["artifacts"]
+
+
+def stream_artifact(key, filename=None, media_type="application/octet-stream"):
+    store = storage.get_store()
+    try:
+        fileobj = store.open(key)
+    except KeyError:
+        raise fastapi.HTTPException(status_code=404)
+    headers = {}
+    if filename is not None:
+        headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return StreamingResponse(
+        storage.iter_chunks(fileobj), media_type=media_type, headers=headers
+    )
+
+
+async def follow_log(jobid, request):
+    """The log lines of a job until it has ended.
+
+    The lines are read when the worker has published new ones, without events
+    the status is read again every KEEPALIVE seconds.
+    """
+    seen = 0
+    async with hub.subscribe(redis_conn, jobid) as queue:
+        while True:
+            # the worker pushes the last lines before the job ends
+            job = await run_in_threadpool(get_job, jobid, request)
+            finished = job_status(job).finished
+            lines, seen = await run_in_threadpool(
+                joblog.read_tail, redis_conn, jobid, seen
+            )
+            for line in lines:
+                yield line
+            if finished:
+                return
+            try:
+                await asyncio.wait_for(queue.get(), events.KEEPALIVE)
+            except asyncio.TimeoutError:
+                pass
 
 
 @app.get("/result/{jobid}/log")
 @check_auth
-async def resut_zip(request: fastapi.Request, jobid: str = fastapi.Path(...)):
-    '''Get the log of a job.'''
-    job = get_job(jobid, request)
-    return PlainTextResponse(job.result["log"])
+async def result_log(request: fastapi.Request, jobid: str = fastapi.Path(...)):
+    '''Get the log of a job, the log of a running job is followed until it has
+    ended.'''
+    job = await run_in_threadpool(get_job, jobid, request)
+    if not job_status(job).finished:
+        return StreamingResponse(follow_log(jobid, request), media_type="text/plain")
+    # failed jobs have no result, but a log
+    artifacts = job.result["artifacts"] if job.result else f"jobs/{jobid}"
+    return await run_in_threadpool(
+        stream_artifact, f"{artifacts}/log.txt", media_type="text/plain"
+    )
 
 
 @app.get("/result/{jobid}/result.zip")
 @check_auth
-async def resut_zip(request: fastapi.Request, jobid: str = fastapi.Path(...)):
+def resut_zip(request: fastapi.Request, jobid: str = fastapi.Path(...)):
     '''Get the result files of a job.'''
     job = get_job(jobid, request)
-    return FileResponse(
-        job.result["result_folder"] / "result.zip",
-        media_type="application/octet-stream",
-        filename=f"result-{jobid}.zip",
-    )
+    return stream_artifact(f"{get_artifacts(job)}/result.zip", f"result-{jobid}.zip")
+
 
 @app.get("/result/{jobid}/temp.zip")
 @check_auth
-async def temp_zip(request: fastapi.Request, jobid: str = fastapi.Path(...)):
+def temp_zip(request: fastapi.Request, jobid: str = fastapi.Path(...)):
     '''Get the temporary files of a job.'''
     job = get_job(jobid, request)
-    return FileResponse(
-        job.result["result_folder"] / "temp.zip",
+    artifacts = get_artifacts(job)
+    store = storage.get_store()
+    if store.stat(f"{artifacts}/temp.zip") is not None:
+        return stream_artifact(f"{artifacts}/temp.zip", f"temp-{jobid}.zip")
+    template = job.kwargs["template"]
+    prefix = f"{artifacts}/workspace/"
+    files = (
+        (artifact, artifact.key[len(prefix) :]) for artifact in store.list(prefix)
+    )
+    return StreamingResponse(
+        archive.stream_zip(files, archive.get_compression(template["config"])),
         media_type="application/octet-stream",
-        filename=f"temp-{jobid}.zip",
+        headers={"Content-Disposition": f'attachment; filename="temp-{jobid}.zip"'},
     )
 
 
-async def get_all_available_data(request):
-    try:
-        json = await request.json()
-    except:
-        json = None
-    body = await request.body()
-    return dict(
-        body=body,
-        json=json,
+async def read_payload(request):
+    """Read the body of a request, large bodies are spooled to a file"""
+    payload = ingest.Payload(
         headers=dict(request.headers),
         query=dict(request.query_params),
         client=request.client.host,
     )
+    try:
+        await payload.read(request)
+    except ingest.PayloadTooLarge as e:
+        payload.close()
+        raise fastapi.HTTPException(status_code=413, detail=str(e))
+    return payload
+
+
+async def render_sync(template, data):
+    """Render a `sync` template in the thread pool of the server.
+
+    Returns the output files or None if the job has to go through the queue:
+    all threads are busy, the rendering failed or took longer than
+    SYNC_TIMEOUT (it is not aborted, but the client gets a job instead).
+    """
+    if not sync_slots.acquire(blocking=False):
+        metrics.inc("sync_renders", template=template["name"], result="busy")
+        return None
+
+    def run():
+        try:
+            return processor.render_sync(template, data)
+        finally:
+            sync_slots.release()
+
+    future = asyncio.wrap_future(sync_pool.submit(run))
+    try:
+        files = await asyncio.wait_for(asyncio.shield(future), SYNC_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"rendering {template['name']} timed out, using the queue")
+        metrics.inc("sync_renders", template=template["name"], result="timeout")
+        return None
+    except Exception:
+        logger.exception(f"rendering {template['name']} failed, using the queue")
+        metrics.inc("sync_renders", template=template["name"], result="error")
+        return None
+    metrics.inc("sync_renders", template=template["name"], result="ok")
+    return files
+
+
+def sync_response(template, files):
+    """A single output file as it is, several as zip"""
+    if len(files) == 1:
+        (name, content), = files.items()
+        media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    else:
+        name = f"result-{template['name']}.zip"
+        content = archive.zip_bytes(files, archive.get_compression(template["config"]))
+        media_type = "application/zip"
+    return fastapi.Response(
+        content,
+        media_type=media_type,
+        headers={
+            "Content-Disposition": f'inline; filename="{name}"',
+            "x-httypist-sync": "1",
+        },
+    )
+
+
+def get_queue(template, priority=None):
+    """The queue of a template, see `queue` and `priority` in config.yml"""
+    return queues.get_queue(template, q.connection, priority)
+
+
+def get_cached_result(template, payload):
+    options = resultcache.get_options(template)
+    if options is None:
+        return None
+    return resultcache.lookup(
+        template, resultcache.key(template, payload.data(), options), options["ttl"]
+    )
+
+
+def too_many_requests(e):
+    return fastapi.HTTPException(
+        status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)}
+    )
+
+
+def admit(request, templates=(), priority=None):
+    """Apply the request rate of the client and the queue limits of the
+    templates, before the body is read"""
+    token = request.headers.get("Authorization")
+    limits = current_registry.limits.get(token)
+    if limits is not None:
+        try:
+            ratelimit.take(redis_conn, token, limits)
+        except ratelimit.RateLimited as e:
+            raise too_many_requests(e)
+    admit_queues(templates, priority)
+
+
+def admit_queues(templates, priority=None):
+    """Refuse new jobs while the queues of the templates are full"""
+    try:
+        for template in templates:
+            ratelimit.check_queue(get_queue(template, priority), template)
+    except ratelimit.RateLimited as e:
+        raise too_many_requests(e)
+
+
+def reserve_jobs(request, count):
+    """Ids for count jobs and the key of their in-flight slots of the client"""
+    token = request.headers.get("Authorization")
+    limits = current_registry.limits.get(token)
+    jobids = [str(uuid.uuid4()) for _ in range(count)]
+    quota = None
+    if limits is not None:
+        try:
+            quota = ratelimit.reserve(redis_conn, token, limits, jobids)
+        except ratelimit.RateLimited as e:
+            raise too_many_requests(e)
+    return jobids, quota
+
+
+def enqueue_jobs(request, templates, data):
+    """Enqueue a job for every template, within the in-flight quota of the client"""
+    jobids, quota = reserve_jobs(request, len(templates))
+    jobs = []
+    try:
+        for jobid, template in zip(jobids, templates):
+            jobs.append(
+                get_queue(template).enqueue(
+                    processor.process_template,
+                    template=template,
+                    data=data,
+                    result_ttl=storage.ARTIFACT_TTL,
+                    job_id=jobid,
+                    meta=dict(quota=quota) if quota else None,
+                )
+            )
+    except Exception:
+        for jobid in jobids[len(jobs):]:
+            ratelimit.release(redis_conn, quota, jobid)
+        raise
+    return jobs
+
 
 @app.post("/process/{templatename}")
 @check_auth
@@ -178,102 +584,203 @@ async def process_template(
     '''This triggers the processing of a given template with the data provided in the request'''
     if not ("*" in request.state.allowed or templatename in request.state.allowed):
         raise fastapi.HTTPException(status_code=403)
-    if templatename not in available_templates:
+    templates = current_registry.templates
+    if templatename not in templates:
         raise fastapi.HTTPException(status_code=404)
-    template = available_templates[templatename]
-    alldata = await get_all_available_data(request)
-    job = q.enqueue(processor.process_template, template=template, data=alldata)
+    template = templates[templatename]
+    await run_in_threadpool(admit, request, [template])
+    payload = await read_payload(request)
+    try:
+        cached = await run_in_threadpool(get_cached_result, template, payload)
+        if cached is not None:
+            response = stream_artifact(cached.key, f"result-{templatename}.zip")
+            response.headers["x-httypist-cache"] = "hit"
+            return response
+        if processor.can_render_sync(template) and not payload.uploads:
+            # reads and parses the spooled body, hashes the uploads
+            files = await render_sync(template, await run_in_threadpool(payload.data))
+            if files is not None:
+                return sync_response(template, files)
+        data = await run_in_threadpool(payload.job_data)
+    finally:
+        payload.close()
+    job, = await run_in_threadpool(enqueue_jobs, request, [template], data)
     resp = schema.RequestResult(
         template=templatename,
         request_id=job.id,
-        request_timestamp=datetime.datetime.now().timestamp(),
+        request_timestamp=int(datetime.datetime.now().timestamp()),
     )
     return build_success_response(resp)
 
 
 
+@app.post("/batch/{templatename}")
+@check_auth
+async def process_batch(
+    request: fastapi.Request,
+    templatename: str = fastapi.Path(...),
+):
+    '''Process the template for every record of a json array or newline delimited json'''
+    if not ("*" in request.state.allowed or templatename in request.state.allowed):
+        raise fastapi.HTTPException(status_code=403)
+    templates = current_registry.templates
+    if templatename not in templates:
+        raise fastapi.HTTPException(status_code=404)
+    template = templates[templatename]
+    priority = template["config"].get("batch_priority", "low")
+    await run_in_threadpool(admit, request, [template], priority)
+    payload = await read_payload(request)
+    batchid = str(uuid.uuid4())
+    try:
+        chunks = await run_in_threadpool(
+            batch.store_records, payload.body, template, batchid
+        )
+    except batch.BatchError as e:
+        raise fastapi.HTTPException(status_code=400, detail=str(e))
+    finally:
+        payload.close()
+    data = dict(
+        body=b"",
+        json=None,
+        headers=dict(request.headers),
+        query=dict(request.query_params),
+        client=request.client.host,
+    )
+    queue = get_queue(template, priority)
+    jobids, quota = await run_in_threadpool(reserve_jobs, request, len(chunks))
+    try:
+        jobs = await run_in_threadpool(
+            batch.enqueue, queue, template, batchid, chunks, data, jobids, quota
+        )
+    except Exception:
+        for jobid in jobids:
+            ratelimit.release(redis_conn, quota, jobid)
+        raise
+    resp = schema.BatchRequestResult(
+        template=templatename,
+        batch_id=batchid,
+        records=sum(count for _, count, _ in chunks),
+        jobs=len(jobs),
+        request_timestamp=int(datetime.datetime.now().timestamp()),
+    )
+    return build_success_response(resp)
+
+
+def get_batch(batchid, request):
+    info = batch.load(redis_conn, batchid)
+    if info is None:
+        raise fastapi.HTTPException(status_code=404)
+    if not ("*" in request.state.allowed or info["template"] in request.state.allowed):
+        raise fastapi.HTTPException(status_code=403)
+    return info
+
+
+@app.get("/batch/{batchid}")
+@check_auth
+def batch_status(request: fastapi.Request, batchid: str = fastapi.Path(...)):
+    '''Progress of a batch request'''
+    info = get_batch(batchid, request)
+    return build_success_response(
+        schema.BatchStatusResult(**batch.status(redis_conn, info))
+    )
+
+
+@app.get("/batch/{batchid}/result.zip")
+@check_auth
+def batch_result_zip(request: fastapi.Request, batchid: str = fastapi.Path(...)):
+    '''All result files of the finished records of a batch, one folder per record'''
+    info = get_batch(batchid, request)
+    template = current_registry.templates.get(info["template"], dict(config={}))
+    return StreamingResponse(
+        archive.stream_zip(
+            batch.result_files(redis_conn, info),
+            archive.get_compression(template["config"]),
+        ),
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": f'attachment; filename="batch-{batchid}.zip"'},
+    )
+
+
 @app.post("/process")
 @check_auth
 async def autoprocess(request: fastapi.Request):
     '''This triggers the processing of a template with the data provided in the request. The template will be selected based on the data provided and the selector in the template config.'''
     logger.info("autotemplate")
-    alldata = await get_all_available_data(request)
-    logger.debug("data: {}".format(alldata))
-    use_templates = []
-    for name, template in available_templates.items():
-        logger.debug(f"check process {name}")
-        if "selector" in template["config"]:
-            for selector in template["config"]["selector"]:
-                use = (
-                    processor.process_string(f"{{{{ {selector} }}}}", alldata)
-                    == "True"
-                )
-                logger.debug(f"check: {{{{ {selector} }}}} => {use}")
-                if use:
-                    if not (
-                        "*" in request.state.allowed or name in request.state.allowed
-                    ):
-                        continue
-                    use_templates.append(name)
+    await run_in_threadpool(admit, request)
+    payload = await read_payload(request)
+    try:
+        snapshot = current_registry
+        request_data = await run_in_threadpool(payload.data)
+        names = await run_in_threadpool(snapshot.selector_index.match, request_data)
+        use_templates = [
+            snapshot.templates[name]
+            for name in names
+            if "*" in request.state.allowed or name in request.state.allowed
+        ]
+        data = None
+        if use_templates:
+            await run_in_threadpool(admit_queues, use_templates)
+            data = await run_in_threadpool(payload.job_data)
+    finally:
+        payload.close()
     jobs = []
-    for template in use_templates:
-        job = q.enqueue(
-            processor.process_template,
-            template=available_templates[template],
-            data=data,
-        )
+    for job, template in zip(
+        await run_in_threadpool(enqueue_jobs, request, use_templates, data),
+        use_templates,
+    ):
         resp = schema.RequestResult(
-            template=template,
+            template=template["name"],
             request_id=job.id,
-            request_timestamp=datetime.datetime.now().timestamp(),
+            request_timestamp=int(datetime.datetime.now().timestamp()),
         )
         jobs.append(resp)
     return build_success_response(schema.MultipleRequestsResult(requests=jobs))
 
 
 def read_templates():
-    authentication.clear()
-    base = pathlib.PosixPath("repo")
-
+    global current_registry
+    loaded = registry.load("repo", current_registry)
     try:
-        baseconfig = yaml.load(open(base / "config.yml"), Loader=Loader)
-    except FileNotFoundError:
-        baseconfig = {}
-
-    if "access" in baseconfig:
-        for e in baseconfig["access"]:
-            if isinstance(e, str):
-                authentication[e] = ["*"]
-            elif isinstance(e, dict):
-                if isinstance(e["templates"], str):
-                    authentication[e["token"]] = [e["templates"]]
-                else:
-                    authentication[e["token"]] = [].expand(e["templates"])
-        del baseconfig["access"]
-
+        bundles.publish(loaded.templates.values())
+    except Exception:
+        # workers sharing the disk with the server still find the templates
+        logger.exception("could not publish the template bundles")
+    current_registry = loaded
+    registry.save(current_registry)
     try:
-        dirs = [x for x in next(os.walk(base))[1] if not x.startswith(".")]
-    except (FileNotFoundError, StopIteration):
-        dirs = []
-
-    for dirname in dirs:
-        path = base / dirname
-        available_templates[dirname] = {}
-        template = available_templates[dirname]
-        template["path"] = str(path)
-        template["name"] = dirname
-        template["config"] = copy.deepcopy(baseconfig)
-        with contextlib.suppress(FileNotFoundError):
-            template["config"].update(
-                yaml.load(open(path / "config.yml"), Loader=Loader)
-            )
-            if "access" in template["config"]:
-                for e in template["config"]["access"]:
-                    if isinstance(e, str):
-                        authentication[e].append(dirname)
+        latex.enqueue_formats(q, current_registry.templates.values())
+    except Exception:
+        # the workers build missing formats on their own as well
+        logger.exception("could not enqueue the latex formats")
+
+
+@app.on_event("startup")
+def load_registry():
+    """Serve the templates known from the last run, update in the background"""
+    global current_registry
+    snapshot = registry.load_snapshot()
+    if snapshot is not None:
+        logger.info(f"loaded the templates of {snapshot.commit}")
+        current_registry = snapshot
+    refresh_in_background()
+    if REFRESH_INTERVAL:
+
+        def run():
+            while True:
+                time.sleep(REFRESH_INTERVAL)
+                refresh_in_background()
+
+        threading.Thread(target=run, daemon=True, name="refresh").start()
+
+
+@app.on_event("startup")
+def start_hub():
+    hub.start(redis_conn)
 
 
-update_repo()
+@app.on_event("startup")
+def start_sweeper():
+    storage.start_sweeper(tasks=[resultcache.evict])
 
 
 def main():
@@ -0,0 +1,225 @@
+import contextlib
+import logging
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+import time
+import urllib.parse
+
+logger = logging.getLogger(__name__)
+
+STORE_URL = os.getenv(
+    "HTTYPIST_STORE", os.path.join(tempfile.gettempdir(), "httypist-artifacts")
+)
+ARTIFACT_TTL = int(os.getenv("HTTYPIST_ARTIFACT_TTL", 7 * 24 * 60 * 60))
+SWEEP_INTERVAL = int(os.getenv("HTTYPIST_SWEEP_INTERVAL", 60 * 60))
+CHUNK_SIZE = 64 * 1024
+
+
+class Artifact(object):
+    """A stored file, the key is a path like `jobs/<jobid>/result.zip`"""
+
+    def __init__(self, store, key, size, mtime):
+        self.store = store
+        self.key = key
+        self.size = size
+        self.mtime = mtime
+
+    @property
+    def name(self):
+        return self.key.rsplit("/", 1)[-1]
+
+    def open(self):
+        return self.store.open(self.key)
+
+
+class LocalStore(object):
+    """Artifacts in a local (or shared) directory"""
+
+    def __init__(self, root):
+        self.root = pathlib.Path(root)
+
+    def _path(self, key):
+        path = (self.root / key).resolve()
+        if self.root.resolve() not in path.parents:
+            raise ValueError(f"invalid key {key}")
+        return path
+
+    def put(self, key, source):
+        """Store a file, source is a path or a readable file object"""
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}")
+        if isinstance(source, (str, os.PathLike)):
+            shutil.copyfile(source, temp)
+        else:
+            with open(temp, "wb") as f:
+                shutil.copyfileobj(source, f, CHUNK_SIZE)
+        os.replace(temp, path)
+
+    def open(self, key):
+        try:
+            return open(self._path(key), "rb")
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def stat(self, key):
+        try:
+            stat = self._path(key).stat()
+        except FileNotFoundError:
+            return None
+        return Artifact(self, key, stat.st_size, stat.st_mtime)
+
+    def list(self, prefix=""):
+        base = self._path(prefix) if prefix else self.root
+        if base.is_file():
+            yield self.stat(prefix)
+            return
+        for root, dirs, files in os.walk(base):
+            dirs.sort()
+            for name in sorted(files):
+                if name.startswith("."):
+                    continue
+                path = pathlib.Path(root) / name
+                key = path.relative_to(self.root).as_posix()
+                stat = path.stat()
+                yield Artifact(self, key, stat.st_size, stat.st_mtime)
+
+    def delete(self, prefix):
+        path = self._path(prefix)
+        if path.is_dir():
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            path.unlink(missing_ok=True)
+
+
+class S3Store(object):
+    """Artifacts in a S3 compatible object store (needs boto3)"""
+
+    def __init__(self, bucket, prefix="", client=None, endpoint_url=None):
+        if client is None:
+            import boto3
+
+            client = boto3.client("s3", endpoint_url=endpoint_url)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+
+    def _key(self, key):
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def _strip(self, key):
+        return key[len(self.prefix) + 1 :] if self.prefix else key
+
+    def put(self, key, source):
+        if isinstance(source, (str, os.PathLike)):
+            self.client.upload_file(str(source), self.bucket, self._key(key))
+        else:
+            self.client.upload_fileobj(source, self.bucket, self._key(key))
+
+    def open(self, key):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self._key(key))[
+                "Body"
+            ]
+        except self.client.exceptions.NoSuchKey:
+            raise KeyError(key)
+
+    def stat(self, key):
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+        except Exception:
+            return None
+        return Artifact(
+            self, key, head["ContentLength"], head["LastModified"].timestamp()
+        )
+
+    def list(self, prefix=""):
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self._key(prefix)):
+            for item in page.get("Contents", []):
+                yield Artifact(
+                    self,
+                    self._strip(item["Key"]),
+                    item["Size"],
+                    item["LastModified"].timestamp(),
+                )
+
+    def delete(self, prefix):
+        keys = [{"Key": self._key(a.key)} for a in self.list(prefix)]
+        for i in range(0, len(keys), 1000):
+            self.client.delete_objects(
+                Bucket=self.bucket, Delete={"Objects": keys[i : i + 1000]}
+            )
+
+
+def from_url(url):
+    """`s3://bucket/prefix` (endpoint from HTTYPIST_S3_ENDPOINT) or a directory"""
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme == "s3":
+        return S3Store(
+            parsed.netloc,
+            parsed.path,
+            endpoint_url=os.getenv("HTTYPIST_S3_ENDPOINT") or None,
+        )
+    if parsed.scheme == "file":
+        return LocalStore(parsed.path)
+    return LocalStore(url)
+
+
+_store = None
+
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = from_url(STORE_URL)
+    return _store
+
+
+def iter_chunks(fileobj, chunk_size=CHUNK_SIZE):
+    with contextlib.closing(fileobj) as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            yield data
+
+
+def sweep(store=None, ttl=None, prefixes=("jobs", "cache", "uploads")):
+    """Delete the artifacts of jobs (and their uploads) older than ttl seconds"""
+    store = store or get_store()
+    ttl = ARTIFACT_TTL if ttl is None else ttl
+    limit = time.time() - ttl
+    newest = {}
+    for prefix in prefixes:
+        for artifact in store.list(f"{prefix}/"):
+            group = "/".join(artifact.key.split("/")[:2])
+            newest[group] = max(newest.get(group, 0), artifact.mtime)
+    removed = 0
+    for group, mtime in newest.items():
+        if mtime < limit:
+            logger.info(f"remove artifacts {group}")
+            store.delete(group)
+            removed += 1
+    return removed
+
+
+def start_sweeper(interval=SWEEP_INTERVAL, tasks=()):
+    """Sweep the store every `interval` seconds and run the other cleanup
+    `tasks` (functions without arguments) as well"""
+
+    def run():
+        while True:
+            for task in (sweep, *tasks):
+                try:
+                    task()
+                except Exception:
+                    logger.exception(f"{task.__name__} failed")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, daemon=True, name="artifact-sweeper")
+    thread.start()
+    return thread
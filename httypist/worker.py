@@ -1,23 +1,136 @@
 #!/usr/bin/env python
 import sys
-from rq import Connection, Worker
-from rq import Queue
+import os
+import time
+import signal
+import contextlib
+import logging
+import multiprocessing
+import rq
 from redis import Redis
 
 # Preload libraries
 from . import processor
+from . import queues
+from . import events
+from . import callbacks
+from . import ratelimit
+from . import autoscale
 
+logger = logging.getLogger(__name__)
 
-redis_conn = Redis(host="localhost")
+# the same redis as the server, see REDIS_URL
+redis_conn = Redis.from_url(os.getenv("REDIS_URL", "redis://localhost"))
+
+
+class Worker(
+    ratelimit.QuotaMixin, events.NotifyingMixin, queues.WeightedMixin, rq.Worker
+):
+    pass
+
+
+class SimpleWorker(
+    ratelimit.QuotaMixin, events.NotifyingMixin, queues.WeightedMixin, rq.SimpleWorker
+):
+    pass
+
+
+def create_worker(worker_class, args):
+    """A worker for queue arguments like `fast:3 process:1`"""
+    weights = queues.parse_weights(args)
+    w = worker_class(queues.expand(weights), connection=redis_conn)
+    w.weights = weights
+    w.reorder_queues()
+    return w
+
+
+def work(args, max_jobs=None):
+    """Run jobs in this process, without forking, so caches stay warm"""
+    w = create_worker(SimpleWorker, args)
+    w.work(with_scheduler=True, max_jobs=max_jobs)
 
-def main():
-    # Provide queue names to listen to as arguments to this script,
-    # similar to rq worker
-    with Connection():
-        qs = sys.argv[1:] or ['process']
 
-        w = Worker(qs)
-        w.work(with_scheduler=True)
+def pool(args, size, max_jobs=None, maximum=None):
+    """Keep `size` long lived worker processes running.
+
+    With a `maximum` the number of processes follows the load between both
+    (see autoscale.Autoscaler). Children exit after `max_jobs` jobs and are
+    replaced. Surplus children get a SIGTERM, like all of them on SIGTERM,
+    they finish their current job before exiting. SIGINT reaches the children
+    through the process group already.
+    """
+    children = {}
+    retiring = set()
+    stopping = False
+    target = size
+    scaler = None
+    if maximum is not None and maximum > size:
+        scaler = autoscale.Autoscaler(
+            redis_conn, queues.expand(queues.parse_weights(args)), size, maximum
+        )
+    next_check = 0
+
+    def spawn():
+        process = multiprocessing.Process(target=work, args=(args, max_jobs))
+        process.start()
+        children[process.pid] = process
+        logger.info(f"started worker process {process.pid}")
+
+    def retire(pid):
+        retiring.add(pid)
+        logger.info(f"stopping worker process {pid} after its current job")
+        with contextlib.suppress(ProcessLookupError):
+            os.kill(pid, signal.SIGTERM)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        logger.info("shutting down worker pool")
+        if signum == signal.SIGTERM:
+            for process in children.values():
+                with contextlib.suppress(ProcessLookupError):
+                    os.kill(process.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while children or not stopping:
+        for pid, process in list(children.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            del children[pid]
+            retiring.discard(pid)
+            logger.info(f"worker process {pid} exited ({process.exitcode})")
+        if not stopping:
+            active = [pid for pid in children if pid not in retiring]
+            if scaler is not None and time.monotonic() >= next_check:
+                target = scaler.decide(len(active), active)
+                next_check = time.monotonic() + autoscale.INTERVAL
+            for _ in range(target - len(active)):
+                spawn()
+            # the newest processes are stopped first
+            for pid in active[target:]:
+                retire(pid)
+        time.sleep(0.5)
+    if scaler is not None:
+        scaler.remove()
+
+
+def main(pool_size=None, max_jobs=None, max_workers=None):
+    # Provide queue names to listen to as arguments to this script,
+    # similar to rq worker, optionally with a weight: fast:3 process:1
+    # without arguments the jobs and the callbacks they enqueue are run
+    args = sys.argv[1:] or [queues.DEFAULT_QUEUE, callbacks.CALLBACK_QUEUE]
+    if max_workers is not None:
+        minimum = pool_size if pool_size is not None else 1
+        pool(args, minimum, max_jobs, autoscale.get_maximum(max_workers))
+        return
+    if pool_size:
+        pool(args, pool_size, max_jobs)
+        return
+    w = create_worker(Worker, args)
+    w.work(with_scheduler=True, max_jobs=max_jobs)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,94 @@
+import errno
+import logging
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# ioctl to clone a file on copy on write file systems (btrfs, xfs, ...)
+FICLONE = 0x40049409
+DEFAULT_STRATEGY = "reflink"
+
+# (method, source device, target device) known to fail, so we do not try
+# again for every file
+_unsupported = set()
+_unsupported_errors = {
+    errno.EXDEV,
+    errno.EPERM,
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+    errno.EINVAL,
+    errno.ENOSYS,
+}
+
+
+def reflink(src, dst):
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, "reflink not supported")
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.unlink(dst)
+            raise
+    shutil.copystat(src, dst)
+
+
+def hardlink(src, dst):
+    os.link(src, dst)
+
+
+def _try(method, src, dst):
+    key = (method.__name__, os.stat(src).st_dev, os.stat(os.path.dirname(dst)).st_dev)
+    if key in _unsupported:
+        return False
+    try:
+        method(src, dst)
+        return True
+    except OSError as e:
+        if e.errno in _unsupported_errors:
+            logger.info(f"{method.__name__} not possible for {key[1:]}: {e}")
+            _unsupported.add(key)
+        return False
+
+
+def link_or_copy(src, dst):
+    """Share the data of src: reflink, hardlink or, if both fail, copy"""
+    if not (_try(reflink, src, dst) or _try(hardlink, src, dst)):
+        shutil.copy2(src, dst)
+    return dst
+
+
+def reflink_or_copy(src, dst):
+    if not _try(reflink, src, dst):
+        shutil.copy2(src, dst)
+    return dst
+
+
+STRATEGIES = {
+    "link": link_or_copy,
+    "reflink": reflink_or_copy,
+    "copy": shutil.copy2,
+}
+
+
+def get_copy_function(config):
+    """Return the function to put the auxiliary files into the workspace.
+
+    `workspace: reflink` (default) shares the data with the snapshot of the
+    repository where the file system supports copy on write and copies the
+    files otherwise. `workspace: link` falls back to hardlinks, which is
+    only safe for templates never modifying an auxiliary file in place, a
+    write would change the snapshot for all later jobs.
+    """
+    strategy = config.get("workspace", DEFAULT_STRATEGY)
+    try:
+        return STRATEGIES[strategy]
+    except KeyError:
+        raise ValueError(f"unknown workspace strategy {strategy}")
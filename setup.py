@@ -9,9 +9,11 @@ setuptools.setup(
     version="0.1",
     packages=["httypist",],
     license="MIT",
-    install_requires=["fastapi", "redis", "requests", "rq"],
+    install_requires=["fastapi", "python-multipart", "redis", "requests", "rq"],
     extras_require={
-        'test':['httpx', 'pytest-asyncio'],
+        'test':['httpx', 'pytest-asyncio', 'fakeredis[lua]', 'moto[s3]'],
+        's3':['boto3'],
+        'bench':['httpx', 'fakeredis'],
     },
     long_description=open(os.path.join(root, "README.md")).read(),
 )
@@ -0,0 +1,9 @@
+import pytest
+from httypist import storage
+
+
+@pytest.fixture(autouse=True)
+def store(tmp_path, monkeypatch):
+    store = storage.LocalStore(tmp_path / "store")
+    monkeypatch.setattr(storage, "_store", store)
+    return store
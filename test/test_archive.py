@@ -0,0 +1,32 @@
+import io
+import zipfile
+import pytest
+from httypist import archive
+
+
+@pytest.fixture
+def folder(tmp_path):
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "image.png").write_bytes(bytes(range(256)) * 1000)
+    (tmp_path / "main.tex").write_text("\\documentclass{article}")
+    return tmp_path
+
+
+def test__get_compression():
+    assert archive.get_compression({}) == zipfile.ZIP_DEFLATED
+    assert archive.get_compression({"output": {"compression": "store"}}) == zipfile.ZIP_STORED
+    assert archive.get_compression({"output": {"compression": "LZMA"}}) == zipfile.ZIP_LZMA
+    with pytest.raises(ValueError):
+        archive.get_compression({"output": {"compression": "rar"}})
+
+
+@pytest.mark.parametrize("compression", list(archive.COMPRESSION.values()))
+def test__stream_zip(folder, compression):
+    data = b"".join(
+        archive.stream_zip(archive.iter_folder(folder), compression, chunk_size=1024)
+    )
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.testzip() is None
+        assert zf.read("main.tex") == b"\\documentclass{article}"
+        assert zf.read("sub/image.png") == bytes(range(256)) * 1000
+        assert zf.getinfo("main.tex").compress_type == compression
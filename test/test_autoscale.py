@@ -0,0 +1,43 @@
+import fakeredis
+import pytest
+from rq import Queue
+from httypist import autoscale
+from httypist import metrics
+
+
+@pytest.fixture
+def scaler():
+    return autoscale.Autoscaler(fakeredis.FakeRedis(), ["process"], 1, 4)
+
+
+def test__wanted(scaler, monkeypatch):
+    monkeypatch.setattr(autoscale, "TARGET_SECONDS", 30)
+    observation = dict(depth=0, oldest=0, busy=0, job_seconds=10)
+    assert scaler.wanted(3, observation) == 1
+    # 6 queued jobs of 10s need 2 more workers to be done in 30s, 1 is busy
+    assert scaler.wanted(1, dict(observation, depth=6, busy=1)) == 3
+    assert scaler.wanted(1, dict(observation, depth=100)) == 4
+    assert scaler.wanted(2, dict(observation, depth=1, job_seconds=1, oldest=60)) == 3
+
+
+def test__decide(scaler, monkeypatch):
+    monkeypatch.setattr(autoscale, "DOWN_DELAY", 60)
+    queue = Queue("process", connection=scaler.connection)
+    for _ in range(90):
+        queue.enqueue("builtins.dict")
+    assert scaler.decide(1, now=0) == 3
+    queue.empty()
+    assert scaler.decide(3, now=10) == 3
+    assert scaler.decide(3, now=69) == 3
+    assert scaler.decide(3, now=70) == 1
+    counters, _ = metrics.load(scaler.connection)
+    assert counters[("autoscale_events", (("direction", "up"),))] == 1
+    assert counters[("autoscale_events", (("direction", "down"),))] == 1
+    assert list(autoscale.load(scaler.connection).values())[0]["target"] == 1
+    scaler.remove()
+    assert autoscale.load(scaler.connection) == {}
+
+
+def test__maximum():
+    assert autoscale.get_maximum("3") == 3
+    assert autoscale.get_maximum("auto") >= 1
@@ -0,0 +1,28 @@
+import io
+import pytest
+from httypist import batch
+
+
+def records(body):
+    return list(batch.parse_records(io.BytesIO(body)))
+
+
+def test__parse_records():
+    assert records(b'[{"a": 1}, {"a": 2}]') == [{"a": 1}, {"a": 2}]
+    assert records(b'{"a": 1}\n\n{"a": 2}\n') == [{"a": 1}, {"a": 2}]
+    assert records(b'{\n  "a": 1\n}\n') == [{"a": 1}]
+    assert records(b"") == []
+    with pytest.raises(batch.BatchError):
+        records(b'{"a": 1}\n{"a": \n')
+    with pytest.raises(batch.BatchError):
+        records(b'[{"a": 1}')
+
+
+def test__records_are_stored_in_chunks(store):
+    template = dict(name="t", config={"batch_chunk_size": 2})
+    body = io.BytesIO(b"".join(b'{"n": %d}\n' % i for i in range(5)))
+    chunks = batch.store_records(body, template, "b1")
+    assert [(offset, count) for offset, count, _ in chunks] == [(0, 2), (2, 2), (4, 1)]
+    assert store.open(chunks[1][2]).read() == b'{"n": 2}\n{"n": 3}\n'
+    with pytest.raises(batch.BatchError, match="no records"):
+        batch.store_records(io.BytesIO(b"\n"), template, "b2")
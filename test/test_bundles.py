@@ -0,0 +1,66 @@
+import os
+import pytest
+from httypist import bundles
+from httypist import processor
+
+
+@pytest.fixture
+def folder(tmp_path):
+    path = tmp_path / "letter"
+    (path / "assets").mkdir(parents=True)
+    (path / "letter.txt.jinja").write_text("Dear {{ json.name }}")
+    (path / "assets" / "logo.png").write_bytes(b"png")
+    return path
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(bundles, "CACHE_DIR", str(tmp_path / "bundles"))
+    return tmp_path / "bundles"
+
+
+def test__bundle_is_content_addressed(folder, tmp_path):
+    _, digest = bundles.pack(folder)
+    os.utime(folder / "letter.txt.jinja", (0, 0))
+    copy = tmp_path / "copy"
+    copy.mkdir()
+    (copy / "assets").mkdir()
+    (copy / "letter.txt.jinja").write_text("Dear {{ json.name }}")
+    (copy / "assets" / "logo.png").write_bytes(b"png")
+    assert bundles.pack(copy)[1] == digest
+    (copy / "assets" / "logo.png").write_bytes(b"gif")
+    assert bundles.pack(copy)[1] != digest
+
+
+def test__worker_fetches_bundle(folder, cache, store):
+    template = dict(name="letter", path=str(folder), commit="abc", config={})
+    bundles.publish([template])
+    assert store.stat(bundles.bundle_key(template["bundle"])) is not None
+    assert bundles.localize(template) is template
+    remote = dict(template, path="/elsewhere/letter")
+    local = bundles.localize(remote)
+    assert local["path"] == str(cache / template["bundle"])
+    assert (cache / template["bundle"] / "assets" / "logo.png").read_bytes() == b"png"
+    t = processor.Template(remote, dict(json=dict(name="Anna")))
+    t.prepare_files()
+    t.process_template_files()
+    assert (t.tempdir / "letter.txt").read_text() == "Dear Anna"
+
+
+def test__corrupt_bundle_is_refused(folder, cache, store):
+    template = dict(name="letter", path=str(folder), commit="abc", config={})
+    bundles.publish([template])
+    store.put(bundles.bundle_key(template["bundle"]), str(folder / "letter.txt.jinja"))
+    with pytest.raises(bundles.BundleError):
+        bundles.fetch(template["bundle"])
+    assert not any(cache.iterdir())
+
+
+def test__least_recently_used_bundles_are_evicted(cache, monkeypatch):
+    monkeypatch.setattr(bundles, "MIN_AGE", 0)
+    for i, name in enumerate(("old", "new")):
+        (cache / name).mkdir(parents=True)
+        (cache / name / "file").write_bytes(b"x" * 10)
+        os.utime(cache / name, (i, i))
+    bundles.evict(size=15)
+    assert sorted(p.name for p in cache.iterdir()) == ["new"]
@@ -0,0 +1,67 @@
+import email.parser
+import io
+import http.server
+import threading
+import pytest
+from httypist import callbacks
+
+
+@pytest.fixture
+def files(store):
+    store.put("jobs/1/vertrag.pdf", io.BytesIO(b"%PDF" + bytes(range(256)) * 500))
+    store.put("jobs/1/info.txt", io.BytesIO(b"hello"))
+    return [("pdf", "jobs/1/vertrag.pdf"), ("info", "jobs/1/info.txt")]
+
+
+@pytest.fixture
+def endpoint():
+    received = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            length = int(self.headers["Content-Length"])
+            received.append((self.path, dict(self.headers), self.rfile.read(length)))
+            status = 503 if self.path == "/fail" else 200
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}", received
+    server.shutdown()
+
+
+def test__multipart_stream(files):
+    stream = callbacks.MultipartStream(files)
+    body = b"".join(stream)
+    assert len(body) == len(stream)
+    message = email.parser.BytesParser().parsebytes(
+        f"Content-Type: {stream.content_type}\r\n\r\n".encode() + body
+    )
+    parts = message.get_payload()
+    assert [p.get_param("name", header="content-disposition") for p in parts] == ["pdf", "info"]
+    assert parts[0].get_filename() == "vertrag.pdf"
+    assert parts[1].get_payload(decode=True) == b"hello"
+
+
+def test__deliver(files, endpoint):
+    url, received = endpoint
+    callback = dict(name="cb", method="post", url=f"{url}/ok", headers={"x-test": "1"}, files=files)
+    assert callbacks.deliver(callback) == 200
+    path, headers, body = received[0]
+    assert path == "/ok"
+    assert headers["x-test"] == "1"
+    assert headers["Content-Length"] == str(len(body))
+    with pytest.raises(callbacks.CallbackError):
+        callbacks.deliver(dict(callback, url=f"{url}/fail", files=[]))
+
+
+def test__missing_file(files):
+    with pytest.raises(callbacks.CallbackError):
+        callbacks.MultipartStream(files + [("gone", "jobs/1/gone.txt")])
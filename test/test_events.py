@@ -0,0 +1,26 @@
+import asyncio
+import time
+from httypist import events
+
+
+def test__subscribe_does_not_block_the_loop(monkeypatch):
+    hub = events.Hub()
+    monkeypatch.setattr(hub, "start", lambda connection: time.sleep(0.5))
+    ticks = []
+
+    async def tick():
+        while True:
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.05)
+
+    async def main():
+        ticker = asyncio.create_task(tick())
+        async with hub.subscribe(None, "job") as queue:
+            hub.dispatch(dict(job="job", state="finished"))
+            event = await asyncio.wait_for(queue.get(), 1)
+        ticker.cancel()
+        return event
+
+    assert asyncio.run(main())["state"] == "finished"
+    assert len(ticks) >= 5
+    assert hub.waiters == {}
@@ -0,0 +1,38 @@
+import pytest
+from httypist import ingest
+
+
+def test__safe_filename():
+    assert ingest.safe_filename("../../etc/passwd", "x") == "passwd"
+    assert ingest.safe_filename("C:\\temp\\a.pdf", "x") == "a.pdf"
+    assert ingest.safe_filename("..", "x") == "x"
+    assert ingest.safe_filename(None, "x") == "x"
+
+
+def test__small_body_is_inlined():
+    payload = ingest.Payload(headers={}, query={}, client="::1")
+    payload.write(b'{"name": "World"}')
+    data = payload.job_data()
+    assert data["body"] == b'{"name": "World"}'
+    assert "json" not in data and "body_ref" not in data
+    assert ingest.resolve(data)["json"] == {"name": "World"}
+
+
+def test__large_body_is_stored(store, monkeypatch):
+    monkeypatch.setattr(ingest, "INLINE_SIZE", 4)
+    payload = ingest.Payload(headers={}, query={}, client="::1")
+    payload.write(b'{"name": ')
+    payload.write(b'"World"}')
+    data = payload.job_data()
+    assert data["body"] == b""
+    assert store.open(data["body_ref"]).read() == b'{"name": "World"}'
+    resolved = ingest.resolve(data)
+    assert resolved["json"] == {"name": "World"}
+    assert "body_ref" not in resolved
+
+
+def test__body_size_limit(monkeypatch):
+    monkeypatch.setattr(ingest, "MAX_BODY_SIZE", 4)
+    payload = ingest.Payload(headers={}, query={}, client="::1")
+    with pytest.raises(ingest.PayloadTooLarge):
+        payload.write(b"12345")
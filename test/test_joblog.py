@@ -0,0 +1,62 @@
+import logging
+import time
+import types
+import fakeredis
+from httypist import joblog
+
+parent = logging.getLogger("httypist.processor")
+
+
+def test__handlers_are_removed():
+    handlers = list(parent.handlers)
+    first, second = joblog.JobLog(parent), joblog.JobLog(parent)
+    first.logger.info("first")
+    second.logger.info("second")
+    assert b"first" in first.getvalue() and b"second" not in first.getvalue()
+    first.close()
+    second.close()
+    assert parent.handlers == handlers
+    assert first.logger.handlers == []
+
+
+def test__large_log_is_spilled_and_capped(monkeypatch):
+    monkeypatch.setattr(joblog, "MEMORY_SIZE", 100)
+    monkeypatch.setattr(joblog, "MAX_SIZE", 1000)
+    monkeypatch.setattr(joblog, "TAIL_LINES", 3)
+    log = joblog.JobLog(parent)
+    for i in range(100):
+        log.logger.info(f"line {i}")
+    assert log.file._rolled
+    value = log.getvalue()
+    assert len(value) < 1200
+    assert b"line 0\n" in value
+    assert b"lines dropped" in value
+    assert [l.split(b" ")[-1] for l in value.splitlines()[-3:]] == [b"97", b"98", b"99"]
+    log.close()
+
+
+def test__running_log_is_tailed(monkeypatch):
+    monkeypatch.setattr(joblog, "FLUSH_SECONDS", 60)
+    job = types.SimpleNamespace(id="abc", connection=fakeredis.FakeRedis())
+    log = joblog.JobLog(parent, job)
+    log.logger.info("one")
+    log.logger.info("two")
+    assert joblog.read_tail(job.connection, "abc") == ([], 0)
+    log.flush()
+    lines, seen = joblog.read_tail(job.connection, "abc")
+    assert [l.split(b" ")[-1] for l in lines] == [b"one\n", b"two\n"]
+    log.logger.info("three")
+    log.close()
+    lines, seen = joblog.read_tail(job.connection, "abc", seen)
+    assert (len(lines), seen) == (1, 3)
+
+
+def test__pending_lines_are_pushed_on_a_timer(monkeypatch):
+    monkeypatch.setattr(joblog, "FLUSH_SECONDS", 0.05)
+    job = types.SimpleNamespace(id="abc", connection=fakeredis.FakeRedis())
+    log = joblog.JobLog(parent, job)
+    log.logger.info("before a long latex run")
+    time.sleep(0.3)
+    lines, seen = joblog.read_tail(job.connection, "abc")
+    assert seen == 1
+    log.close()
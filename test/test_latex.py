@@ -0,0 +1,77 @@
+import os
+import sys
+import pytest
+from httypist import latex
+
+
+@pytest.fixture
+def template(tmp_path, monkeypatch):
+    monkeypatch.setattr(latex, "CACHE_DIR", str(tmp_path / "cache"))
+    path = tmp_path / "letter"
+    path.mkdir()
+    (path / "preamble.tex").write_text("\\documentclass{article}\n")
+    # stands in for the tex engine, it dumps a format and counts the runs
+    engine = tmp_path / "fakelatex"
+    engine.write_text(
+        f"#!{sys.executable}\n"
+        "import pathlib, sys\n"
+        "args = dict(a[1:].split('=', 1) for a in sys.argv[1:] if '=' in a)\n"
+        "out = pathlib.Path(args['output-directory'])\n"
+        "(out / (args['jobname'] + '.fmt')).write_text('format')\n"
+        "runs = out.parent / 'runs'\n"
+        "runs.write_text(str(int(runs.read_text()) + 1 if runs.exists() else 1))\n"
+    )
+    engine.chmod(0o755)
+    config = {"latex": {"engine": str(engine), "format": "preamble.tex"}}
+    return dict(name="letter", path=str(path), commit="abc", config=config)
+
+
+def test__format_is_built_once(template):
+    fmt = latex.ensure_format(template)
+    assert fmt.read_text() == "format"
+    assert fmt.name == "preamble.fmt"
+    assert latex.ensure_format(template) == fmt
+    assert (fmt.parent / "runs").read_text() == "1"
+    assert latex.ensure_format(dict(template, commit=None)) is None
+
+
+def test__failed_format_is_not_retried(template):
+    template["config"]["latex"]["engine"] = "false"
+    assert latex.ensure_format(template) is None
+    assert latex.ensure_format(template) is None
+    assert (latex.cache_dir(template) / "preamble.failed").exists()
+
+
+def test__interrupted_format_is_retried(template):
+    template["config"]["latex"]["engine"] = "/nonexistent/latex"
+    assert latex.ensure_format(template) is None
+    assert not (latex.cache_dir(template) / "preamble.failed").exists()
+
+
+def test__build_formats_removes_old_versions(template, tmp_path, monkeypatch):
+    from httypist import repo
+    monkeypatch.setattr(repo, "SNAPSHOT_DIR", str(tmp_path / "snapshots"))
+    monkeypatch.setattr(repo, "SNAPSHOT_KEEP", 2)
+    (tmp_path / "snapshots" / "retained").mkdir(parents=True)
+    for commit in ("retained", "old", "older"):
+        latex.ensure_format(dict(template, commit=commit))
+    base = latex.cache_dir(template).parent
+    os.utime(base / "older", (0, 0))
+    os.utime(base / "retained", (0, 0))
+    latex.build_formats([template])
+    assert sorted(p.name for p in base.iterdir() if p.is_dir()) == ["abc", "old", "retained"]
+
+
+def test__aux_files_are_kept(template, tmp_path):
+    options = latex.get_options(template["config"])
+    first = tmp_path / "first"
+    first.mkdir()
+    (first / "doc.aux").write_text("\\relax")
+    (first / "doc.pdf").write_text("pdf")
+    latex.save(template, first, options)
+    second = tmp_path / "second"
+    second.mkdir()
+    latex.restore(template, second, options)
+    assert sorted(p.name for p in second.iterdir()) == ["doc.aux", "preamble.fmt"]
+    # the restored aux file is a copy, latex may write it
+    assert not os.path.samefile(second / "doc.aux", latex.cache_dir(template) / "aux" / "doc.aux")
@@ -0,0 +1,35 @@
+import fakeredis
+from httypist import metrics
+
+
+def test__flush_and_load():
+    connection = fakeredis.FakeRedis()
+    metrics.reset()
+    metrics.inc("jobs", template="a", state="finished")
+    metrics.observe("job_seconds", 0.2, template="a")
+    metrics.observe("job_seconds", 20, template="a")
+    metrics.flush(connection)
+    assert not metrics.counters and not metrics.histograms
+    metrics.inc("jobs", template="a", state="finished")
+    metrics.flush(connection)
+    counters, histograms = metrics.load(connection)
+    assert counters[("jobs", (("state", "finished"), ("template", "a")))] == 2
+    histogram = histograms[("job_seconds", (("template", "a"),))]
+    assert histogram.count == 2
+    assert histogram.buckets[metrics.BUCKETS.index(0.5)] == 1
+    assert histogram.buckets[metrics.BUCKETS.index(30)] == 2
+
+
+def test__render():
+    metrics.reset()
+    metrics.inc("result_cache", result="hit", template="a")
+    metrics.inc("result_cache", result="miss", template="a")
+    metrics.observe("selector_seconds", 0.002)
+    counters = dict(metrics.counters)
+    text = metrics.render(counters, dict(metrics.histograms), metrics.hit_ratios(counters))
+    assert '# TYPE httypist_result_cache_total counter' in text
+    assert 'httypist_result_cache_total{result="hit",template="a"} 1' in text
+    assert 'httypist_result_cache_hit_ratio{template="a"} 0.5' in text
+    assert 'httypist_selector_seconds_bucket{le="0.001"} 0' in text
+    assert 'httypist_selector_seconds_bucket{le="+Inf"} 1' in text
+    assert 'httypist_selector_seconds_count 1' in text
@@ -0,0 +1,79 @@
+import logging
+import pytest
+import time
+from httypist import post
+
+logger = logging.getLogger(__name__)
+
+
+def config(commands, **kwargs):
+    return dict(post={"txt": {"commands": commands}}, **kwargs)
+
+
+def test__commands_keep_order_by_default():
+    commands = post.build_commands(
+        [("a.txt", "txt")], config({"one": "touch one", "two": "touch two"})
+    )
+    assert [c.after for c in commands] == [[], ["a.txt:one"]]
+
+
+def test__independent_commands_run_in_parallel(tmp_path):
+    commands = post.build_commands(
+        [("a.txt", "txt"), ("b.txt", "txt")],
+        config({"sleep": "sleep 0.5", "done": {"command": "touch done", "after": "b.txt:sleep"}}),
+    )
+    start = time.perf_counter()
+    failed, skipped = post.run(commands, tmp_path, 4, logger)
+    assert time.perf_counter() - start < 1
+    assert (failed, skipped) == ([], [])
+    assert (tmp_path / "done").exists()
+    assert all(c.duration is not None for c in commands)
+
+
+def test__failed_command_skips_dependents(tmp_path):
+    commands = post.build_commands(
+        [("a.txt", "txt")],
+        config({
+            "fail": "false",
+            "after": "touch after",
+            "independent": {"command": "touch independent", "after": []},
+            "slow": {"command": "sleep 5", "after": [], "timeout": 0.1},
+        }),
+    )
+    failed, skipped = post.run(commands, tmp_path, 2, logger)
+    assert sorted(failed) == ["a.txt:fail", "a.txt:slow"]
+    assert skipped == ["a.txt:after"]
+    assert (tmp_path / "independent").exists()
+    assert not (tmp_path / "after").exists()
+
+
+def test__passes_until_stable(tmp_path):
+    # the aux file changes in the first two runs only
+    (tmp_path / "pass.py").write_text(
+        "import pathlib\n"
+        "p = pathlib.Path('count')\n"
+        "n = int(p.read_text()) + 1 if p.exists() else 1\n"
+        "p.write_text(str(n))\n"
+        "pathlib.Path('doc.aux').write_text(str(min(n, 2)))\n"
+    )
+    spec = {"command": "python pass.py", "passes": 5, "stable": "*.aux"}
+    commands = post.build_commands([("doc.txt", "txt")], config({"latex": spec}))
+    assert post.run(commands, tmp_path, 1, logger) == ([], [])
+    assert commands[0].runs == 3
+    commands = post.build_commands(
+        [("doc.txt", "txt")], config({"latex": dict(spec, passes=1)})
+    )
+    post.run(commands, tmp_path, 1, logger)
+    assert commands[0].runs == 1
+
+
+def test__passes_have_to_run_once():
+    with pytest.raises(ValueError):
+        post.build_commands([("doc.txt", "txt")], config({"latex": {"command": "true", "passes": 0}}))
+
+
+def test__parallelism(monkeypatch):
+    monkeypatch.setattr(post, "MAX_PARALLELISM", 4)
+    assert post.get_parallelism({}) == 1
+    assert post.get_parallelism({"post_parallelism": 2}) == 2
+    assert post.get_parallelism({"post_parallelism": 16}) == 4
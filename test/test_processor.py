@@ -0,0 +1,173 @@
+import pytest
+import pathlib
+import zipfile
+from httypist import processor
+
+
+@pytest.fixture
+def template(tmp_path):
+    (tmp_path / "hello.txt.jinja").write_text("Hello {{ json.name }}")
+    return dict(name="hello", path=str(tmp_path), commit="abc", config={})
+
+
+def test__environment_is_cached(template):
+    env = processor.get_environment(template)
+    assert processor.get_environment(template) is env
+    assert processor.get_environment(template, {"trim_blocks": True}) is not env
+    assert processor.get_environment(dict(template, commit="def")) is not env
+
+
+def test__environment_cache_is_bounded(template, monkeypatch):
+    monkeypatch.setattr(processor, "ENVIRONMENT_CACHE_SIZE", 2)
+    processor.clear_environments()
+    for commit in ("a", "b", "c"):
+        processor.get_environment(dict(template, commit=commit))
+    assert len(processor._environments) == 2
+
+
+def test__render_template_files(template):
+    t = processor.Template(template, dict(json=dict(name="World")))
+    t.prepare_files()
+    t.process_template_files()
+    assert (t.tempdir / "hello.txt").read_text() == "Hello World"
+
+
+def test__temp_zip_has_the_stored_workspace_files(template, store):
+    (pathlib.Path(template["path"]) / "logo.png").write_bytes(b"png")
+    template["config"] = {"output": {"files": ["hello.txt"]}}
+    t = processor.Template(template, dict(json=dict(name="World")))
+    t.prepare_files()
+    t.process_template_files()
+    t.pack_result()
+    t.upload_results()
+    stored = sorted(a.name for a in store.list(f"{t.artifacts}/workspace"))
+    assert stored == ["hello.txt", "logo.png"]
+    with zipfile.ZipFile(store.open(t.pack_temp())) as zf:
+        assert sorted(zf.namelist()) == stored
+
+
+def test__temp_zip_is_packed_on_demand(template, store):
+    template["config"] = {"output": {"files": ["hello.txt"], "compression": "store"}}
+    t = processor.Template(template, dict(json=dict(name="World")))
+    t.prepare_files()
+    t.process_template_files()
+    t.pack_result()
+    assert (t.resultdir / "result.zip").exists()
+    assert not (t.resultdir / "temp.zip").exists()
+    assert store.stat(t.pack_temp()) is not None
+
+
+def test__artifacts_are_stored(template, store, tmp_path, monkeypatch):
+    monkeypatch.setattr(processor, "WORK_DIR", str(tmp_path))
+    (pathlib.Path(template["path"]) / "asset.txt").write_text("asset")
+    template["config"] = {"output": {"files": ["hello.txt"], "workspace": "generated"}}
+    result = processor.process_template(template, dict(json=dict(name="World")))
+    keys = [a.key[len(result["artifacts"]) + 1 :] for a in store.list(result["artifacts"])]
+    assert sorted(keys) == ["log.txt", "result.zip", "workspace/hello.txt"]
+    assert not any(tmp_path.glob("result_hello_*"))
+
+
+def test__process_template_records_stage_timings(template):
+    template["config"] = {"output": {"files": ["hello.txt"]}}
+    result = processor.process_template(template, dict(json=dict(name="World")))
+    assert [t["stage"] for t in result["timings"]] == [
+        "prepare_files", "render", "post", "pack", "upload", "callbacks"
+    ]
+    assert all(t["duration"] >= 0 for t in result["timings"])
+
+
+def test__rendered_file_does_not_write_through_links(template):
+    path = pathlib.Path(template["path"])
+    (path / "hello.txt").write_text("asset")
+    t = processor.Template(template, dict(json=dict(name="World")))
+    t.prepare_files()
+    t.process_template_files()
+    assert (t.tempdir / "hello.txt").read_text() == "Hello World"
+    assert (path / "hello.txt").read_text() == "asset"
+
+
+def test__render_sync(template):
+    assert not processor.can_render_sync(template)
+    template["config"] = {"sync": True}
+    assert processor.can_render_sync(template)
+    assert not processor.can_render_sync(dict(template, config={"sync": True, "post": {}}))
+    files = processor.render_sync(template, dict(json=dict(name="World")))
+    assert files == {"hello.txt": b"Hello World"}
+
+
+def test__render_limits(template):
+    path = pathlib.Path(template["path"])
+    (path / "hello.txt.jinja").write_text("{% for i in range(100000) %}line {{ i }}\n{% endfor %}")
+    template["config"] = {"render": {"max_size": 1000}}
+    t = processor.Template(template, dict(json={}))
+    t.prepare_files()
+    with pytest.raises(processor.RenderLimitExceeded, match="larger than 1000 bytes"):
+        t.process_template_files()
+    assert not (t.tempdir / "hello.txt").exists()
+    template["config"] = {"render": {"timeout": 0.0001}}
+    with pytest.raises(processor.RenderLimitExceeded, match="took longer"):
+        processor.render_sync(template, dict(json={}))
+    template["config"] = {}
+    assert len(processor.render_sync(template, dict(json={}))["hello.txt"]) > 500000
+
+
+def test__post_command_does_not_write_into_snapshot(template):
+    path = pathlib.Path(template["path"])
+    (path / "data.txt").write_text("asset")
+    template["config"] = {
+        "post": {"txt": {"commands": {"copy": "cp hello.txt data.txt"}}},
+        "output": {"files": ["data.txt"]},
+    }
+    processor.process_template(template, dict(json=dict(name="Eve")))
+    assert (path / "data.txt").read_text() == "asset"
+
+
+def test__incomplete_result_is_not_cached(template, store):
+    from httypist import resultcache
+    data = dict(json=dict(name="World"))
+    template["config"] = {
+        "cache": True,
+        "post": {"txt": {"commands": {"fail": "false"}}},
+        "output": {"files": ["hello.txt"]},
+    }
+    processor.process_template(template, data)
+    key = resultcache.key(template, data, resultcache.get_options(template))
+    assert resultcache.lookup(template, key) is None
+    template["config"] = {"cache": True, "output": {"files": ["hello.txt", "hello.pdf"]}}
+    processor.process_template(template, data)
+    key = resultcache.key(template, data, resultcache.get_options(template))
+    assert resultcache.lookup(template, key) is None
+    template["config"]["output"]["files"] = ["hello.txt"]
+    processor.process_template(template, data)
+    key = resultcache.key(template, data, resultcache.get_options(template))
+    assert resultcache.lookup(template, key) is not None
+
+
+def test__restored_aux_files_are_not_delivered(template, store, tmp_path_factory, monkeypatch):
+    from httypist import latex
+    monkeypatch.setattr(latex, "CACHE_DIR", str(tmp_path_factory.mktemp("cache")))
+    template["config"] = {
+        "latex": {"cache": True},
+        "post": {"txt": {"commands": {"aux": "cp hello.txt doc.aux"}}},
+        "output": {"files": ["hello.txt"]},
+    }
+    last = tmp_path_factory.mktemp("last")
+    (last / "doc.aux").write_text("Hello Eve")
+    (last / "other.aux").write_text("Eve's document")
+    latex.save(template, last, latex.get_options(template["config"]))
+    t = processor.Template(template, dict(json=dict(name="World")))
+    t.process()
+    stored = sorted(a.name for a in store.list(f"{t.artifacts}/workspace"))
+    assert stored == ["doc.aux", "hello.txt"]
+    with store.open(f"{t.artifacts}/workspace/doc.aux") as f:
+        assert f.read() == b"Hello World"
+
+
+def test__record_with_failed_post_step_is_failed(template, store):
+    template["config"] = {
+        "post": {"txt": {"commands": {"check": "grep -q World hello.txt"}}},
+        "output": {"files": ["hello.txt"]},
+    }
+    records = [dict(name="World"), dict(name="Bob"), dict(name="World")]
+    result = processor.process_batch(template, records, dict(json=None))
+    assert (result["records"], result["failed"]) == ([0, 2], [1])
@@ -0,0 +1,55 @@
+import fakeredis
+import pytest
+from rq import Queue
+from rq.registry import ScheduledJobRegistry
+from httypist import queues
+from httypist import worker
+
+
+@pytest.fixture
+def connection(monkeypatch):
+    connection = fakeredis.FakeRedis()
+    monkeypatch.setattr(worker, "redis_conn", connection)
+    return connection
+
+
+def test__queue_name():
+    template = dict(name="t", config={"queue": "fast", "priority": "high"})
+    assert queues.get_queue_name(template) == "fast.high"
+    assert queues.get_queue_name(template, "low") == "fast.low"
+    assert queues.get_queue_name(dict(name="t", config={})) == "process"
+    with pytest.raises(ValueError):
+        queues.queue_name("fast", "urgent")
+
+
+def test__weighted_order():
+    weights = queues.parse_weights(["fast:1000", "process:0.001"])
+    assert weights == {"fast": 1000.0, "process": 0.001}
+    assert queues.weighted_order(weights) == [
+        "fast.high", "process.high", "fast", "process", "fast.low", "process.low"
+    ]
+
+
+def test__concurrency_slots(connection):
+    template = dict(name="t", config={"concurrency": 2})
+    assert queues.acquire(connection, template, "a")
+    assert queues.acquire(connection, template, "b")
+    assert not queues.acquire(connection, template, "c")
+    assert queues.acquire(connection, template, "a")
+    queues.release(connection, template, "a")
+    assert queues.acquire(connection, template, "c")
+    assert queues.acquire(connection, dict(template, name="other"), "d", lease=-1)
+    assert queues.acquire(connection, dict(template, name="other"), "e", lease=-1)
+
+
+def test__job_is_deferred_at_the_limit(connection):
+    template = dict(name="t", config={"concurrency": 1})
+    queues.acquire(connection, template, "running")
+    job = Queue("process", connection=connection).enqueue("builtins.dict", template=template)
+    worker.create_worker(worker.SimpleWorker, ["process"]).work(burst=True)
+    assert job.id in ScheduledJobRegistry("process", connection=connection)
+    queues.release(connection, template, "running")
+    Queue("process", connection=connection).enqueue_job(job)
+    worker.create_worker(worker.SimpleWorker, ["process"]).work(burst=True)
+    assert job.get_status() == "finished"
+    assert connection.zcard("httypist:running:t") == 0
@@ -0,0 +1,48 @@
+import fakeredis
+import pytest
+from rq import Queue
+from httypist import ratelimit
+
+limits = dict(name="client", rate=1.0, burst=2.0, max_in_flight=2)
+
+
+def test__parse_limits():
+    assert ratelimit.parse_limits(dict(token="t", templates="*")) is None
+    parsed = ratelimit.parse_limits(dict(token="t", templates="*", rate=5, name="shop"))
+    assert parsed == dict(name="shop", rate=5.0, burst=5.0, max_in_flight=None)
+
+
+def test__token_bucket():
+    connection = fakeredis.FakeRedis()
+    ratelimit.take(connection, "secret", limits)
+    ratelimit.take(connection, "secret", limits)
+    with pytest.raises(ratelimit.RateLimited) as e:
+        ratelimit.take(connection, "secret", limits)
+    assert (e.value.reason, e.value.retry_after) == ("rate", 1)
+    ratelimit.take(connection, "other", limits)
+    assert not any(b"secret" in key for key in connection.keys())
+
+
+def test__in_flight_quota():
+    connection = fakeredis.FakeRedis()
+    key = ratelimit.reserve(connection, "secret", limits, ["a", "b"])
+    with pytest.raises(ratelimit.RateLimited):
+        ratelimit.reserve(connection, "secret", limits, ["c"])
+    assert ratelimit.in_flight(connection, "secret") == 2
+    ratelimit.release(connection, key, "a")
+    ratelimit.reserve(connection, "secret", limits, ["c"])
+    # all or nothing
+    with pytest.raises(ratelimit.RateLimited):
+        ratelimit.reserve(connection, "secret", limits, ["d", "e"])
+    assert ratelimit.in_flight(connection, "secret") == 2
+
+
+def test__queue_depth():
+    queue = Queue("process", connection=fakeredis.FakeRedis())
+    template = dict(name="t", config={"max_queue_depth": 1})
+    ratelimit.check_queue(queue, template)
+    queue.enqueue("builtins.dict")
+    with pytest.raises(ratelimit.RateLimited) as e:
+        ratelimit.check_queue(queue, template)
+    assert e.value.reason == "queue"
+    ratelimit.check_queue(queue, dict(name="t", config={}))
@@ -0,0 +1,89 @@
+import os
+import subprocess
+import pytest
+from httypist import registry
+from httypist import repo
+
+
+def git(cwd, *args):
+    subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@test", *args],
+        cwd=cwd,
+        check=True,
+        capture_output=True,
+    )
+
+
+@pytest.fixture
+def gitrepo(tmp_path, monkeypatch):
+    monkeypatch.setattr(repo, "SNAPSHOT_DIR", str(tmp_path / "snapshots"))
+    path = tmp_path / "repo"
+    for name in ("one", "two"):
+        (path / name).mkdir(parents=True)
+        (path / name / "config.yml").write_text(f'selector:\n  - json.type == "{name}"\n')
+        (path / name / "text.txt.jinja").write_text(name)
+    (path / "config.yml").write_text(
+        'access:\n  - token: "key"\n    templates: "*"\n    rate: 5\n'
+    )
+    git(path, "init", "-q")
+    git(path, "add", "-A")
+    git(path, "commit", "-q", "-m", "initial")
+    return path
+
+
+def test__load(gitrepo):
+    r = registry.load(gitrepo)
+    assert sorted(r.templates) == ["one", "two"]
+    assert r.authentication["key"] == ["*"]
+    assert r.selector_index.match(dict(json=dict(type="two"))) == ["two"]
+    template = r.templates["one"]
+    assert template["commit"] == r.commit
+    assert template["path"].startswith(repo.SNAPSHOT_DIR)
+
+
+def test__incremental_load(gitrepo):
+    old = registry.load(gitrepo)
+    (gitrepo / "two" / "config.yml").write_text('selector:\n  - json.type == "three"\n')
+    git(gitrepo, "commit", "-q", "-am", "change")
+    new = registry.load(gitrepo, old)
+    assert new.commit != old.commit
+    assert new.templates["one"]["config"] is old.templates["one"]["config"]
+    assert new.templates["two"]["config"]["selector"] == ['json.type == "three"']
+    # the old snapshot is still there for running jobs
+    assert (
+        open(os.path.join(old.templates["two"]["path"], "config.yml")).read()
+        != open(os.path.join(new.templates["two"]["path"], "config.yml")).read()
+    )
+    # unchanged files are hardlinked
+    old_file = os.path.join(old.templates["one"]["path"], "text.txt.jinja")
+    new_file = os.path.join(new.templates["one"]["path"], "text.txt.jinja")
+    assert os.stat(old_file).st_ino == os.stat(new_file).st_ino
+
+
+def test__no_commit_outside_of_checkout():
+    assert repo.get_commit(os.path.join(os.path.dirname(__file__), "testrepo")) is None
+
+
+def test__snapshot(gitrepo, tmp_path):
+    r = registry.load(gitrepo)
+    registry.save(r)
+    loaded = registry.load_snapshot()
+    assert loaded.commit == r.commit
+    assert loaded.templates == r.templates
+    assert loaded.authentication["key"] == ["*"]
+    assert loaded.authentication["unknown"] == []
+    assert loaded.limits["key"]["rate"] == 5
+    assert loaded.selector_index.match(dict(json=dict(type="one"))) == ["one"]
+
+
+def test__unusable_snapshot(gitrepo, monkeypatch):
+    import shutil
+    assert registry.load_snapshot() is None
+    r = registry.load(gitrepo)
+    registry.save(r)
+    monkeypatch.setattr(registry, "FORMAT_VERSION", 2)
+    assert registry.load_snapshot() is None
+    monkeypatch.undo()
+    monkeypatch.setattr(repo, "SNAPSHOT_DIR", str(gitrepo.parent / "snapshots"))
+    shutil.rmtree(r.templates["one"]["path"])
+    assert registry.load_snapshot() is None
@@ -0,0 +1,77 @@
+import os
+import time
+import pytest
+from httypist import resultcache
+from httypist import metrics
+
+
+@pytest.fixture
+def template(tmp_path):
+    return dict(name="t", path=str(tmp_path), commit="abc", config={"cache": True})
+
+
+def request(**kwargs):
+    data = dict(body=b'{"a": 1}', json={"a": 1}, headers={"x-id": "1"}, query={}, client="1.2.3.4")
+    data.update(kwargs)
+    return data
+
+
+def test__key_ignores_fields(template):
+    key = resultcache.key(template, request())
+    assert key == resultcache.key(template, request(headers={"x-id": "2"}, client="::1"))
+    assert key != resultcache.key(template, request(json={"a": 2}))
+    assert key != resultcache.key(dict(template, commit="def"), request())
+
+
+def test__store_and_lookup(template, tmp_path):
+    metrics.reset()
+    result = tmp_path / "result.zip"
+    result.write_bytes(b"zip")
+    key = resultcache.key(template, request())
+    assert resultcache.lookup(template, key) is None
+    resultcache.store(template, key, result)
+    assert resultcache.lookup(template, key).open().read() == b"zip"
+    assert resultcache.lookup(template, key, ttl=-1) is None
+    assert metrics.counters[("result_cache", (("result", "hit"), ("template", "t")))] == 1
+    assert metrics.counters[("result_cache", (("result", "miss"), ("template", "t")))] == 2
+
+
+def test__evict(template, store, tmp_path):
+    result = tmp_path / "result.zip"
+    result.write_bytes(b"x" * 100)
+    for age, name in ((100, "expired"), (20, "old"), (0, "new")):
+        resultcache.store(template, name, result)
+        mtime = time.time() - age
+        os.utime(store.root / "cache" / f"{name}.zip", (mtime, mtime))
+    resultcache.evict(max_size=150, max_age=50)
+    assert [a.key for a in store.list("cache/")] == ["cache/new.zip"]
+
+
+def test__key_of_stored_body(template):
+    import hashlib
+    inline = request(body=b"raw", json=None)
+    stored = request(body=b"", body_ref="uploads/1/body", json=None)
+    stored["digest"] = hashlib.sha256(b"raw").hexdigest()
+    assert resultcache.key(template, inline) == resultcache.key(template, stored)
+
+
+def test__store_does_not_list_the_cache(template, store, tmp_path, monkeypatch):
+    result = tmp_path / "result.zip"
+    result.write_bytes(b"zip")
+
+    def no_list(prefix=""):
+        raise AssertionError("the cache is listed by the sweeper only")
+
+    monkeypatch.setattr(store, "list", no_list)
+    resultcache.store(template, "key", result)
+
+
+def test__digest_of_templates_outside_of_git(tmp_path, monkeypatch):
+    from httypist import registry
+    (tmp_path / "letter").mkdir()
+    (tmp_path / "letter" / "letter.txt.jinja").write_text("Dear {{ json.name }}")
+    template = registry.load(tmp_path).templates["letter"]
+    assert template["commit"] is None
+    assert template["digest"] == resultcache.content_digest(tmp_path / "letter")
+    monkeypatch.setattr(resultcache, "content_digest", None)
+    assert resultcache.key(dict(template, config={"cache": True}), request())
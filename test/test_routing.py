@@ -0,0 +1,41 @@
+from httypist import routing
+from httypist import metrics
+
+
+def build_index():
+    index = routing.SelectorIndex()
+    index.add("invoice", 'json.type == "invoice"')
+    index.add("letter", "json.type == 'letter'")
+    index.add("number", "json.count == 3")
+    index.add("large", "json.count > 10")
+    index.add("broken", "json.type ==")
+    return index
+
+
+def test__equality_selector_is_indexed():
+    index = build_index()
+    assert ("json", "type") in index.equality
+    assert [name for name, _, _ in index.expressions] == ["large"]
+
+
+def test__match():
+    index = build_index()
+    assert index.match(dict(json=dict(type="invoice"))) == ["invoice"]
+    assert index.match(dict(json=dict(type="letter", count=3))) == ["letter", "number"]
+    assert index.match(dict(json=dict(count=11))) == ["large"]
+    assert index.match(dict(json=None)) == []
+    assert index.match(dict(json=[1, 2])) == []
+
+
+def test__missing_nested_value():
+    index = routing.SelectorIndex()
+    index.add("german", 'json.customer.country == "DE"')
+    assert index.match(dict(json=dict(customer=dict(country="DE")))) == ["german"]
+    assert index.match(dict(json=dict(type="invoice"))) == []
+    assert index.match(dict(json=None)) == []
+
+
+def test__selector_timing():
+    metrics.reset()
+    build_index().match(dict(json=dict(type="invoice")))
+    assert metrics.histograms[("selector_seconds", ())].count == 1
@@ -3,6 +3,10 @@ import shutil
 import os
 import tempfile
 import io
+import json
+import threading
+import time
+import zipfile
 from httypist import server
 from fastapi.testclient import TestClient
 
@@ -62,3 +66,284 @@ def test__index_post_with_invalid_mainfile(client):
 
 
 
+
+
+@pytest.fixture
+def queue(monkeypatch):
+    import fakeredis
+    from rq import Queue
+    q = Queue("process", connection=fakeredis.FakeRedis())
+    monkeypatch.setattr(server, "q", q)
+    monkeypatch.setattr(server, "redis_conn", q.connection)
+    return q
+
+
+def test__update_runs_in_background(client, monkeypatch):
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_update():
+        started.set()
+        release.wait(5)
+
+    monkeypatch.setattr(server.repo, "update", slow_update)
+    r = client.get("/update")
+    assert r.json()["result"] == "update triggered"
+    started.wait(5)
+    assert client.get("/update/status").json()["result"]["state"] == "running"
+    assert client.get("/update").json()["result"] == "update already running"
+    release.set()
+    for _ in range(50):
+        if server.update_state["state"] != "running":
+            break
+        time.sleep(0.1)
+    assert client.get("/update/status").json()["result"]["state"] == "finished"
+
+
+def test__status(client, queue):
+    job = queue.enqueue("os.getpid", template=dict(name="test"))
+    r = client.get(f"/status/{job.id}")
+    assert r.status_code == 200
+    assert r.json()["result"] == {"finished": False, "state": "queued", "progress": None}
+    assert client.get("/status/unknown").status_code == 404
+
+
+@pytest.fixture
+def run_jobs(queue, monkeypatch):
+    from httypist import events
+    from httypist import worker
+    monkeypatch.setattr(server, "redis_conn", queue.connection)
+    monkeypatch.setattr(server, "hub", events.Hub())
+    monkeypatch.setattr(worker, "redis_conn", queue.connection)
+    return lambda: worker.create_worker(worker.SimpleWorker, ["process"]).work(burst=True)
+
+
+def test__failed_job_is_finished(client, queue, run_jobs):
+    job = queue.enqueue("builtins.int", template=dict(name="test"))
+    run_jobs()
+    result = client.get(f"/status/{job.id}").json()["result"]
+    assert (result["finished"], result["state"]) == (True, "failed")
+
+
+def test__status_wait(client, queue, run_jobs):
+    job = queue.enqueue("builtins.dict", template=dict(name="test"))
+    responses = []
+    thread = threading.Thread(
+        target=lambda: responses.append(client.get(f"/status/{job.id}?wait=10"))
+    )
+    start = time.monotonic()
+    thread.start()
+    time.sleep(0.5)
+    run_jobs()
+    thread.join()
+    assert time.monotonic() - start < 5
+    assert responses[0].json()["result"]["state"] == "finished"
+
+
+def test__events(client, queue, run_jobs):
+    job = queue.enqueue("builtins.dict", template=dict(name="test"))
+    run_jobs()
+    with client.stream("GET", f"/events/{job.id}") as r:
+        assert r.headers["content-type"].startswith("text/event-stream")
+        lines = [line for line in r.iter_lines() if line.startswith("data: ")]
+    assert json.loads(lines[-1][6:])["state"] == "finished"
+    with client.websocket_connect(f"/ws/{job.id}") as ws:
+        assert ws.receive_json()["state"] == "finished"
+
+
+def test__metrics(client, queue, monkeypatch):
+    monkeypatch.setattr(server, "redis_conn", queue.connection)
+    queue.enqueue("os.getpid")
+    r = client.get("/metrics")
+    assert r.status_code == 200
+    assert 'httypist_queue_depth{queue="process"} 1' in r.text
+    assert "httypist_worker_utilization 0" in r.text
+
+
+@pytest.fixture
+def templates(tmp_path, monkeypatch):
+    from httypist import registry
+    path = tmp_path / "letter"
+    path.mkdir()
+    (path / "letter.txt.jinja").write_text("Dear {{ json.name }}")
+    template = dict(
+        name="letter",
+        path=str(path),
+        commit=None,
+        config={"output": {"files": ["letter.txt"]}, "batch_chunk_size": 2},
+    )
+    monkeypatch.setattr(
+        server, "current_registry", registry.Registry(templates={"letter": template})
+    )
+    return {"letter": template}
+
+
+def test__batch(client, queue, templates, monkeypatch):
+    from httypist import worker
+    monkeypatch.setattr(server, "redis_conn", queue.connection)
+    monkeypatch.setattr(worker, "redis_conn", queue.connection)
+    body = "\n".join('{"name": "%s"}' % name for name in ("Anna", "Bob", "Carl"))
+    r = client.post("/batch/letter", content=body)
+    assert r.status_code == 200
+    result = r.json()["result"]
+    assert (result["records"], result["jobs"]) == (3, 2)
+    assert queue.count == 0
+    status = client.get(f"/batch/{result['batch_id']}").json()["result"]
+    assert (status["done"], status["finished"]) == (0, False)
+
+    worker.create_worker(worker.SimpleWorker, ["process"]).work(burst=True)
+    status = client.get(f"/batch/{result['batch_id']}").json()["result"]
+    assert (status["done"], status["failed"], status["finished"]) == (3, 0, True)
+    r = client.get(f"/batch/{result['batch_id']}/result.zip")
+    with zipfile.ZipFile(io.BytesIO(r.content)) as zf:
+        assert sorted(zf.namelist()) == ["0/letter.txt", "1/letter.txt", "2/letter.txt"]
+        assert zf.read("1/letter.txt") == b"Dear Bob"
+    assert client.get("/batch/unknown").status_code == 404
+
+
+def test__empty_batch(client, queue, templates):
+    r = client.post("/batch/letter", content=b"")
+    assert r.status_code == 400
+    assert queue.count == 0
+
+
+def test__body_size_limit(client, templates, monkeypatch):
+    from httypist import ingest
+    monkeypatch.setattr(ingest, "MAX_BODY_SIZE", 10)
+    r = client.post("/process/letter", content=b'{"name": "a long name"}')
+    assert r.status_code == 413
+
+
+def test__multipart_upload(client, queue, templates, store):
+    from rq import SimpleWorker
+    templates["letter"]["config"]["output"]["files"].append("photo.jpg")
+    r = client.post(
+        "/process/letter",
+        data={"name": "Anna"},
+        files={"photo": ("../photo.jpg", b"\xff\xd8jpeg", "image/jpeg")},
+    )
+    assert r.status_code == 200
+    job = queue.fetch_job(r.json()["result"]["request_id"])
+    assert job.kwargs["data"]["form"] == {"name": "Anna"}
+    assert [f["filename"] for f in job.kwargs["data"]["files"]] == ["photo.jpg"]
+    SimpleWorker([queue], connection=queue.connection).work(burst=True)
+    job.refresh()
+    with zipfile.ZipFile(store.open(f"{job.result['artifacts']}/result.zip")) as zf:
+        assert zf.read("photo.jpg") == b"\xff\xd8jpeg"
+
+
+def test__sync_render(client, queue, templates):
+    templates["letter"]["config"]["sync"] = True
+    r = client.post("/process/letter", json={"name": "Anna"})
+    assert r.status_code == 200
+    assert r.headers["x-httypist-sync"] == "1"
+    assert r.headers["content-type"].startswith("text/plain")
+    assert r.content == b"Dear Anna"
+    assert queue.count == 0
+
+
+def test__sync_render_timeout_uses_queue(client, queue, templates, monkeypatch):
+    from httypist import processor
+    templates["letter"]["config"]["sync"] = True
+    monkeypatch.setattr(server, "SYNC_TIMEOUT", 0.05)
+    monkeypatch.setattr(processor, "render_sync", lambda *args: time.sleep(0.5))
+    r = client.post("/process/letter", json={"name": "Anna"})
+    assert "request_id" in r.json()["result"]
+    assert queue.count == 1
+
+
+def test__startup_uses_registry_snapshot(monkeypatch):
+    from httypist import registry
+    snapshot = registry.Registry("abc", {"t": dict(name="t", path=".", commit="abc", config={})})
+    refreshed = []
+    monkeypatch.setattr(registry, "load_snapshot", lambda: snapshot)
+    monkeypatch.setattr(server, "refresh_in_background", lambda: refreshed.append(True))
+    monkeypatch.setattr(server.storage, "start_sweeper", lambda **kwargs: None)
+    monkeypatch.setattr(server.hub, "start", lambda connection: None)
+    monkeypatch.setattr(server, "current_registry", registry.Registry())
+    with TestClient(server.app):
+        assert server.current_registry is snapshot
+    assert refreshed == [True]
+
+
+def test__log_of_running_job_is_followed(client, queue, templates, run_jobs):
+    from httypist import processor
+    job = queue.enqueue(
+        processor.process_template, template=templates["letter"], data=dict(body=b"{}")
+    )
+    responses = []
+    thread = threading.Thread(
+        target=lambda: responses.append(client.get(f"/result/{job.id}/log"))
+    )
+    thread.start()
+    time.sleep(0.5)
+    run_jobs()
+    thread.join(10)
+    r = responses[0]
+    assert r.status_code == 200
+    assert "Template created" in r.text
+    assert "callbacks took" in r.text
+    stored = client.get(f"/result/{job.id}/log")
+    assert "callbacks took" in stored.text
+
+
+def test__rate_limits(client, queue, templates, run_jobs, monkeypatch):
+    from httypist import registry
+    limits = dict(name="shop", rate=0.001, burst=2.0, max_in_flight=1)
+    monkeypatch.setattr(
+        server,
+        "current_registry",
+        registry.Registry(
+            templates=templates, authentication={"t": ["*"]}, limits={"t": limits}
+        ),
+    )
+    headers = {"Authorization": "t"}
+    r = client.post("/process/letter", json={"name": "Anna"}, headers=headers)
+    assert r.status_code == 200
+    r = client.post("/process/letter", json={"name": "Bob"}, headers=headers)
+    assert r.status_code == 429
+    assert r.headers["Retry-After"] == "5"
+    run_jobs()
+    r = client.post("/process/letter", json={"name": "Bob"}, headers=headers)
+    assert r.status_code == 429
+    assert int(r.headers["Retry-After"]) > 100
+
+
+def test__batch_in_flight_limit(client, queue, templates, run_jobs, monkeypatch):
+    from httypist import registry
+    limits = dict(name="shop", rate=1.0, burst=10.0, max_in_flight=1)
+    monkeypatch.setattr(
+        server,
+        "current_registry",
+        registry.Registry(
+            templates=templates, authentication={"t": ["*"]}, limits={"t": limits}
+        ),
+    )
+    headers = {"Authorization": "t"}
+    three = "\n".join('{"name": "%s"}' % name for name in ("Anna", "Bob", "Carl"))
+    two = "\n".join('{"name": "%s"}' % name for name in ("Anna", "Bob"))
+    # two chunks of two records
+    assert client.post("/batch/letter", content=three, headers=headers).status_code == 429
+    assert client.post("/batch/letter", content=two, headers=headers).status_code == 200
+    assert client.post("/batch/letter", content=two, headers=headers).status_code == 429
+    run_jobs()
+    assert client.post("/batch/letter", content=two, headers=headers).status_code == 200
+
+
+def test__queue_backpressure(client, queue, templates, run_jobs):
+    templates["letter"]["config"]["max_queue_depth"] = 1
+    assert client.post("/process/letter", json={"name": "Anna"}).status_code == 200
+    r = client.post("/process/letter", json={"name": "Bob"})
+    assert (r.status_code, r.headers["Retry-After"]) == (429, "10")
+    run_jobs()
+    assert client.post("/process/letter", json={"name": "Bob"}).status_code == 200
+
+
+def test__job_in_priority_queue(client, queue, templates):
+    templates["letter"]["config"].update(queue="fast", priority="high")
+    r = client.post("/process/letter", json={"name": "Anna"})
+    jobid = r.json()["result"]["request_id"]
+    assert queue.count == 0
+    r = client.get(f"/status/{jobid}")
+    assert r.status_code == 200
+    assert r.json()["result"]["state"] == "queued"
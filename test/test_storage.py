@@ -0,0 +1,55 @@
+import io
+import os
+import time
+import pytest
+from httypist import storage
+
+
+def test__local_store(store):
+    store.put("jobs/1/result.zip", io.BytesIO(b"zip"))
+    store.put("jobs/1/workspace/a.txt", io.BytesIO(b"a"))
+    assert store.open("jobs/1/result.zip").read() == b"zip"
+    assert store.stat("jobs/1/result.zip").size == 3
+    assert store.stat("jobs/1/missing") is None
+    assert [a.key for a in store.list("jobs/1/")] == [
+        "jobs/1/result.zip", "jobs/1/workspace/a.txt"
+    ]
+    with pytest.raises(KeyError):
+        store.open("jobs/2/result.zip")
+    with pytest.raises(ValueError):
+        store.put("../outside", io.BytesIO(b""))
+    store.delete("jobs/1")
+    assert list(store.list("jobs/")) == []
+
+
+def test__sweep(store):
+    for job in ("old", "new"):
+        store.put(f"jobs/{job}/result.zip", io.BytesIO(b"zip"))
+    past = time.time() - 100
+    os.utime(store.root / "jobs" / "old" / "result.zip", (past, past))
+    assert storage.sweep(store, ttl=50) == 1
+    assert [a.key for a in store.list()] == ["jobs/new/result.zip"]
+
+
+def test__s3_store():
+    boto3 = pytest.importorskip("boto3")
+    moto = pytest.importorskip("moto")
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="artifacts")
+        store = storage.S3Store("artifacts", "httypist", client=client)
+        store.put("jobs/1/result.zip", io.BytesIO(b"zip"))
+        assert store.open("jobs/1/result.zip").read() == b"zip"
+        assert [a.key for a in store.list("jobs/")] == ["jobs/1/result.zip"]
+        assert store.stat("jobs/1/result.zip").size == 3
+        with pytest.raises(KeyError):
+            store.open("jobs/2/result.zip")
+        store.delete("jobs/1")
+        assert list(store.list()) == []
+
+
+def test__sweeper_runs_tasks(store):
+    import threading
+    done = threading.Event()
+    storage.start_sweeper(interval=60, tasks=[done.set])
+    assert done.wait(5)
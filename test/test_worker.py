@@ -0,0 +1,103 @@
+import os
+import signal
+import sys
+import threading
+import time
+import pytest
+from httypist import autoscale
+from httypist import worker
+
+
+def fake_work(args, max_jobs):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    time.sleep(30)
+
+
+@pytest.fixture
+def run_pool(monkeypatch):
+    monkeypatch.setattr(worker, "work", fake_work)
+    handlers = signal.getsignal(signal.SIGTERM), signal.getsignal(signal.SIGINT)
+
+    def run(seconds, *args, **kwargs):
+        timer = threading.Timer(seconds, os.kill, (os.getpid(), signal.SIGTERM))
+        timer.start()
+        try:
+            worker.pool(["process"], *args, **kwargs)
+        finally:
+            timer.cancel()
+            signal.signal(signal.SIGTERM, handlers[0])
+            signal.signal(signal.SIGINT, handlers[1])
+
+    return run
+
+
+def test__autoscaled_pool(run_pool, monkeypatch):
+    targets = [2, 2, 1]
+    calls = []
+
+    class FakeScaler(object):
+        def __init__(self, connection, queue_names, minimum, maximum):
+            assert (minimum, maximum) == (1, 4)
+
+        def decide(self, running, pids):
+            calls.append(list(pids))
+            return targets.pop(0) if targets else 1
+
+        def remove(self):
+            pass
+
+    monkeypatch.setattr(autoscale, "Autoscaler", FakeScaler)
+    monkeypatch.setattr(autoscale, "INTERVAL", 0)
+    start = time.monotonic()
+    run_pool(3, 1, maximum=4)
+    assert time.monotonic() - start < 10
+    # two processes were started, the newest one was stopped again
+    assert calls[0] == []
+    first, second = calls[2]
+    assert calls[-1] == [first]
+
+
+def test__pool_replaces_recycled_children(run_pool, monkeypatch, tmp_path):
+    def recycled(args, max_jobs):
+        # a child which did its max_jobs jobs
+        (tmp_path / str(os.getpid())).write_text(str(max_jobs))
+
+    monkeypatch.setattr(worker, "work", recycled)
+    run_pool(2, 2, max_jobs=5)
+    started = list(tmp_path.iterdir())
+    assert len(started) > 2
+    assert {p.read_text() for p in started} == {"5"}
+
+
+def test__pool_forwards_sigterm(run_pool, monkeypatch, tmp_path):
+    def stopped(signum, frame):
+        (tmp_path / str(os.getpid())).touch()
+        sys.exit(0)
+
+    def work(args, max_jobs):
+        signal.signal(signal.SIGTERM, stopped)
+        time.sleep(30)
+
+    monkeypatch.setattr(worker, "work", work)
+    start = time.monotonic()
+    run_pool(1, 2)
+    # both children got the SIGTERM and the pool waited for them
+    assert time.monotonic() - start < 10
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test__default_queues(monkeypatch):
+    created = []
+
+    class FakeWorker(object):
+        def work(self, **kwargs):
+            pass
+
+    def create_worker(worker_class, args):
+        created.append(args)
+        return FakeWorker()
+
+    monkeypatch.setattr(worker, "create_worker", create_worker)
+    monkeypatch.setattr(sys, "argv", ["httypist"])
+    worker.main()
+    assert created == [["process", "callbacks"]]
@@ -0,0 +1,41 @@
+import pytest
+from httypist import workspace
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "logo.png"
+    path.write_bytes(b"png" * 1000)
+    return path
+
+
+def test__link_or_copy(source, tmp_path):
+    target = workspace.link_or_copy(source, tmp_path / "copy.png")
+    assert target.read_bytes() == source.read_bytes()
+
+
+def test__unsupported_method_is_not_tried_again(source, tmp_path, monkeypatch):
+    calls = []
+
+    def failing(name):
+        def method(src, dst):
+            calls.append(name)
+            raise OSError(18, "Invalid cross-device link")
+
+        method.__name__ = name
+        return method
+
+    monkeypatch.setattr(workspace, "reflink", failing("reflink"))
+    monkeypatch.setattr(workspace, "hardlink", failing("hardlink"))
+    monkeypatch.setattr(workspace, "_unsupported", set())
+    workspace.link_or_copy(source, tmp_path / "a.png")
+    workspace.link_or_copy(source, tmp_path / "b.png")
+    assert calls == ["reflink", "hardlink"]
+    assert (tmp_path / "b.png").read_bytes() == source.read_bytes()
+
+
+def test__get_copy_function():
+    assert workspace.get_copy_function({}) is workspace.reflink_or_copy
+    assert workspace.get_copy_function({"workspace": "copy"}) is workspace.STRATEGIES["copy"]
+    with pytest.raises(ValueError):
+        workspace.get_copy_function({"workspace": "overlay"})